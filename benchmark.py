@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks for the ewelink MQTT bridge.
+The eWeLink cloud is replaced by a stub that records when a command arrives, so no account is needed,
+but the mqtt benchmark does need an MQTT broker.
+
+./benchmark.py mqtt -b 192.168.1.119
+./benchmark.py ws
+./benchmark.py state
+./benchmark.py route
+./benchmark.py wait
+./benchmark.py soak
+'''
+
+import asyncio
+import logging
+import time
+import statistics
+import argparse
+import json
+import io
+import tracemalloc
+import gc
+import sys
+
+BENCH_DEVICE = {'deviceid'     : 'bench00001',
+                'name'         : 'Benchmark Switch',
+                'productModel' : 'Basic',
+                'apikey'       : 'bench',
+                'params'       : {'switch': 'off'}
+               }
+
+def make_client(**kwargs):
+    '''
+    returns an EwelinkClient with the cloud connection replaced by a stub, with one Basic switch
+    '''
+    from ewelink import EwelinkClient, XRegistryCloud
+
+    class BenchClient(EwelinkClient):
+        async def send(self, device, params=None, sequence=None, timeout=5):
+            self.sent.put_nowait(time.perf_counter())
+
+    client = BenchClient(None, None, **kwargs)
+    XRegistryCloud.__init__(client, None)
+    client.set_online(True)     #commands wait for the cloud to be connected
+    client.sent = asyncio.Queue()
+    client._devices = [dict(BENCH_DEVICE)]
+    client._create_client_devices()
+    return client
+
+async def stop_client(client):
+    await client._stop()
+
+class NullMQTT():
+    '''
+    stands in for the MQTT client, so the publish path can be measured without a broker
+    '''
+    published = 0
+    on_publish = None
+    
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+        if isinstance(payload, str):    #as the real clients do
+            payload = payload.encode('utf-8')
+        if self.on_publish:
+            self.on_publish(self, None, self.published)
+        
+    def subscribe(self, topic, qos=0):
+        pass
+        
+    def want_write(self):
+        return False
+        
+    def is_connected(self):
+        return True
+        
+    def disconnect(self):
+        pass
+        
+    def loop_stop(self):
+        pass
+
+def ws_message(i):
+    '''
+    a typical cloud update for the benchmark device
+    '''
+    return {'action'   : 'update',
+            'deviceid' : BENCH_DEVICE['deviceid'],
+            'apikey'   : 'bench',
+            'userAgent': 'device',
+            'd_seq'    : i,
+            'params'   : {'switch': 'on' if i % 2 else 'off', 'startup': 'off', 'pulse': 'off', 'pulseWidth': 500, 'sledOnline': 'on',
+                          'rssi': -50 - i % 10, 'fwVersion': '3.5.0', 'staMac': '00:11:22:33:44:55'}
+           }
+
+def cloud_device(i):
+    '''
+    a device as returned by the cloud device list
+    '''
+    return {'deviceid'     : 'bench{:05d}'.format(i),
+            'name'         : 'Benchmark Switch {}'.format(i),
+            'productModel' : 'Basic',
+            'apikey'       : 'bench',
+            'online'       : True,
+            'extra'        : {'uiid': 1, 'description': '20180813001', 'brandId': '5c4c1aee3a7d24c7100be054', 'apmac': 'd0:27:00:01:02:03',
+                              'mac': 'd0:27:00:01:02:04', 'ui': 'Single Channel Switch', 'modelInfo': '5c700f8ed8b5a800017ff0b5',
+                              'model': 'PSF-BD1-GL', 'manufacturer': 'Bench Tech', 'chipid': '00A1B2C3'},
+            'family'       : {'familyid': '5f1234567890abcdef123456', 'index': i, 'members': [], 'roomid': '5f1234567890abcdef123457'},
+            'settings'     : {'opsNotify': 0, 'opsHistory': 1, 'alarmNotify': 1, 'wxAlarmNotify': 0, 'wxOpsNotify': 0, 'wxDoorbellNotify': 0, 'appDoorbellNotify': 1},
+            'devGroups'    : [],
+            'params'       : ws_message(i)['params']
+           }
+
+def report(name, results):
+    print('{:<12}'.format(name) + '  '.join('{}: {}'.format(k, v) for k, v in results.items()))
+
+async def bench_mqtt(arg):
+    '''
+    command-to-cloud latency (MQTT command published -> cloud send) and publishes per second for each transport
+    '''
+    for transport in arg.transport:
+        client = make_client(ip=arg.broker, port=arg.port, pubtopic='/ewelink_bench_status', topic='/ewelink_bench_command/', transport=transport, command_rate=0)
+        if not await client._waitForMQTT(10):
+            print('Unable to connect to MQTT broker {}:{}'.format(arg.broker, arg.port))
+            return
+        await asyncio.sleep(0.5)    #let subscription complete
+        latencies = []
+        for i in range(arg.count):
+            start = time.perf_counter()
+            client._mqttc.publish('/ewelink_bench_command/{}/switch'.format(BENCH_DEVICE['deviceid']), 'on' if i % 2 else 'off')
+            try:
+                end = await asyncio.wait_for(client.sent.get(), 5)
+            except asyncio.TimeoutError:
+                print('{}: command {} timed out'.format(transport, i))
+                continue
+            latencies.append((end - start) * 1000)
+        start = time.perf_counter()
+        for i in range(arg.publishes):
+            client._publish(BENCH_DEVICE['deviceid'], 'bench', i)
+        while client._mqttc.want_write():
+            await asyncio.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        report(transport, {'commands': len(latencies),
+                           'latency ms (median)': round(statistics.median(latencies), 3) if latencies else None,
+                           'latency ms (max)': round(max(latencies), 3) if latencies else None,
+                           'publishes/s': int(arg.publishes / elapsed)})
+        await stop_client(client)
+
+async def bench_ws(arg):
+    '''
+    peak bytes allocated and json serializations per cloud (WS) message, from _process_ws_msg to the MQTT client publish
+    copy this file to an older version of the bridge for a before/after comparison
+    '''
+    dumps = json.dumps
+    calls = [0]
+    def counting_dumps(*args, **kwargs):
+        calls[0] += 1
+        return dumps(*args, **kwargs)
+        
+    main_log = logging.getLogger('Main')
+    if arg.debug:   #format every message, as writing a debug log would
+        main_log.setLevel(logging.DEBUG)
+        main_log.addHandler(logging.StreamHandler(io.StringIO()))
+        main_log.propagate = False
+    client = make_client(json_out=arg.json_out, refresh=0)
+    client._mqttc = NullMQTT()
+    client._mqttc.on_publish = client._on_publish
+    messages = [ws_message(i) for i in range(arg.count)]
+    allocated = []
+    json.dumps = counting_dumps
+    tracemalloc.start()
+    try:
+        for data in messages:
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            await client._process_ws_msg(data)
+            allocated.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+        json.dumps = dumps
+    report('ws', {'messages': arg.count,
+                  'peak bytes allocated/msg (median)': int(statistics.median(allocated)),
+                  'json serializations/msg': round(calls[0] / arg.count, 2),
+                  'publishes/msg': round(client._mqttc.published / arg.count, 2)})
+    await stop_client(client)
+
+async def bench_state(arg):
+    '''
+    memory per device, and time per device update (cloud message to publish)
+    devices and messages go through json, so they are built like the real (parsed) cloud messages
+    '''
+    client = make_client(refresh=0)
+    client._mqttc = NullMQTT()
+    client._mqttc.on_publish = client._on_publish
+    messages = json.loads(json.dumps([ws_message(i) for i in range(arg.count)]))
+    devices = json.dumps([dict(cloud_device(i), deviceid='state{:05d}'.format(i)) for i in range(arg.devices)])
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    devices = json.loads(devices)
+    client._devices = devices
+    client._create_client_devices()
+    del devices
+    created = tracemalloc.get_traced_memory()[0] - base
+    clients = [device for device in client._clients.values() if device.deviceid != BENCH_DEVICE['deviceid']]
+    start = time.perf_counter()
+    for i, data in enumerate(messages):
+        clients[i % len(clients)]._handle_notification(data)
+    elapsed = time.perf_counter() - start
+    del messages
+    updated = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    report('state', {'devices': len(clients),
+                     'bytes/device (created)': int(created / len(clients)),
+                     'bytes/device (after updates)': int(updated / len(clients)),
+                     'us/update': round(elapsed * 1e6 / arg.count, 1)})
+    await stop_client(client)
+
+class Message():
+    '''
+    a received MQTT message
+    '''
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload.encode('utf-8')
+
+async def bench_route(arg):
+    '''
+    time per received MQTT command to find the device (or reject the topic), with many devices
+    the command is not handled (the worker pool is bypassed), so this is just the routing cost
+    the best of repeat runs is reported, and the first run (before any topics have been seen) in brackets
+    '''
+    client = make_client(topic='/ewelink_command/')
+    client._devices = [cloud_device(i) for i in range(arg.devices)]
+    client._create_client_devices()
+    routed = []
+    client._workers.put = lambda deviceid, func, *args: routed.append(deviceid)
+    known = [Message('/ewelink_command/{}/switch'.format(client._devices[i % arg.devices]['deviceid']), 'on') for i in range(arg.count)]
+    named = [Message('/ewelink_command/{}/switch'.format(client._devices[i % arg.devices]['name'].lower()), 'on') for i in range(arg.count)]
+    unknown = [Message('/ewelink_command/unknown{:05d}/switch'.format(i), 'on') for i in range(arg.count)]
+    results = {'devices': arg.devices}
+    gc.collect()
+    for name, messages in [('deviceid', known), ('name', named), ('unknown', unknown)]:
+        times = []
+        for _ in range(arg.repeat):     #best of repeat, as timeit does
+            start = time.perf_counter()
+            for msg in messages:
+                client._get_command(msg)
+            times.append(time.perf_counter() - start)
+        results['us/msg ({})'.format(name)] = '{:.2f} (first {:.2f})'.format(min(times) * 1e6 / arg.count, times[0] * 1e6 / arg.count)
+    results['routed'] = len(routed) // arg.repeat
+    report('route', results)
+    await stop_client(client)
+
+async def reaction(wait, trigger, count):
+    '''
+    returns list of ms from trigger() to wait() returning, for count waits
+    '''
+    latencies = []
+    for _ in range(count):
+        task = asyncio.ensure_future(wait())
+        await asyncio.sleep(0.01)   #let it start waiting
+        start = time.perf_counter()
+        trigger()
+        await task
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+async def bench_wait(arg):
+    '''
+    time from an event (device param changing, cloud going offline, MQTT connecting) to the code waiting for it running
+    these used to be checked every second, so took up to 1000ms, they should now take well under 100ms
+    '''
+    from device_state import DeviceState
+    client = make_client()
+    client._mqttc = NullMQTT()
+    client._broker = 'bench'
+    client._transport = 'asyncio'
+    state = DeviceState('bench', {'m': '1'})
+
+    def param_trigger():
+        state.update({'m': '2'})
+    async def param_wait():
+        state.update({'m': '1'})
+        await state.wait_for('m', '2')
+
+    def offline_trigger():
+        client.set_online(False)
+    async def offline_wait():
+        client.set_online(True)
+        await client._loop_while_online()
+
+    def mqtt_trigger():
+        client._on_mqtt_connect(client._mqttc, None, {}, 0)
+    async def mqtt_wait():
+        client._on_mqtt_disconnect(client._mqttc, None, 0)
+        await client._waitForMQTT()
+
+    results = {}
+    worst = 0
+    for name, wait, trigger in [('param', param_wait, param_trigger), ('cloud offline', offline_wait, offline_trigger),
+                                ('mqtt connect', mqtt_wait, mqtt_trigger)]:
+        latencies = await reaction(wait, trigger, arg.count)
+        worst = max(worst, max(latencies))
+        results['ms ({})'.format(name)] = '{:.3f} (max {:.3f})'.format(statistics.median(latencies), max(latencies))
+    results['under {}ms'.format(arg.limit)] = worst < arg.limit
+    report('wait', results)
+    await stop_client(client)
+    return worst < arg.limit
+
+class SoakWS():
+    '''
+    stands in for the cloud WS, receives nothing until it's closed
+    '''
+    def __init__(self):
+        self._closed = asyncio.Event()
+        
+    @property
+    def closed(self):
+        return self._closed.is_set()
+        
+    async def close(self):
+        self._closed.set()
+        
+    async def wait_closed(self):
+        await self._closed.wait()
+
+async def bench_soak(arg):
+    '''
+    memory, tasks and clients over many cloud reconnects of the start_connection() loop (login and the cloud are stubbed),
+    with a few devices coming and going, one device replaced by a new one each time, and a command sent to every device
+    (so each has a command scheduler). The WS task reconnects while the session is open, as XRegistryCloud.run_forever() does,
+    and each reconnect is caused by the WS closing and the WS task failing to reconnect once.
+    memory and tasks are measured after the first 10 reconnects, and at the end, they should stay flat, with one WS task
+    returns False if memory grew by more than arg.growth percent, or there are more tasks, clients or schedulers at the end
+    '''
+    import ewelink
+    ewelink.arg = argparse.Namespace(poll_interval=0, appid=0, oauth=False, startup_report=False)
+    client = make_client(command_rate=0)    #no waiting between commands
+    client.reconnect_delay = 0
+    client._mqttc = NullMQTT()
+    client._mqttc.on_publish = client._on_publish
+    reconnect = [0]
+    fail = [False]
+    ws_tasks = set()
+    online = asyncio.Queue()
+
+    async def login(*args, **kwargs):
+        client._saved_auth = {'at': 'soak'}     #a good token, so start_connection() reconnects straight away
+        return True
+    async def get_homes():
+        return {'home': 'Home'}
+    async def get_devices(homes=None):
+        churn = reconnect[0] % 5    #devices 0-4 come and go
+        devices = [cloud_device(i) for i in range(churn, arg.devices-1)]
+        devices.append(dict(cloud_device(arg.devices), deviceid='soak{:05d}'.format(reconnect[0])))
+        return json.loads(json.dumps(devices))
+    async def connect():
+        if fail[0]:
+            fail[0] = False
+            return False
+        client.ws = SoakWS()
+        return True
+    async def run_forever():
+        ws_tasks.add(asyncio.current_task())
+        try:
+            while not client.session.closed:
+                if not await client.connect():
+                    client.set_online(False)
+                    await asyncio.sleep(0.01)
+                    continue
+                client.set_online(True)
+                await client.ws.wait_closed()
+        finally:
+            ws_tasks.discard(asyncio.current_task())
+    async def send(device, params=None, sequence=None, timeout=5):
+        return 'online'
+    loop_while_online = client._loop_while_online
+    async def while_online():
+        online.put_nowait(True)
+        await loop_while_online()
+    client._login, client.get_homes, client.get_devices, client.connect, client.run_forever, client.send = login, get_homes, get_devices, connect, run_forever, send
+    client._loop_while_online = while_online
+
+    tracemalloc.start()
+    samples = {}
+    created = 0
+    previous = set()    #the client objects of the last connection (not every one created, that would grow)
+    task = asyncio.create_task(client.start_connection(ewelink.arg))
+    for reconnect[0] in range(1, arg.count+1):
+        await asyncio.wait_for(online.get(), 10)
+        current = set(client._clients.values())
+        created += len(current - previous)
+        previous = current
+        await asyncio.gather(*[device._setparameter('switch', 'on') for device in client._clients.values()])
+        if reconnect[0] in (10, arg.count):
+            gc.collect()
+            samples[reconnect[0]] = (tracemalloc.get_traced_memory()[0], len(asyncio.all_tasks()), len(ws_tasks), len(client._clients), len(client._schedulers))
+        fail[0] = True
+        await client.ws.close()
+    tracemalloc.stop()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    (mem0, tasks0, ws0, clients0, schedulers0), (mem1, tasks1, ws1, clients1, schedulers1) = samples[10], samples[arg.count]
+    flat = (mem1 <= mem0 * (1 + arg.growth / 100) and tasks1 <= tasks0 and ws1 == 1 and clients1 <= clients0
+            and schedulers1 <= schedulers0)
+    report('soak', {'reconnects': arg.count,
+                    'KB (after 10)': round(mem0 / 1024),
+                    'KB (end)': round(mem1 / 1024),
+                    'tasks': '{} -> {}'.format(tasks0, tasks1),
+                    'WS tasks': '{} -> {}'.format(ws0, ws1),
+                    'clients': '{} -> {}'.format(clients0, clients1),
+                    'schedulers': '{} -> {}'.format(schedulers0, schedulers1),
+                    'clients created': created,
+                    'flat': flat})
+    await stop_client(client)
+    return flat
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='ewelink bridge benchmarks')
+    sub = parser.add_subparsers(dest='bench', required=True)
+    mqtt_parser = sub.add_parser('mqtt', help='MQTT transport latency and throughput (needs a broker)')
+    mqtt_parser.add_argument('-b', '--broker', action='store', type=str, default='127.0.0.1', help='ipaddress of MQTT broker (default: %(default)s)')
+    mqtt_parser.add_argument('-p', '--port', action='store', type=int, default=1883, help='MQTT broker port number (default: %(default)s)')
+    mqtt_parser.add_argument('-t', '--transport', nargs='*', action='store', type=str, default=['paho', 'asyncio'], help='transports to test (default: %(default)s)')
+    mqtt_parser.add_argument('-n', '--count', action='store', type=int, default=200, help='number of commands (default: %(default)s)')
+    mqtt_parser.add_argument('-N', '--publishes', action='store', type=int, default=20000, help='number of publishes (default: %(default)s)')
+    ws_parser = sub.add_parser('ws', help='bytes allocated and serializations per cloud message (no broker needed)')
+    ws_parser.add_argument('-n', '--count', action='store', type=int, default=1000, help='number of messages (default: %(default)s)')
+    ws_parser.add_argument('-J', '--json_out', action='store_true', help='publish topics as json (default: %(default)s)')
+    ws_parser.add_argument('-D', '--debug', action='store_true', help='debug logging (default: %(default)s)')
+    state_parser = sub.add_parser('state', help='memory per device and device update cost (no broker needed)')
+    state_parser.add_argument('-d', '--devices', action='store', type=int, default=1000, help='number of devices (default: %(default)s)')
+    state_parser.add_argument('-n', '--count', action='store', type=int, default=20000, help='number of updates (default: %(default)s)')
+    route_parser = sub.add_parser('route', help='time to route a received MQTT command to its device (no broker needed)')
+    route_parser.add_argument('-d', '--devices', action='store', type=int, default=10000, help='number of devices (default: %(default)s)')
+    route_parser.add_argument('-n', '--count', action='store', type=int, default=20000, help='number of commands of each kind (default: %(default)s)')
+    route_parser.add_argument('-r', '--repeat', action='store', type=int, default=5, help='times to repeat, the best time is reported (default: %(default)s)')
+    wait_parser = sub.add_parser('wait', help='time to react to a param change, the cloud going offline and MQTT connecting (no broker needed)')
+    wait_parser.add_argument('-n', '--count', action='store', type=int, default=20, help='number of times to measure each (default: %(default)s)')
+    wait_parser.add_argument('-l', '--limit', action='store', type=float, default=100, help='max ms allowed, exits with 1 if exceeded (default: %(default)s)')
+    soak_parser = sub.add_parser('soak', help='memory and tasks over many simulated cloud reconnects (no broker needed)')
+    soak_parser.add_argument('-d', '--devices', action='store', type=int, default=50, help='number of devices (default: %(default)s)')
+    soak_parser.add_argument('-n', '--count', action='store', type=int, default=300, help='number of reconnects (default: %(default)s)')
+    soak_parser.add_argument('-g', '--growth', action='store', type=float, default=5, help='max memory growth allowed (percent), exits with 1 if exceeded, or if tasks, clients or schedulers grow (default: %(default)s)')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    arg = parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    benchmarks = {'mqtt': bench_mqtt, 'ws': bench_ws, 'state': bench_state, 'route': bench_route, 'wait': bench_wait, 'soak': bench_soak}
+    if asyncio.get_event_loop().run_until_complete(benchmarks[arg.bench](arg)) is False:
+        sys.exit(1)
@@ -0,0 +1,148 @@
+'''
+Command scheduler for the ewelink bridge
+The cloud gives 504 Timeouts if a device is sent more than about one command per second,
+so commands for each device are queued, and sent in order at a limited rate.
+Parameter writes that arrive close together can be merged into one command.
+'''
+
+import asyncio
+import collections
+import logging
+import time
+
+class TokenBucket():
+    '''
+    Allows rate events per second, with bursts of up to burst events (rate <= 0 is unlimited)
+    '''
+
+    def __init__(self, rate=1.0, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def delay(self):
+        '''
+        seconds until a token is available (0 if there is one now)
+        '''
+        if self.rate <= 0:
+            return 0
+        self._refill()
+        return 0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    async def acquire(self):
+        '''
+        wait for, and take a token
+        '''
+        while True:
+            delay = self.delay()
+            if not delay:
+                break
+            await asyncio.sleep(delay)
+        if self.rate > 0:
+            self._tokens -= 1
+
+class CommandScheduler():
+    '''
+    Queue of commands (cloud payloads) for one device, sent in order by send(payload, waitResponse) at
+    the rate allowed by a TokenBucket.
+    If a command for the same params as a command that has not been sent yet is put, the earlier command
+    is dropped (superseded), and the new one is sent in order from where it was put. Everyone waiting on
+    a superseded command gets the result of the command that replaced it.
+    If merge_window (seconds) is set, parameter writes wait merge_window before they are sent, and a parameter
+    write put while the last queued command is also a parameter write is merged into it, so that several
+    params are set in one command. Everyone waiting on a merged command gets the result of sending it.
+    '''
+
+    def __init__(self, send, rate=1.0, burst=1, merge_window=0, loop=None, log=None):
+        self._log = log
+        if self._log is None:
+            self._log = logging.getLogger('Main.'+__class__.__name__)
+        self._send = send
+        self._loop = loop or asyncio.get_event_loop()
+        self._bucket = TokenBucket(rate, burst)
+        self.merge_window = merge_window
+        self._pending = collections.OrderedDict()   #params key: (payload, waitResponse, [futures], time to send)
+        self._task = None
+        self.stats = {'sent': 0, 'superseded': 0, 'merged': 0, 'max_depth': 0}
+
+    def __len__(self):
+        return len(self._pending)
+
+    @staticmethod
+    def _key(payload):
+        params = payload.get('params')
+        return tuple(sorted(params)) if params else None   #None is a query (get params)
+
+    def put(self, payload, waitResponse=False):
+        '''
+        queue payload, returns a future for the result of sending it
+        '''
+        future = self._loop.create_future()
+        futures = [future]
+        ready = 0
+        if payload.get('params') and self.merge_window:
+            ready = time.monotonic() + self.merge_window
+            if self._pending and next(reversed(self._pending)) is not None:     #last queued command is a parameter write
+                last = self._pending.popitem()[1]
+                self._log.debug('command merged: %s into %s', payload['params'], last[0]['params'])
+                self.stats['merged'] += 1
+                payload = dict(last[0], params={**last[0]['params'], **payload['params']})
+                waitResponse = waitResponse or last[1]
+                futures = last[2] + futures
+                ready = last[3]
+        key = self._key(payload)
+        superseded = self._pending.pop(key, None)
+        if superseded is not None:
+            self._log.debug('command superseded: %s', superseded[0].get('params'))
+            self.stats['superseded'] += 1
+            waitResponse = waitResponse or superseded[1]
+            futures = superseded[2] + futures
+        self._pending[key] = (payload, waitResponse, futures, ready)
+        self.stats['max_depth'] = max(self.stats['max_depth'], len(self._pending))
+        if self._task is None:
+            self._task = self._loop.create_task(self._run())
+        return future
+
+    async def _run(self):
+        '''
+        send queued commands as the token bucket allows, exits when the queue is empty
+        '''
+        try:
+            while self._pending:
+                delay = next(iter(self._pending.values()))[3] - time.monotonic()
+                if delay > 0:   #merge window
+                    await asyncio.sleep(delay)
+                await self._bucket.acquire()
+                payload, waitResponse, futures, ready = self._pending.popitem(last=False)[1]
+                result = None
+                try:
+                    result = await self._send(payload, waitResponse)
+                except Exception as e:
+                    self._log.exception(e)
+                finally:    #including when cancelled by clear(), so no one is left waiting
+                    for future in futures:
+                        if not future.done():
+                            future.set_result(result)
+                self.stats['sent'] += 1
+        finally:
+            if self._task is asyncio.current_task():    #not replaced by a new task after clear()
+                self._task = None
+
+    def clear(self):
+        '''
+        drop all queued commands, and stop sending
+        '''
+        if self._task:
+            self._task.cancel()
+            self._task = None   #so the next put() starts a new task
+        for payload, waitResponse, futures, ready in self._pending.values():
+            for future in futures:
+                if not future.done():
+                    future.set_result(None)
+        self._pending.clear()
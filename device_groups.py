@@ -0,0 +1,85 @@
+'''
+Device groups for the ewelink bridge
+Named groups of devices, so that one command sent to /ewelink_command/group/<name>/<command> goes to all of them.
+Groups are made automatically for all devices, each productModel and each device_type, and can be defined
+in a json file, eg:
+{"downstairs": ["Kitchen Light", "1000861ac4", 3],
+ "plugs":      {"productModel": ["Pow", "S31"]},
+ "switches":   {"device_type": "switch"}
+}
+a list selects devices by deviceid, name or index number (as for get_deviceid()), a dictionary selects all
+devices with any of the productModels and/or device_types given.
+'''
+
+import json
+import logging
+
+class DeviceGroup():
+    '''
+    A named group of device clients
+    '''
+    __slots__ = ('name', 'clients')
+
+    def __init__(self, name, clients):
+        self.name = name
+        self.clients = clients
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __repr__(self):
+        return 'DeviceGroup({}, {} devices)'.format(self.name, len(self.clients))
+
+def load_groups(path, log=None):
+    '''
+    load group definitions from json file path, returns {} if there isn't one
+    '''
+    log = log or logging.getLogger('Main.'+__name__)
+    try:
+        with open(path, 'r') as f:
+            groups = json.load(f)
+        if not isinstance(groups, dict):
+            raise ValueError('groups must be a dictionary of name: devices')
+        log.debug('loaded groups: %s', list(groups))
+        return groups
+    except FileNotFoundError:
+        return {}
+    except (ValueError, OSError) as e:
+        log.error('Unable to load groups from %s: %s', path, e)
+        return {}
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+def build_groups(config, registry, clients, log=None):
+    '''
+    returns dictionary of name: DeviceGroup for the automatic groups and the groups in config
+    registry is the DeviceRegistry, clients is the dictionary of deviceid: client
+    groups in config replace automatic groups of the same name
+    '''
+    log = log or logging.getLogger('Main.'+__name__)
+    if not clients:
+        return {}
+    members = {'all': list(clients.values())}
+    for device in registry:
+        client = clients.get(device['deviceid'])
+        if client is None:
+            continue
+        for name in {device['productModel'], client.device_type}:
+            members.setdefault(name, []).append(client)
+    for name, selection in config.items():
+        if isinstance(selection, dict):
+            models = set(_as_list(selection.get('productModel', [])))
+            types = set(_as_list(selection.get('device_type', [])))
+            selected = [client for client in clients.values()
+                        if client._productModel in models or client.device_type in types]
+        else:
+            selected = []
+            for sel_device in _as_list(selection):
+                client = clients.get(registry.get_deviceid(sel_device))
+                if client is None:
+                    log.warning('group %s: device %s not found', name, sel_device)
+                elif client not in selected:
+                    selected.append(client)
+        members[name] = selected
+    return {name: DeviceGroup(name, group_clients) for name, group_clients in members.items() if group_clients}
@@ -0,0 +1,84 @@
+'''
+Device registry for the ewelink bridge
+Keeps dictionary indexes of the cloud device list so that devices can be looked up
+by deviceid, name (case sensitive or not) or ordinal without scanning the list.
+'''
+
+import logging
+
+class DeviceRegistry():
+    '''
+    Indexed list of ewelink devices (the json dicts returned by the cloud)
+    The indexes are rebuilt as a whole and swapped in in one assignment whenever the
+    device list changes, so a lookup never sees a half built index.
+    '''
+
+    def __init__(self, devices=None, log=None):
+        self._log = log
+        if self._log is None:
+            self._log = logging.getLogger('Main.'+__class__.__name__)
+        self._index = ([], {}, {}, {}, set())   #devices, positions by deviceid, by name, by lowercase name, custom deviceids
+        self.update(devices or [])
+
+    @property
+    def devices(self):
+        return self._index[0]
+
+    def __len__(self):
+        return len(self._index[0])
+
+    def __iter__(self):
+        return iter(self._index[0])
+
+    def __contains__(self, deviceid):
+        return deviceid in self._index[1]
+
+    def update(self, devices):
+        '''
+        replace the device list, and rebuild the indexes
+        '''
+        self._rebuild(list(devices), set())
+
+    def add(self, device, custom=False):
+        '''
+        add a device to the list, and rebuild the indexes
+        '''
+        custom_ids = self._index[4] | {device['deviceid']} if custom else self._index[4]
+        self._rebuild(self._index[0] + [device], custom_ids)
+
+    def _rebuild(self, devices, custom_ids):
+        by_id = {}
+        by_name = {}
+        by_lower_name = {}
+        for num, device in enumerate(devices):
+            by_id.setdefault(device['deviceid'], num)
+            name = device.get('name')
+            if name is not None:
+                by_name.setdefault(name, num)
+                by_lower_name.setdefault(name.lower(), num)
+        self._index = (devices, by_id, by_name, by_lower_name, custom_ids)
+        self._log.debug('device registry rebuilt: {} devices'.format(len(devices)))
+
+    def is_custom(self, deviceid):
+        return deviceid in self._index[4]
+
+    def get(self, sel_device=0):
+        '''
+        return device json for sel_device which can be a deviceid, a device name, or an index number in the range 0-99,
+        whichever matches the first device in the list (so a device called "1" after the second device doesn't hide it),
+        then a device name that matches case insensitively
+        returns None if not found
+        '''
+        devices, by_id, by_name, by_lower_name, _ = self._index
+        sel_device = str(sel_device)
+        matches = [num for num in (by_id.get(sel_device), by_name.get(sel_device)) if num is not None]
+        if len(sel_device) <= 2 and sel_device.isdigit() and int(sel_device) < len(devices):   #assume an index number in the range 0-99
+            matches.append(int(sel_device))
+        if not matches:
+            num = by_lower_name.get(sel_device.lower())
+            return devices[num] if num is not None else None
+        return devices[min(matches)]
+
+    def get_deviceid(self, sel_device=0):
+        device = self.get(sel_device)
+        return device['deviceid'] if device is not None else None
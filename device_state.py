@@ -0,0 +1,123 @@
+'''
+Device state for the ewelink bridge
+Compact store of a device's current parameters, with a version number that increases with every change,
+so that updates return (and consumers can ask for) just the parameters that changed.
+'''
+
+import asyncio
+import sys
+import time
+from collections.abc import Mapping
+
+_MISSING = object()
+
+#fields of the cloud device json that are only used by the ewelink app
+UNUSED_FIELDS = ('family', 'settings', 'devGroups', 'shareTo', 'devConfig', 'deviceFeature', 'brandLogo', 'showBrand',
+                 'isSupportGroup', 'isSupportedOnMP')
+
+def compact_device(device):
+    '''
+    remove the fields the bridge doesn't use from device json (in place), returns device
+    '''
+    for field in UNUSED_FIELDS:
+        device.pop(field, None)
+    return device
+
+def _merge(d, u):
+    '''
+    merge nested dictionary u into a copy of d
+    '''
+    d = dict(d)
+    for k, v in u.items():
+        if isinstance(v, Mapping) and isinstance(d.get(k), Mapping):
+            v = _merge(d[k], v)
+        d[k] = v
+    return d
+
+class DeviceState():
+    '''
+    Current parameters of one device, as a flat dictionary of param: value (param names are interned,
+    as every device of a model has the same ones).
+    version increases by one for each update that changes anything, and the version each param last changed
+    in is kept, so a consumer can get everything that changed since the version it last saw.
+    wait_for() waits for a param to have a value, woken by the update that sets it.
+    '''
+    __slots__ = ('deviceid', 'params', 'version', 'updated', '_versions', '_waiters')
+
+    def __init__(self, deviceid, params=None):
+        self.deviceid = sys.intern(deviceid)
+        self.params = {}
+        self.version = 0
+        self.updated = 0    #time of last update (changed or not)
+        self._versions = {} #param: version it last changed in
+        self._waiters = None    #list of (param, value, future) for wait_for(), None if nothing is waiting
+        if params:
+            self.update(params)
+
+    def __len__(self):
+        return len(self.params)
+
+    def __contains__(self, param):
+        return param in self.params
+
+    def __getitem__(self, param):
+        return self.params[param]
+
+    def get(self, param, default=None):
+        return self.params.get(param, default)
+
+    def update(self, params):
+        '''
+        merge params into the state (nested dictionaries are merged, everything else is replaced)
+        returns the delta, a dictionary of the params that changed, which is empty if nothing changed
+        '''
+        delta = {}
+        current = self.params
+        for param, value in params.items():
+            old = current.get(param, _MISSING)
+            if old is _MISSING:
+                param = sys.intern(param)
+            elif isinstance(value, Mapping) and isinstance(old, Mapping):
+                value = _merge(old, value)
+            if old != value:
+                current[param] = value
+                delta[param] = value
+        self.updated = time.time()
+        if delta:
+            self.version += 1
+            for param in delta:
+                self._versions[param] = self.version
+            if self._waiters:
+                for param, value, future in self._waiters:
+                    if delta.get(param, _MISSING) == value and not future.done():
+                        future.set_result(value)
+        return delta
+
+    async def wait_for(self, param, value, timeout=None):
+        '''
+        wait until param has value (returns straight away if it already has)
+        returns True, or False if timeout seconds pass first
+        '''
+        if self.params.get(param, _MISSING) == value:
+            return True
+        waiter = (param, value, asyncio.get_running_loop().create_future())
+        if self._waiters is None:
+            self._waiters = []
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter[2], timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiters.remove(waiter)
+            if not self._waiters:
+                self._waiters = None
+
+    def changes_since(self, version):
+        '''
+        returns dictionary of params that changed after version
+        '''
+        if version >= self.version:
+            return {}
+        return {param: self.params[param] for param, changed in self._versions.items() if changed > version}
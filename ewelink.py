@@ -43,6 +43,7 @@ This websocket interface is the connection to the Autoslide device. This is an i
 - Autoslide connects to iTEAD's servers, and the servers pass messages back and forth. This is where the disconnects and Timeouts can happen..
 
 Do not hit the servers with too many commands too quickly, max is about 1 per second. You will get Timeouts if you send commands too quickly.
+Commands for each device are queued and sent at no more than command_rate (default 1) per second, a queued command is replaced by a newer one for the same params.
 
 eWelink uses "regions" to determine which servers to use. This client is set to use the US (North Amrican as I'm in Canada) servers by
 default, and is supposed to select other regions if that doesn't work - but I haven't tried this out.
@@ -173,25 +174,39 @@ Autoslide device:
   },
 '''
 
+import sys
+from import_utils import ImportProfiler, import_submodule
+#--import-report has to start timing before anything else is imported, so before the options are parsed
+_import_profiler = ImportProfiler().start() if '--import-report' in sys.argv else None
+
 import logging
-from logging.handlers import RotatingFileHandler
-import json, time, sys, hmac, hashlib, base64, collections, re, inspect
+from logging.handlers import RotatingFileHandler, QueueListener
+import json, time, hmac, hashlib, base64, collections, re, queue, atexit, random
 
 import asyncio
-from aiohttp import ClientSession, ClientTimeout, ClientConnectorError, WSMessage, ClientWebSocketResponse
+from aiohttp import ClientSession, ClientTimeout, ClientError, ClientConnectorError, WSMessage, WSMsgType, ClientWebSocketResponse
 
 from get_components import check_setup
 #install custom_components if needed
 check_setup()
 
-from typing import Callable, Dict, List, Optional, TypedDict
-
-from custom_components.sonoff.core.ewelink.__init__ import XRegistry, SIGNAL_ADD_ENTITIES
-from custom_components.sonoff.core.ewelink.base import XRegistryBase, XDevice, SIGNAL_UPDATE, SIGNAL_CONNECTED
+#only the cloud module (and the base module it uses) is needed, not the whole SonoffLAN integration
+#and the dummy homeassistant modules it's package __init__.py files import
+import_submodule('custom_components.sonoff.core.ewelink.cloud')
 from custom_components.sonoff.core.ewelink.cloud import XRegistryCloud, AuthError, APP
+from custom_components.sonoff.core.ewelink.base import XDevice
 
 from ewelink_devices import *
-from mqtt import MQTT
+from mqtt import MQTT, PublishPipeline, PublishCache, Envelope
+from device_registry import DeviceRegistry
+from log_utils import DeferredQueueHandler, LazyJson, SamplingFilter, StageTimer, set_log_level
+from command_scheduler import CommandScheduler
+from request_tracker import InFlightTracker
+from worker_pool import WorkerPool
+from topic_router import TopicRouter
+from device_groups import DeviceGroup, load_groups, build_groups
+from poll_scheduler import PollScheduler
+from snapshot import Snapshot
 
 _LOGGER = logger = logging.getLogger('Main.'+__name__)
 
@@ -201,6 +216,11 @@ __version__ = '2.0.0'
 APP.append(('YzfeftUVcZ6twZw1OoVKPRFYTrGEg01Q', '4G91qSoboqYO4Y0XJ0LPPKIsq8reHdfa'))
 # My appId and secret from my AutoslideNet app. can only use with Oauth2 authentication flow, needs to be renewed on 12th July every year
 OAUTH = [('tKjp3XDwekm5NROJ0TgfrvpHjGJnrXiq', 'nEu1HrliSwf1TQCqM7j97onLppK0F1LZ')]
+
+class WSConnectError(Exception):
+    '''
+    the dispatch server or WS server gave a response we can't use
+    '''
                                 
 class EwelinkClient(MQTT, XRegistryCloud):
     """A websocket client for connecting to ITEAD's devices."""
@@ -214,10 +234,21 @@ class EwelinkClient(MQTT, XRegistryCloud):
                                                         "(?P<month>\*|0?[1-9]|1[012])",
                                                         "(?P<day_of_week>\*|[0-6](\-[0-6])?)"
                                                       )
+    token_refresh = 20*24*3600  #refresh the auth token when it's this old (seconds), tokens last 30 days
+    token_check = 3600          #how often to check if the auth token needs refreshing while connected (seconds)
+    reconnect_delay = 5         #seconds to wait before reconnecting, when the auth token is still good
     
-    
-    def __init__(self, login=None, passw=None, region='us', log=None, **kwargs):
+    def __init__(self, login=None, passw=None, region='us', log=None, publish_window=0, refresh=0, command_rate=1.0, command_burst=1, merge_window=0,
+                 retries=0, command_timeout=5, stats_interval=0, workers=4, groups='groups.json', poll_concurrency=10, poll_jitter=1.0, poll_max=0,
+                 snapshot=None, snapshot_interval=300, **kwargs):
         self.auth = {'at':''}
+        self._started = time.monotonic()
+        self._cloud_online = asyncio.Event()    #set while the cloud WS is connected (see set_online())
+        self._cloud_offline = asyncio.Event()   #set when it disconnects (see _loop_while_online())
+        self._registry = DeviceRegistry(log=log)    #needed before MQTT.__init__(), which reads all attributes
+        self._publish_cache = PublishCache(refresh, exempt=['status', 'json', 'result', 'batch'])  #needed before MQTT connects (_on_connect)
+        self._router = TopicRouter()    #empty until _build_router(), commands received before then are rejected
+        self._groups = {}               #name: DeviceGroup, built with the router
         MQTT.__init__(self, log=log, **kwargs)
         self.log = log
         if self.log is None:
@@ -230,25 +261,57 @@ class EwelinkClient(MQTT, XRegistryCloud):
         self._region = region
         self._match_iso8601 = re.compile(self._ISOregex).match
         self._match_cron = re.compile(self._cronregex).match
-        self._devices = []
         self._clients = {}
         self._parameters = {}  #initial parameters for clients
         self._device_classes = {}
+        self._model_classes = {}    #productModel: device class
         self._load_devices() 
         self._load_custom_devices()
         self.loop = asyncio.get_event_loop()
+        self._pipeline = PublishPipeline(lambda topic, message: MQTT._publish(self, topic, message), publish_window/1000, self.loop)
+        self._command_rate = command_rate
+        self._command_burst = command_burst
+        self._merge_window = merge_window/1000
+        self._schedulers = {}   #deviceid: CommandScheduler
+        self._retries = retries
+        self._command_timeout = command_timeout
+        self._tracker = InFlightTracker()
+        self._workers = WorkerPool(workers, self.loop)     #handles MQTT commands for all devices
+        self._group_config = load_groups(groups, self.log)
+        self._poll_concurrency = max(1, poll_concurrency)
+        self._poll_jitter = poll_jitter
+        self._poll_max = poll_max
+        self._poller = PollScheduler(poll_jitter)
+        self._snapshot = Snapshot(snapshot, self.log)
+        self._saved_auth = None     #auth token, region and WS server from the snapshot (or the last login), see _login()
+        self._ws_backlog = None     #WS device messages received while the device list is loading, see _connect_cloud()
+        self._app = 0
+        if snapshot and snapshot_interval:
+            self._tasks['_save_snapshot_loop'] = self.loop.create_task(self._save_snapshot_loop(snapshot_interval))
+        self._poll_stats = {'cycles': 0, 'devices': 0, 'failed': 0, 'last_ms': 0, 'max_ms': 0}
+        self._build_router()
+        if stats_interval:
+            self._tasks['_publish_stats_loop'] = self.loop.create_task(self._publish_stats_loop(stats_interval))
+        
+    @property
+    def _devices(self):
+        return self._registry.devices
+        
+    @_devices.setter
+    def _devices(self, devices):
+        self._registry.update(devices)
         
     def _load_devices(self):
         '''
         Load device classes
         '''
-        clsmembers = inspect.getmembers(sys.modules[__name__], inspect.isclass) #get devices loaded from modules
-        for dev_class in clsmembers:
-            try:
-                self._device_classes[dev_class[1]] = dev_class[1].productModel
-                self.log.debug('loaded device {}, V:{}, for device models: {}'.format(dev_class[0],dev_class[1].__version__,dev_class[1].productModel))
-            except AttributeError:
-                pass
+        for dev_class in device_classes():
+            self._device_classes[dev_class] = dev_class.productModel
+            self.log.debug('loaded device {}, V:{}, for device models: {}'.format(dev_class.__name__,dev_class.__version__,dev_class.productModel))
+            for alias, other, reason in getattr(dev_class, '_ambiguous', []):
+                self.log.debug('device {}: ambiguous command {} / {} ({})'.format(dev_class.__name__, alias, other, reason))
+            for productModel in dev_class.productModel:
+                self._model_classes.setdefault(productModel, dev_class)   #first matching class
                 
     def _load_custom_devices(self):
         '''
@@ -259,7 +322,7 @@ class EwelinkClient(MQTT, XRegistryCloud):
         try:
             with open('custom_devices.json', 'r') as f:
                 self._custom_devices = json.load(f)
-                self.log.debug('loaded custom devices: {}'.format(self.pprint(self._custom_devices)))
+                self.log.debug('loaded custom devices: %s', LazyJson(self._custom_devices))
         except Exception as e:
             #self.log.exception(e)
             self._custom_devices = {}
@@ -271,6 +334,8 @@ class EwelinkClient(MQTT, XRegistryCloud):
         self._log.info('MQTT broker connected')
         self.subscribe('{}/#'.format(self._topic))
         self._history = {}
+        self._publish_cache.clear()
+        self._reset_backlog()
             
     def pprint(self,obj):
         """Pretty JSON dump of an object."""
@@ -287,47 +352,162 @@ class EwelinkClient(MQTT, XRegistryCloud):
         
     async def start_connection(self, arg):
         try:
-            while True:
-                async with ClientSession(timeout=ClientTimeout(total=5.0)) as session:
-                    XRegistryCloud.__init__(self, session)
-                    self.region = self._region
-                    
-                    if await self._login(self._username, self._passw, arg.appid, arg.oauth):
-                        self.log.debug('Connected: auth: {}'.format(self.pprint(self.auth)))
-                        homes = await self.get_homes()
-                        self.log.debug('Homes: {}'.format(self.pprint(homes)))
-                        if homes:
-                            self._devices = await self.get_devices(homes)
-                            self.log.debug('Devices: {}'.format(self.pprint(self._devices)))
-                            self._add_custom_devices(arg.poll_interval if arg.poll_interval else 60)
-                            self._create_client_devices()
-                            for device in self._devices:    #initial update
-                                client = self._get_client(device['deviceid'])
-                                client._handle_notification(device)
-                            self.log.info('Starting WS receive - waiting for messages')
-                            self.start()
-                            if await self._wait_for_WS(5):
-                                await self._loop_while_online()
-                            else:
-                                self.log.error('Unable to connect to WS, retry in 60 seconds')
-                    else:
-                        self.log.warning('auth: {}'.format(self.pprint(self.auth)))
-                        self.log.error('Failed to login, retry in 60 seconds')
-                await asyncio.sleep(60)
+            timer = StageTimer(self._started, self.log)
+            with timer.stage('warm start'):
+                self._warm_start(arg.poll_interval if arg.poll_interval else 60)
+            async with ClientSession(timeout=ClientTimeout(total=5.0)) as session:   #kept (with it's connections) across reconnects
+                XRegistryCloud.__init__(self, session)
+                while True:
+                    self.region = self._auth_region()
+                    connected = await self._connect_cloud(arg, timer)
+                    if timer and getattr(arg, 'startup_report', False):
+                        print(timer.report())
+                    timer = None    #only time the first connection
+                    if connected:
+                        await self._loop_while_online()
+                        await self._stop_cloud()    #the session stays open, so the WS task would otherwise keep reconnecting by itself
+                        if self._saved_auth and self._saved_auth.get('at'):
+                            await asyncio.sleep(self.reconnect_delay)  #the token is still good, so reconnect straight away
+                            continue
+                    await asyncio.sleep(60)
         
         except Exception as e:
             self.log.exception(e)
         return
         
+    async def _connect_cloud(self, arg, timer=None):
+        '''
+        log in, then connect the WS at the same time as fetching the device list and creating the clients
+        (WS device messages received while the device list is loading are newer than it, so they are held back, and
+        processed after the device list, or they would be overwritten by the older params in it)
+        stages are timed by timer (if given)
+        returns True if connected
+        '''
+        timer = timer or StageTimer(log=self.log)
+        with timer.stage('login'):
+            logged_in = await self._login(self._username, self._passw, arg.appid, arg.oauth)
+        if not logged_in:
+            self.log.warning('auth: %s', LazyJson(self.auth))
+            self.log.error('Failed to login, retry in 60 seconds')
+            return False
+        self.log.debug('Connected: auth: %s', LazyJson(self.auth))
+        
+        async def connect_ws():
+            with timer.stage('ws connect'):
+                self.log.info('Starting WS receive - waiting for messages')
+                self.start()
+                return await self._wait_for_WS(5)
+                
+        async def load_devices():
+            with timer.stage('get homes'):
+                homes = await self.get_homes()
+            self.log.debug('Homes: %s', LazyJson(homes))
+            if not homes:
+                return False
+            with timer.stage('get devices'):
+                self._devices = await self.get_devices(homes)
+            self.log.debug('Devices: %s', LazyJson(self._devices))
+            with timer.stage('create clients'):
+                self._add_custom_devices(arg.poll_interval if arg.poll_interval else 60)
+                self._create_client_devices()   #keeps the clients of devices we already have (eg from the snapshot or the last connection)
+            with timer.stage('initial update'):
+                for device in self._devices:
+                    client = self._get_client(device['deviceid'])
+                    client._handle_notification(device)
+                backlog, self._ws_backlog = self._ws_backlog, None
+                for data in backlog:
+                    await self._process_ws_msg(data)
+            with timer.stage('save snapshot'):
+                self._save_snapshot()
+            return True
+            
+        self._ws_backlog = []
+        try:
+            ws_connected, devices_loaded = await asyncio.gather(connect_ws(), load_devices())
+        finally:
+            self._ws_backlog = None
+        if not devices_loaded:
+            self.log.error('No homes found, retry in 60 seconds')
+        elif not ws_connected:
+            self.log.error('Unable to connect to WS, retry in 60 seconds')
+        if not (ws_connected and devices_loaded):
+            await self._stop_cloud()
+            return False
+        return True
+        
+    async def _stop_cloud(self):
+        '''
+        stop the WS task (XRegistryCloud.run_forever()) and close the WS, before connecting again
+        commands still in flight will not be acknowledged on the next connection, so they are dropped from the tracker
+        '''
+        await self.stop()
+        await self._close_ws()
+        self._tracker.drop()
+        
+    def _warm_start(self, poll_interval):
+        '''
+        create the clients from the snapshot (if there is one) and publish their last known state, so that commands
+        can be accepted (they are sent once the cloud is connected) before we have logged in and fetched the device list
+        returns True if the snapshot was used
+        '''
+        snapshot = self._snapshot.load()
+        if not snapshot:
+            return False
+        self._saved_auth = snapshot.get('auth')
+        if not snapshot.get('devices'):
+            return False
+        self._devices = snapshot['devices']
+        self._add_custom_devices(poll_interval)
+        self._create_client_devices()
+        for device in self._devices:
+            client = self._get_client(device['deviceid'])
+            if client:
+                client._handle_notification(device)
+        self.log.info('Published last known state of %s devices from snapshot (saved %s), %sms after start', len(self._clients),
+                      time.ctime(snapshot.get('saved', 0)), round((time.monotonic() - self._started) * 1000, 1))
+        return True
+        
+    def _save_snapshot(self):
+        '''
+        save the device list (except custom devices), with the current params, and the auth token to the snapshot file
+        '''
+        devices = [device for device in self._devices if not self._registry.is_custom(device['deviceid'])]
+        if devices:
+            self._snapshot.save(devices, self._saved_auth)
+        
+    async def _save_snapshot_loop(self, interval):
+        '''
+        save the snapshot every interval seconds (if we are connected to the cloud, otherwise there is nothing new to save)
+        '''
+        try:
+            while not self._exit:
+                await asyncio.sleep(interval)
+                if self.online:
+                    self._save_snapshot()
+        except asyncio.CancelledError:
+            pass
+            
+    def set_online(self, value):
+        '''
+        Override XRegistryCloud set_online(), to signal commands waiting for the cloud connection
+        '''
+        XRegistryCloud.set_online(self, value)
+        if value:
+            self._cloud_offline.clear()
+            self._cloud_online.set()
+        else:
+            self._cloud_online.clear()
+            self._cloud_offline.set()
+            
     def _add_custom_devices(self, poll_interval):
         '''
         Adds custom devices (eg patio Door device) if missing.
         Some appId/secret combinations only list Sonoff devices, but you can still access other devices
         '''
         for custom_device in self._custom_devices.copy():
-            if custom_device['deviceid'] not in [device['deviceid'] for device in self._devices]:
+            if custom_device['deviceid'] not in self._registry:
                 self.log.info('Adding {} to _devices'.format(custom_device.get('name', 'unknown')))
-                self._devices.append(XDevice(custom_device))
+                self._registry.add(XDevice(custom_device), custom=True)
                 self.log.info('Adding {} to polling task'.format(custom_device.get('name', 'unknown')))
                 self.set_initial_parameters(custom_device['deviceid'], poll=True)
                 self._start_polling(poll_interval)
@@ -347,34 +527,200 @@ class EwelinkClient(MQTT, XRegistryCloud):
             self.log.warning('Unable to poll devices')
             
     async def _wait_for_WS(self, timeout):
-        count = 0
-        while count <= timeout:
-            if self.online:
-                return True
-            await asyncio.sleep(1)
-            count += 1
-        return False
+        '''
+        wait up to timeout seconds for the WS to connect (signalled by set_online())
+        '''
+        try:
+            await asyncio.wait_for(self._cloud_online.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return bool(self.online)
         
     async def _loop_while_online(self):
-        count = 55
+        '''
+        wait until the cloud connection goes offline (signalled by set_online()), checking every token_check seconds if the auth token
+        is due to be refreshed
+        '''
         while self.online:
-            count += 1
-            if count >= 60:
+            try:
+                await asyncio.wait_for(self._cloud_offline.wait(), self.token_check)
+            except asyncio.TimeoutError:
                 self.log.debug('Waiting...')
-                count = 0
-            await asyncio.sleep(1)
+                if self._saved_auth and time.time() - self._saved_auth.get('ts', time.time()) > self.token_refresh:
+                    await self._refresh_token()
         
     async def _login(self, username: str, password: str, app=0, oauth=False) -> bool:
         if oauth:
             APP.extend(OAUTH)
-        self.log.debug('Available App ID, secrets: {}'.format(self.pprint(APP)))
+        self.log.debug('Available App ID, secrets: %s', LazyJson(APP))
         if arg.appid > len(APP)-1:
             self.log.warning('Selected appId({}) index out of range (max{}), using 0'.format(arg.appid, len(APP)-1))
             arg.appid = 0
+        self._app = app
+        if await self._login_saved_token(username, app):
+            return True
+        self.region = self._auth_region(username, app)     #the region the account was found in last time, saves a redirect
         self.log.info('Connecting, login: {}, password: {}, appid({}): {}'.format(username, password, 'Oauth2' if oauth else 'v2', APP[app]))
         if arg.oauth:
-            return await self.oauth_login(username, password, app)
-        return await self.login(username, password, app)
+            result = await self.oauth_login(username, password, app)
+        else:
+            result = await self.login(username, password, app)
+        if result and self.auth.get('at'):
+            self._saved_auth = {'login': username, 'region': self.region, 'at': self.auth['at'], 'rt': self.auth.get('rt'),
+                                'ts': time.time(), 'app': app}
+        return result
+        
+    def _auth_region(self, username=None, app=None):
+        '''
+        region of the saved auth (the region the account was found in), if it's for username and app (if given), or the region
+        '''
+        auth = self._saved_auth or {}
+        if auth.get('region') and (username is None or (auth.get('login') == username and auth.get('app') == app)):
+            return auth['region']
+        return self._region
+        
+    def _forget_token(self):
+        '''
+        the saved auth token has been rejected, keep the region and WS server (they are the same for the next token)
+        '''
+        if self._saved_auth:
+            for key in ['at', 'rt', 'ts']:
+                self._saved_auth.pop(key, None)
+        
+    async def _login_saved_token(self, username, app):
+        '''
+        log in with the saved auth token (from the snapshot or the last login) if it's for this login and app,
+        refreshing it first if it's older than token_refresh seconds. If we are already logged in with it (ie reconnecting),
+        it's just reused, it is checked when the WS connects (see connect()).
+        returns False if there isn't one, or it's not accepted (in which case it's forgotten)
+        '''
+        auth = self._saved_auth
+        if not auth or auth.get('login') != username or auth.get('app') != app or not auth.get('at'):
+            return False
+        try:
+            self.region = auth['region']
+            if time.time() - auth.get('ts', time.time()) > self.token_refresh and await self._refresh_token():
+                return True
+            if self.auth and self.auth.get('at') == auth['at'] and self.auth.get('user'):
+                self.log.info('Reusing auth token, region: %s', self.region)
+                return True
+            if await self.login_token(auth['at'], app):
+                self.log.info('Logged in with saved token, region: %s', self.region)
+                return True
+        except Exception as e:
+            self.log.info('Saved token not accepted (%s), logging in', e)
+        self._forget_token()
+        return False
+        
+    async def _refresh_token(self):
+        '''
+        get a new auth token (and refresh token) with the refresh token, before the auth token expires
+        returns True if the token was refreshed
+        '''
+        auth = self._saved_auth
+        if not auth or not auth.get('rt') or not auth.get('at'):
+            return False
+        appid = APP[auth['app']][0]
+        try:
+            r = await self.session.post(self.host + "/v2/user/refresh", json={'rt': auth['rt']},
+                                        headers={'Authorization': 'Bearer ' + auth['at'], 'X-CK-Appid': appid}, timeout=30)
+            resp = await r.json()
+            if resp.get('error', 0) != 0:
+                raise AuthError(resp.get('msg', resp))
+            data = resp['data']
+        except (ClientError, asyncio.TimeoutError, ValueError, KeyError, AuthError) as e:
+            self.log.warning('Unable to refresh auth token: %s', e)
+            return False
+        auth.update({'at': data['at'], 'rt': data.get('rt', auth['rt']), 'ts': time.time()})
+        if self.auth and self.auth.get('user'):
+            self.auth['at'] = auth['at']
+        elif not await self.login_token(auth['at'], auth['app']):
+            return False
+        self.log.info('Refreshed auth token, region: %s', self.region)
+        self._save_snapshot()
+        return True
+        
+    async def connect(self) -> bool:
+        '''
+        Override XRegistryCloud connect(), to reuse the WS server given by the dispatch server last time (saved with the auth token),
+        it's only asked again if the WS server can't be connected to (and the saved one is then forgotten).
+        Like XRegistryCloud connect() this only sets self.ws, which is all run_forever() and send() use (auth and region are
+        set when logging in). If the auth token is rejected, it's forgotten, so we log in again on the next reconnect.
+        returns True if connected
+        '''
+        auth = self._saved_auth or {}
+        url = auth.get('ws') if auth.get('region') == self.region else None
+        for cached in ([True, False] if url else [False]):
+            try:
+                if not cached:
+                    url = await self._get_ws_server()
+                self.ws = await self.session.ws_connect(url, heartbeat=90)
+                await self._ws_handshake()
+                if self._saved_auth:
+                    self._saved_auth['ws'] = url
+                self.log.debug('Cloud WS connected to %s%s', url, ' (saved)' if cached else '')
+                return True
+            except AuthError as e:
+                self.log.warning('Cloud WS auth token rejected: %s', e)
+                self._forget_token()
+                await self._close_ws()
+                return False
+            except (ClientError, asyncio.TimeoutError, WSConnectError) as e:
+                await self._close_ws()
+                if cached:
+                    self.log.info('Saved cloud WS server %s failed: %s, asking the dispatch server', url, e)
+                    auth.pop('ws', None)
+                else:
+                    self.log.warning('Cloud WS connection to %s failed: %s', url, e)
+            except Exception as e:
+                self.log.exception('Cloud WS exception: %s', e)
+                await self._close_ws()
+                return False
+        return False
+        
+    async def _close_ws(self):
+        if self.ws is not None and not self.ws.closed:
+            await self.ws.close()
+        
+    async def _get_ws_server(self):
+        '''
+        returns the url of the WS server for our region from the dispatch server
+        '''
+        r = await self.session.get(self.ws_host, headers=self.headers)
+        resp = await r.json()
+        if not resp.get('domain') or not resp.get('port'):
+            raise WSConnectError('dispatch server response: {}'.format(resp))
+        return 'wss://{}:{}/api/ws'.format(resp['domain'], resp['port'])
+        
+    async def _ws_handshake(self):
+        '''
+        https://coolkit-technologies.github.io/eWeLink-API/#/en/APICenterV2?id=websocket-handshake
+        raises AuthError if the token is rejected, WSConnectError for any other error
+        '''
+        ts = time.time()
+        payload = {
+            "action": "userOnline",
+            "at": self.auth["at"],
+            "apikey": self.auth["user"]["apikey"],
+            "appid": self.auth["appid"],
+            "nonce": str(int(ts / 100)),
+            "ts": int(ts),
+            "userAgent": "app",
+            "sequence": str(int(ts * 1000)),
+            "version": 8,
+        }
+        await self.ws.send_json(payload)
+        msg = await self.ws.receive(timeout=10)
+        if msg.type != WSMsgType.TEXT:
+            raise WSConnectError('WS closed during handshake: {}'.format(msg.type))
+        try:
+            resp = json.loads(msg.data)
+        except ValueError:
+            raise WSConnectError('WS handshake response is not json: {}'.format(msg.data))
+        if resp.get('error') in [401, 406]:     #token expired or not valid
+            raise AuthError(resp)
+        if resp.get('error') != 0:
+            raise WSConnectError('WS handshake error: {}'.format(resp))
         
     async def oauth_login(self, username: str, password: str, app=0) -> bool:
         self._publish('client', 'status', "Starting")
@@ -422,7 +768,7 @@ class EwelinkClient(MQTT, XRegistryCloud):
                 timeout=30
             )
             resp = await r.json()
-        _LOGGER.debug('Oauth2 response: {}'.format(json.dumps(resp, indent=2)))
+        _LOGGER.debug('Oauth2 response: %s', LazyJson(resp))
         if resp.get("error",0) != 0:
             raise AuthError(resp.get("msg", resp))
 
@@ -435,26 +781,35 @@ class EwelinkClient(MQTT, XRegistryCloud):
         return await XRegistryCloud.login(self, username, password, app)
                 
     async def _process_ws_msg(self, data: dict):
-        self.log.debug(f"RECEIVED cloud msg: {self.pprint(data)}")
+        if self._ws_backlog is not None and data.get('action') and data.get('deviceid'):
+            self._ws_backlog.append(data)   #the device list is loading, see _connect_cloud()
+            return
+        await self._wait_for_publish_space()    #if the MQTT publish queue is full, stop reading the WS until there is space
+        envelope = Envelope(data)               #data is serialized (at most) once, for logging and all json publishes
+        self.log.debug("RECEIVED cloud msg: %s", envelope)
+        if 'action' not in data and 'sequence' in data:     #response to a command
+            self._tracker.ack(data['sequence'], self._tracker.outcome(data.get('error')))
         await XRegistryCloud._process_ws_msg(self, data)
         
         #self.log.debug("Received data: %s" % self.pprint(data))
         deviceid = data.get('deviceid', None)
         if deviceid:
-            self._publish(deviceid, 'json', json.dumps(data))
+            self._publish(deviceid, 'json', envelope)
+            if data.get('action') == 'update':  #sent by the device itself, so it doesn't need polling for a while
+                self._poller.seen(deviceid)
 
             if data.get('error', None) is not None:
                 if data['error'] == 0:
                     self.log.debug('command completed successfully')
                     self._publish(deviceid, 'status', "OK")
                 else:
-                    self.log.warning('error: %s' % self.pprint(data))
+                    self.log.warning('error: %s', LazyJson(data))
                     self._publish(deviceid, 'status', "Error: " + data.get('reason','unknown'))
                     return
 
             client = self._get_client(deviceid)
             if client:
-                client._handle_notification(data)
+                client._handle_notification(envelope)
     
     def _validate_iso8601(self,str_val):
         try:            
@@ -470,93 +825,455 @@ class EwelinkClient(MQTT, XRegistryCloud):
             pass
         return False
         
+    def _build_router(self):
+        '''
+        compile the command topics into a new router (and the device groups), and swap it in
+        <topic>/client/<command> goes to the bridge, <topic>/<device>/<command> to the device client, where device
+        can be the deviceid, name (case insensitive) or index number 0-99, as for get_deviceid(),
+        and <topic>/group/<name>/<command> to the DeviceGroup
+        '''
+        self._groups = build_groups(self._group_config, self._registry, self._clients, self.log)
+        router = TopicRouter(cache_size=max(1024, 2 * len(self._clients)))    #room for a couple of command topics per device
+        prefix = self._topic.replace('//', '/').rstrip('/').split('/')
+        for num, device in enumerate(self._devices):    #the first route added for a topic is kept, so the first device that matches wins, as for get_deviceid()
+            client = self._clients.get(device['deviceid'])
+            if client:
+                router.add(prefix + [device['deviceid'], '+'], client)
+                if device.get('name') is not None:
+                    router.add(prefix + [device['name'], '+'], client, fold_case=True)
+                if num < 100:
+                    router.add(prefix + [str(num), '+'], client)
+        router.add(prefix + ['client', '+'], None)  #bridge commands, unless there is a device called client
+        for name, group in self._groups.items():
+            router.add(prefix + ['group', name, '+'], group, fold_case=True)
+        self._router = router
+        self.log.debug('topic router built: %s routes, groups: %s', len(router), LazyJson({name: len(group) for name, group in self._groups.items()}))
+        
     def _get_command(self, msg):
         '''
         extract command and args from MQTT msg
         '''
-        self.log.debug("CLIENT: message received topic: %s" % msg.topic)
-        #log.info("message topic: %s, value:%s received" % (msg.topic,msg.payload.decode("utf-8")))
-        command = msg.topic.split('/')[-1]
-        deviceid = self.get_deviceid(msg.topic.split('/')[-2])
+        self.log.debug("CLIENT: message received topic: %s", msg.topic)
+        route = self._router.route(msg.topic)
+        if route is None:
+            self.log.debug("CLIENT: no device or command for topic: %s, ignored", msg.topic)
+            return None, None
+        client, levels = route
+        command = levels[-1]
         message = msg.payload.decode("utf-8").strip()
-        self.log.info("CLIENT: Received Command: %s, device: %s, Setting: %s" % (command, deviceid, message))
-        func = None
+        self.log.info("CLIENT: Received Command: %s, device: %s, Setting: %s", command, getattr(client, 'deviceid', client), message)
         
-        if deviceid:
-            if 'reconnect' in command:
-                if message == 'ON':
-                    func = self.disconnect()
-            else:
-                client = self._get_client(deviceid)
-                func = client.q.put((command, message))
-                
-            #have to use this as mqtt client is running in another thread...
-            if func:
-                asyncio.run_coroutine_threadsafe(func,self.loop)
+        if client is None:
+            self._bridge_command(command, message)
+        elif isinstance(client, DeviceGroup):
+            self._workers.put('group/'+client.name, self._group_command, client, command, message)
+        elif 'reconnect' in command:
+            if message == 'ON':
+                self.disconnect()
+        else:
+            self._workers.put(client.deviceid, client._process_command, command, message)  #we are called from _process_q, so already on the event loop
             
         return None, None
         
+    async def _group_command(self, group, command, message):
+        '''
+        send command to every device in group at once (each device's commands are still handled in order,
+        and sent at the device's command rate), then publish the results of all of them in one message
+        to /ewelink_status/group/<name>/result
+        '''
+        start = time.monotonic()
+        outcomes = await self._fan_out([(client, command, message) for client in group.clients])
+        results = {client.deviceid: status for client, (status, latency) in zip(group.clients, outcomes)}
+        ok = sum(1 for status in results.values() if status in ['online', 'sent'])
+        self.log.info('Group: %s, command: %s, %s of %s devices ok', group.name, command, ok, len(results))
+        self._publish('group/'+group.name, 'result', json.dumps({'group'      : group.name,
+                                                                 'command'    : command,
+                                                                 'message'    : message,
+                                                                 'devices'    : len(results),
+                                                                 'ok'         : ok,
+                                                                 'failed'     : len(results) - ok,
+                                                                 'duration_ms': round((time.monotonic() - start) * 1000, 1),
+                                                                 'results'    : results}))
+        
+    async def _fan_out(self, commands):
+        '''
+        hand each (client, command, message) in commands to the worker pool at once, so different devices are handled in
+        parallel, and each device's commands in order (and at the device's command rate)
+        returns list of (outcome, latency ms) for each command, see _command_result() for the outcomes
+        '''
+        start = time.monotonic()
+        async def timed(future):
+            outcome = await future
+            return outcome, round((time.monotonic() - start) * 1000, 1)
+            
+        futures = []
+        for client, command, message in commands:
+            futures.append(self.loop.create_future())
+            self._workers.put(client.deviceid, self._command_result, futures[-1], client._process_command, command, message)
+        return await asyncio.gather(*[timed(future) for future in futures])
+        
+    async def batch_command(self, commands):
+        '''
+        send a batch of commands eg for a scene, commands is a list (or json string) of {"device": <deviceid, name or index>,
+        "command": <command>, "value": <message>} or a dictionary of {"id": <anything>, "commands": <list>}, where the id is
+        returned in the result.
+        All the commands are checked first, if any are invalid nothing is sent. Commands for different devices are sent in
+        parallel, and commands for the same device in the order given.
+        returns the result, which is also published to /ewelink_status/client/batch, a dictionary of
+        {"id", "entries", "ok", "failed", "duration_ms", "results": list of {"device", "command", "value", "status", "latency_ms"}}
+        or {"id", "entries", "errors": list of errors} if the batch is invalid
+        '''
+        start = time.monotonic()
+        batch_id = None
+        entries = 0
+        try:
+            if isinstance(commands, str):
+                commands = json.loads(commands)
+            if isinstance(commands, dict):
+                batch_id = commands.get('id')
+                commands = commands.get('commands')
+            if not isinstance(commands, list):
+                raise ValueError('a batch must be a list of commands')
+        except ValueError as e:     #includes JSONDecodeError
+            commands = []
+            errors = ['invalid batch: {}'.format(e)]
+        else:
+            entries = len(commands)
+            commands, errors = self._validate_batch(commands)
+        if errors:
+            result = {'id': batch_id, 'entries': entries, 'errors': errors}
+            self.log.error('Batch %s rejected: %s', batch_id, errors)
+        else:
+            outcomes = await self._fan_out(commands)
+            results = [{'device'    : client.deviceid,
+                        'command'   : command,
+                        'value'     : message,
+                        'status'    : status,
+                        'latency_ms': latency} for (client, command, message), (status, latency) in zip(commands, outcomes)]
+            ok = sum(1 for entry in results if entry['status'] in ['online', 'sent'])
+            result = {'id'         : batch_id,
+                      'entries'    : len(results),
+                      'ok'         : ok,
+                      'failed'     : len(results) - ok,
+                      'duration_ms': round((time.monotonic() - start) * 1000, 1),
+                      'results'    : results}
+            self.log.info('Batch %s: %s of %s commands ok', batch_id, ok, len(results))
+        self._publish('client', 'batch', json.dumps(result))
+        return result
+        
+    def _validate_batch(self, entries):
+        '''
+        returns list of (client, command, message) for entries, and a list of errors (empty if all are valid)
+        '''
+        commands = []
+        errors = []
+        for num, entry in enumerate(entries):
+            if not isinstance(entry, dict):
+                errors.append('entry {}: not a dictionary'.format(num))
+                continue
+            client = self._get_client(str(entry.get('device')))
+            command = entry.get('command')
+            value = entry.get('value', '')
+            if client is None:
+                errors.append('entry {}: device {} not found'.format(num, entry.get('device')))
+            elif not isinstance(command, str) or 'reconnect' in command or not client.has_command(command):
+                errors.append('entry {}: invalid command {} for device {}'.format(num, command, client.deviceid))
+            else:
+                commands.append((client, command, value if isinstance(value, str) else json.dumps(value)))
+        return commands, errors
+        
+    def send_batch(self, commands):
+        '''
+        thread safe batch_command(), returns a concurrent.futures.Future of the result
+        '''
+        return asyncio.run_coroutine_threadsafe(self.batch_command(commands), self.loop)
+        
+    def _command_result(self, future, func, *args):
+        '''
+        called by the worker pool in place of func(*args), sets future to the outcome of the command:
+        the send result ("online", "timeout", "E#<error>"), "sent" if there was no response to wait for,
+        "not_supported" if func didn't send anything, or "error" if it raised an exception
+        returns the coroutine (if any) for the worker pool to run
+        '''
+        try:
+            coro = func(*args)
+        except Exception:
+            future.set_result('error')
+            raise
+        if not asyncio.iscoroutine(coro):
+            future.set_result('not_supported')
+            return coro
+        async def run():
+            try:
+                result = await coro
+                future.set_result(result or 'sent')
+            except Exception:
+                future.set_result('error')
+                raise
+            finally:
+                if not future.done():   #cancelled
+                    future.cancel()
+        return run()
+        
     async def _publish_command(self, command, args=None):
         pass
         
+    def _bridge_command(self, command, message):
+        '''
+        commands for the bridge itself, sent to /ewelink_command/client/<command>
+        log_level <level> or <logger> <level> eg "DEBUG" or "Main.MQTT INFO"
+        stats publishes bridge counters to /ewelink_status/client/stats
+        latency publishes command latency histograms for each device to /ewelink_status/client/latency
+        batch <json list of {"device", "command", "value"}> sends all the commands, and publishes the results to
+        /ewelink_status/client/batch (see batch_command())
+        '''
+        if command == 'log_level':
+            try:
+                name, level = set_log_level(message)
+                self._debug = self._log.getEffectiveLevel() <= logging.DEBUG
+                self.log.info('Set log level of {} to {}'.format(name, level))
+                self._publish('client', 'log_level', '{} {}'.format(name, level))
+            except ValueError as e:
+                self.log.error(e)
+        elif command == 'stats':
+            self._publish('client', 'stats', json.dumps(self.get_stats()))
+        elif command == 'latency':
+            self._publish('client', 'latency', json.dumps(self._tracker.latency()))
+        elif command == 'batch':
+            self._workers.put('client/batch', self.batch_command, message)
+        else:
+            self.log.warning('Received invalid client command: {}'.format(command))
+            
+    def get_stats(self):
+        '''
+        returns dictionary of bridge counters
+        '''
+        return {'publish_queue': self._publish_stats(),
+                'publish_pipeline': self._pipeline.stats,
+                'publish_cache': self._publish_cache.stats,
+                'commands': self._command_stats(),
+                'requests': dict(self._tracker.stats, in_flight=len(self._tracker)),
+                'workers': dict(self._workers.stats, workers=self._workers.workers, pending=len(self._workers)),
+                'polling': dict(self._poll_stats, scheduled=len(self._poller), **self._poller.stats)
+               }
+               
+    async def _publish_stats_loop(self, interval):
+        '''
+        publish stats and latency every interval seconds
+        '''
+        try:
+            while not self._exit:
+                await asyncio.sleep(interval)
+                self._bridge_command('stats', None)
+                self._bridge_command('latency', None)
+        except asyncio.CancelledError:
+            pass
+               
+    def _command_stats(self):
+        stats = {'sent': 0, 'superseded': 0, 'merged': 0, 'pending': 0, 'max_depth': 0}
+        for scheduler in self._schedulers.values():
+            stats['sent'] += scheduler.stats['sent']
+            stats['superseded'] += scheduler.stats['superseded']
+            stats['merged'] += scheduler.stats['merged']
+            stats['pending'] += len(scheduler)
+            stats['max_depth'] = max(stats['max_depth'], scheduler.stats['max_depth'])
+        return stats
+        
     def _publish(self, deviceid, topic, message):
         '''
-        mqtt _publish
+        mqtt _publish, unchanged values are not published (unless refresh seconds have passed), then via
+        the publish pipeline (which coalesces publishes per device if publish_window is set)
         '''
         #self._log.info('MQTT PUBLISH, deviceid: {}, topic: {}, message: {}'.format(deviceid, topic, message))
         if deviceid in topic:
             topic = topic.split('/')[-1]
-        MQTT._publish(self, f'{deviceid}/{topic}', message)
+        if self._publish_cache.has_changed(deviceid, topic, message):
+            self._pipeline.put(deviceid, f'{deviceid}/{topic}', message)
+            
+    def _clear_history(self, deviceid=None):
+        '''
+        republish all values for deviceid (or all devices if None) on the next update
+        '''
+        self._publish_cache.clear(deviceid)
         
     def _create_client_devices(self):
         '''
-        Create client devices
+        Create client devices for the device list
+        Clients of devices that are still in the list (with the same productModel) are kept, with their state,
+        clients of devices that have gone are closed, and removed
         '''
+        clients = {}
+        kept = 0
         for device in self._devices:
             deviceid = device['deviceid']
             model = device['productModel']
             device_name = device.get('name', None)
+            
+            client = self._clients.get(deviceid)
+            if client is not None and client._productModel == model:
+                client._update_device(device)
+                clients[deviceid] = client
+                kept += 1
+                continue
                 
             initial_parameters = self._parameters.get(deviceid, {})
             
-            client_class = [client_class for client_class, productModels in self._device_classes.items() for productModel in productModels if model == productModel]
+            client_class = self._model_classes.get(model)
             if client_class:
-                #assign first matching class
-                self._clients[deviceid] = client_class[0](self, deviceid, device, model, initial_parameters)          
+                clients[deviceid] = client_class(self, deviceid, device, model, initial_parameters)          
             else:
                 self.log.warning('Unsupported device: {}, using Default device'.format(device["productModel"]))
-                self._clients[deviceid] = Default(self, deviceid, device, device["productModel"], initial_parameters)
-            self.log.info('Created instance of Device: {}, model: {} for: {} ({})'.format(self._clients[deviceid].__class__.__name__, model, deviceid, device_name))
+                clients[deviceid] = Default(self, deviceid, device, device["productModel"], initial_parameters)
+            self.log.info('Created instance of Device: {}, model: {} for: {} ({})'.format(clients[deviceid].__class__.__name__, model, deviceid, device_name))
+            
+        removed = [(deviceid, client) for deviceid, client in self._clients.items() if clients.get(deviceid) is not client]
+        for deviceid, client in removed:
+            self._remove_client(deviceid, client)
+        self._clients.clear()
+        self._clients.update(clients)
+        self.log.debug('clients: %s, %s kept, %s new, %s removed', len(clients), kept, len(clients) - kept, len(removed))
                 
         if len(self._clients) == 0:
             self.log.critical('NO SUPPORTED DEVICES FOUND')
+        self._build_router()
+        self._schedule_polls()
         
-    async def poll_devices(self):
+    def _remove_client(self, deviceid, client):
+        '''
+        close the client of a device that has gone (or changed productModel), and drop it's command scheduler, polling,
+        publish history and latency histogram
+        '''
+        self.log.info('Removing instance of Device: %s, model: %s for: %s', client.__class__.__name__, client._productModel, deviceid)
+        client._close()
+        scheduler = self._schedulers.pop(deviceid, None)
+        if scheduler is not None:
+            scheduler.clear()
+        self._poller.remove(deviceid)
+        self._publish_cache.clear(deviceid)
+        self._tracker.forget(deviceid)
+        
+    def _schedule_polls(self):
+        '''
+        add the devices with poll set to the poll scheduler, polled every poll_min to poll_max seconds if they are set
+        for the device (see set_initial_parameters()), or every -poll to -pm seconds
+        '''
         for device in self._devices:
-            if self._parameters.get(device['deviceid'], {}).get('poll'):
-                self.log.info('Polling device: {}'.format(device['deviceid']))
-                await self._getparameter(device['deviceid'])
+            parameters = self._parameters.get(device['deviceid'], {})
+            if parameters.get('poll'):
+                min_interval = parameters.get('poll_min', self._poll or 60)
+                self._poller.add(device['deviceid'], min_interval, parameters.get('poll_max', self._poll_max or min_interval))
+                
+    async def _poll_status(self):
+        '''
+        Override MQTT _poll_status(), to poll each device when it is due (see PollScheduler), rather than all of them every
+        poll seconds. A device that sends updates by itself is not polled.
+        '''
+        try:
+            while not self._exit:
+                await self._poller.wait()
+                deviceids = self._poller.due()
+                if deviceids:
+                    await self._poll_batch(deviceids)
+        except asyncio.CancelledError:
+            pass
+        self.log.info('Poll loop exited')
+        
+    async def poll_devices(self):
+        '''
+        poll all the devices with poll set now
+        '''
+        await self._poll_batch([device['deviceid'] for device in self._devices if self._parameters.get(device['deviceid'], {}).get('poll')])
         return {}   #return dict is expected
         
+    async def _poll_batch(self, deviceids):
+        '''
+        get the parameters of deviceids, up to poll_concurrency devices at a time, each after a random delay of up to
+        poll_jitter seconds (so they don't all hit the cloud at once).
+        Each poll goes through the device's command scheduler, so it is sent at the device's command rate, and waits for the reply
+        (up to command_timeout), so the poll scheduler is told whether the reply changed the device's state.
+        '''
+        start = time.monotonic()
+        semaphore = asyncio.Semaphore(self._poll_concurrency)
+        
+        async def poll(deviceid):
+            client = self._clients.get(deviceid)
+            version = client.state.version if client else None
+            try:
+                if self._poll_jitter:
+                    await asyncio.sleep(random.uniform(0, self._poll_jitter))
+                async with semaphore:
+                    self.log.info('Polling device: %s', deviceid)
+                    return await self._getparameter(deviceid, waitResponse=True)
+            finally:
+                self._poller.polled(deviceid, client is not None and client.state.version != version)
+                
+        results = await asyncio.gather(*[poll(deviceid) for deviceid in deviceids], return_exceptions=True)
+        duration = round((time.monotonic() - start) * 1000, 1)
+        failed = sum(1 for result in results if isinstance(result, Exception) or self._tracker.failed(result))
+        self._poll_stats['cycles'] += 1
+        self._poll_stats['devices'] = len(deviceids)
+        self._poll_stats['failed'] = failed
+        self._poll_stats['last_ms'] = duration
+        self._poll_stats['max_ms'] = max(self._poll_stats['max_ms'], duration)
+        self.log.info('Polled %s devices in %sms (%s failed)', len(deviceids), duration, failed)
+        
     async def _send_request(self, command, waitResponse=False):
-        """Send a payload request to websocket"""
-        self.log.debug("Sending command: {}".format(command))
-        timeout = 0 if not waitResponse else 5
-        result = await self.send(command.get('device'), command.get('params'), timeout=timeout)
+        """
+        Queue a payload request for the device's command scheduler, which sends it to the websocket
+        at no more than command_rate commands per second (per device)
+        returns the send result
+        """
+        deviceid = command['device']['deviceid']
+        scheduler = self._schedulers.get(deviceid)
+        if scheduler is None:
+            scheduler = self._schedulers[deviceid] = CommandScheduler(self._send_request_now, self._command_rate, self._command_burst,
+                                                                          self._merge_window, self.loop)
+        return await scheduler.put(command, waitResponse)
+        
+    async def _send_request_now(self, command, waitResponse=False):
+        """
+        Send a payload request to websocket, tracked by sequence id
+        if the device doesn't respond, it is sent again up to retries times, unless it contains non idempotent params
+        """
+        self.log.debug("Sending command: %s", command)
+        if not self.online:     #wait for the cloud connection (eg commands received while starting up)
+            await self._cloud_online.wait()
+        device = command.get('device', {})
+        params = command.get('params')
+        retries = self._retries if self._is_idempotent(device.get('deviceid'), params) else 0
+        timeout = self._command_timeout if waitResponse or retries else 0
+        for attempt in range(retries + 1):
+            sequence = self.sequence()
+            self._tracker.sent(sequence, device.get('deviceid'), params, attempt)
+            result = await self.send(device, params, sequence=sequence, timeout=timeout)
+            if timeout:
+                self._tracker.done(sequence, result)
+            if result != 'timeout':
+                break
+            if attempt < retries:
+                self.log.info('Device: {}({}) timeout, retrying'.format(device.get('deviceid'), device.get('name')))
         if result:
-            self.log.debug('Send response is: {}'.format(result))
+            self.log.debug('Send response is: %s', result)
             if result == 'timeout':
-                device = command.get('device', {})
                 self.log.warning('Device: {}({}) is not updating'.format(device.get('deviceid'), device.get('name')))
         return result
         
+    def _is_idempotent(self, deviceid, params):
+        '''
+        True if sending params to deviceid more than once has the same effect as sending it once
+        '''
+        client = self._clients.get(deviceid)
+        if not params or client is None:
+            return True
+        return not any(param in client.non_idempotent for param in params)
+        
     async def _sendjson(self, deviceid, message):
         """Send a json payload direct to device"""
         try:
             params = json.loads(message.replace("'",'"'))
             payload = {'params':params, 'device':self.get_config(deviceid)}
             #self.log.debug('sending JSON: {}'.format(self.pprint(payload)))
-            await self._send_request(payload)
+            return await self._send_request(payload)
 
         except json.JSONDecodeError as e:
             self.log.error('json encoding error inmessage: %s: %s' % (message,e))
@@ -564,9 +1281,9 @@ class EwelinkClient(MQTT, XRegistryCloud):
     async def _getparameter(self, device_id='', params=[], waitResponse=False):
         deviceid = self.get_deviceid(str(device_id))
         if deviceid:
-            self.log.debug('Getting params: for device [{}]'.format(self.get_devicename(deviceid)))
+            self.log.debug('Getting params: for device [%s]', self.get_devicename(deviceid))
             payload = {'device':self.get_config(deviceid)}
-            await self._send_request(payload, waitResponse)
+            return await self._send_request(payload, waitResponse)
         else:
             self.log.error(f'device {device_id} not found')
         
@@ -578,26 +1295,19 @@ class EwelinkClient(MQTT, XRegistryCloud):
         if deviceid:
             params = {param:targetState}
                 
-            self.log.debug('Setting param: {} to [{}] for device [{}]'.format(param, targetState, self.get_devicename(deviceid)))
-            waitResponse = True if deviceid in [device['deviceid'] for device in self._custom_devices] else waitResponse
+            self.log.debug('Setting param: %s to [%s] for device [%s]', param, targetState, self.get_devicename(deviceid))
+            waitResponse = True if self._registry.is_custom(deviceid) else waitResponse
 
             payload = {'params':params, 'device':self.get_config(deviceid)}
-            await self._send_request(payload, waitResponse)
+            return await self._send_request(payload, waitResponse)
         else:
             self.log.error(f'device {device_id} not found')
         
     def get_deviceid(self, sel_device=0):
-        deviceid = None
-        num_device = -1
-        sel_device = str(sel_device)
-        if len(sel_device) <= 2 and sel_device.isdigit():    #assume an index number in the range 0-99
-            num_device = int(sel_device)
-        for num, device in enumerate(self._devices):
-            if device['deviceid'] == sel_device or device['name'] == sel_device or num == num_device:
-                deviceid = device['deviceid']
-                break
-        
-        return deviceid
+        '''
+        returns deviceid for sel_device (deviceid, name or index number) or None
+        '''
+        return self._registry.get_deviceid(sel_device)
         
     def update(self, d, u):
         '''
@@ -614,8 +1324,10 @@ class EwelinkClient(MQTT, XRegistryCloud):
         return self._get_client(deviceid).name
         
     def _get_client(self, deviceid):
-        deviceid = self.get_deviceid(deviceid)
-        return self._clients.get(deviceid, None)
+        client = self._clients.get(deviceid)    #fast path, deviceid already resolved
+        if client is None:
+            client = self._clients.get(self.get_deviceid(deviceid), None)
+        return client
         
     def send_command(self, deviceid, command, message):
         '''
@@ -624,22 +1336,28 @@ class EwelinkClient(MQTT, XRegistryCloud):
         self._get_client(deviceid).send_command(command, message)
         
     async def _disconnect(self, send_close=None):
-        """Disconnect from Websocket and delete clients"""
+        """Disconnect from Websocket, the clients are kept for when we reconnect"""
         self.log.debug('Disconnecting')
-        for deviceid, client in self._clients.items():
-            if client is not None:
-                #self.log.debug('waiting for client %s to exit: %s' % (client,client.deviceid))
-                await client.q.put((None,None))
-                await client.q.join()
-                self._clients.pop(deviceid, None)
+        await self._workers.join()  #wait for received commands to be handled
         self._publish('client', 'status', "Disconnected")
-        await self.stop()
-        await self.ws.close()
+        self._pipeline.flush()
+        for scheduler in self._schedulers.values():
+            scheduler.clear()
+        await self._stop_cloud()
         self.log.info('Disconnected')
             
     def disconnect(self):
         asyncio.run_coroutine_threadsafe(self._disconnect(),self.loop)
         
+    async def _stop(self):
+        self._save_snapshot()
+        await self._workers.stop()
+        for scheduler in self._schedulers.values():
+            scheduler.clear()
+        for client in self._clients.values():
+            client._close()     #eg Autoslide waiting to restore it's delay
+        await MQTT._stop(self)
+        
 def parse_args():
     
     #-------- Command Line -----------------
@@ -726,6 +1444,47 @@ def parse_args():
         type=str,
         default=None,
         help='Poll deviceID (default: %(default)s)')
+    parser.add_argument(
+        '-pc', '--poll_concurrency',
+        action='store',
+        type=int,
+        default=10,
+        help='Max devices polled at the same time (default: %(default)s)')
+    parser.add_argument(
+        '-pj', '--poll_jitter',
+        action='store',
+        type=float,
+        default=1.0,
+        help='Max random delay (seconds) before each device is polled (default: %(default)s)')
+    parser.add_argument(
+        '-pm', '--poll_max',
+        action='store',
+        type=int,
+        default=0,
+        help='Max polling interval (seconds), devices whose polls find nothing new are polled less often, up to this (0=same as poll interval) (default: %(default)s)')
+    parser.add_argument(
+        '-s', '--snapshot',
+        action='store',
+        type=str,
+        default=None,
+        help='Snapshot file of devices, their last known state and the auth token, used to start up without waiting for the cloud (off if not given). '
+             'It contains your credentials (the auth token), so keep it somewhere private, eg ~/.ewelink_snapshot.json (default: %(default)s)')
+    parser.add_argument(
+        '-si', '--snapshot_interval',
+        action='store',
+        type=int,
+        default=300,
+        help='Save the snapshot every SNAPSHOT_INTERVAL seconds (0=only on exit) (default: %(default)s)')
+    parser.add_argument(
+        '--startup-report',
+        action='store_true',
+        default = False,
+        help='print how long each stage of startup took (default: %(default)s)')
+    parser.add_argument(
+        '--import-report',
+        action='store_true',
+        default = False,
+        help='print how long each module took to import, and the memory used (default: %(default)s)')
     parser.add_argument(
         '-d', '--device',
         action='store',
@@ -744,6 +1503,93 @@ def parse_args():
         type=str,
         default="./ewelink.log",
         help='path/name of log file (default: %(default)s)')
+    parser.add_argument(
+        '-M', '--transport',
+        action='store',
+        type=str,
+        choices=['paho', 'asyncio'],
+        default='paho',
+        help='MQTT client, paho-mqtt thread or native asyncio (default: %(default)s)')
+    parser.add_argument(
+        '-w', '--publish_window',
+        action='store',
+        type=int,
+        default=0,
+        help='Time to coalesce publishes for each device (ms) (0=off) (default: %(default)s)')
+    parser.add_argument(
+        '-cr', '--command_rate',
+        action='store',
+        type=float,
+        default=1.0,
+        help='Max commands per second sent to each device (0=no limit) (default: %(default)s)')
+    parser.add_argument(
+        '-cb', '--command_burst',
+        action='store',
+        type=int,
+        default=1,
+        help='Number of commands that can be sent to a device at once, before command_rate applies (default: %(default)s)')
+    parser.add_argument(
+        '-mw', '--merge_window',
+        action='store',
+        type=int,
+        default=0,
+        help='Time to wait for more parameter writes to merge into one command for each device (ms) (0=off) (default: %(default)s)')
+    parser.add_argument(
+        '-rt', '--retries',
+        action='store',
+        type=int,
+        default=0,
+        help='Number of times to resend a command when a device doesn\'t respond (0=never). If set, every command waits up to command_timeout '
+             'for the device to respond, and the device\'s next command waits for it (default: %(default)s)')
+    parser.add_argument(
+        '-ct', '--command_timeout',
+        action='store',
+        type=float,
+        default=5,
+        help='Time to wait for the cloud to respond to a command (seconds) (default: %(default)s)')
+    parser.add_argument(
+        '-S', '--stats_interval',
+        action='store',
+        type=int,
+        default=0,
+        help='Publish stats and command latency every STATS_INTERVAL seconds (0=off) (default: %(default)s)')
+    parser.add_argument(
+        '-W', '--workers',
+        action='store',
+        type=int,
+        default=4,
+        help='Number of workers handling commands for all devices (default: %(default)s)')
+    parser.add_argument(
+        '-g', '--groups',
+        action='store',
+        type=str,
+        default='groups.json',
+        help='json file of device groups, for commands sent to /ewelink_command/group/<name>/<command> (default: %(default)s)')
+    parser.add_argument(
+        '-R', '--refresh',
+        action='store',
+        type=int,
+        default=300,
+        help='Only publish unchanged device values every REFRESH seconds (0=always publish) (default: %(default)s)')
+    parser.add_argument(
+        '-q', '--queue_size',
+        action='store',
+        type=int,
+        default=1000,
+        help='Max MQTT messages queued when the broker is slow (default: %(default)s)')
+    parser.add_argument(
+        '-Q', '--queue_policy',
+        action='store',
+        type=str,
+        choices=['block', 'drop_oldest', 'latest'],
+        default='drop_oldest',
+        help='What to do when the MQTT queue is full, block (pause the cloud connection), drop oldest message, or only keep the latest message for each topic (default: %(default)s)')
+    parser.add_argument(
+        '-ls', '--log_sample',
+        action='store',
+        type=int,
+        default=0,
+        help='Max repeats per second of each debug/info log message (0=all) (default: %(default)s)')
     parser.add_argument(
         '-J', '--json_out',
         action='store_true',
@@ -761,23 +1607,35 @@ def parse_args():
         help='Display version of this program')
     return parser.parse_args()
     
-def setuplogger(logger_name, log_file, level=logging.DEBUG, console=False):
+def setuplogger(logger_name, log_file, level=logging.DEBUG, console=False, sample=0):
+    '''
+    log records are passed through a queue to a listener thread, which does the formatting (see DeferredQueueHandler) and writing,
+    so that file writes (and rotation) don't block the event loop.
+    sample is the max number of each debug/info message per second (0=all) see SamplingFilter
+    '''
     try: 
         l = logging.getLogger(logger_name)
         formatter = logging.Formatter('[%(asctime)s][%(levelname)5.5s](%(name)-20s) %(message)s')
+        handlers = []
         if log_file is not None:
             fileHandler = logging.handlers.RotatingFileHandler(log_file, mode='a', maxBytes=10000000, backupCount=10)
             fileHandler.setFormatter(formatter)
+            handlers.append(fileHandler)
         if console == True:
             #formatter = logging.Formatter('[%(levelname)1.1s %(name)-20s] %(message)s')
             streamHandler = logging.StreamHandler()
             streamHandler.setFormatter(formatter)
+            handlers.append(streamHandler)
 
         l.setLevel(level)
-        if log_file is not None:
-            l.addHandler(fileHandler)
-        if console == True:
-          l.addHandler(streamHandler)
+        log_queue = queue.SimpleQueue()
+        queueHandler = DeferredQueueHandler(log_queue)
+        if sample:
+            queueHandler.addFilter(SamplingFilter(sample))
+        l.addHandler(queueHandler)
+        listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)     #flush remaining records on exit
              
     except Exception as e:
         print("Error in Logging setup: %s - do you have permission to write the log file??" % e)
@@ -788,6 +1646,10 @@ if __name__ == "__main__":
     import argparse
     arg = parse_args()
     
+    if _import_profiler:
+        _import_profiler.stop()
+        print(_import_profiler.report())
+    
     if arg.debug:
         log_level = logging.DEBUG
     else:
@@ -795,7 +1657,7 @@ if __name__ == "__main__":
 
     #setup logging
     log_name = 'Main'
-    setuplogger(log_name, arg.log, level=log_level,console=True)
+    setuplogger(log_name, arg.log, level=log_level, console=True, sample=arg.log_sample)
 
     log = logging.getLogger(log_name)
 
@@ -830,6 +1692,24 @@ if __name__ == "__main__":
                                 name=None,
                                 poll=poll,
                                 json_out=arg.json_out,
+                                transport=arg.transport,
+                                publish_window=arg.publish_window,
+                                refresh=arg.refresh,
+                                command_rate=arg.command_rate,
+                                command_burst=arg.command_burst,
+                                merge_window=arg.merge_window,
+                                retries=arg.retries,
+                                command_timeout=arg.command_timeout,
+                                stats_interval=arg.stats_interval,
+                                workers=arg.workers,
+                                groups=arg.groups,
+                                poll_concurrency=arg.poll_concurrency,
+                                poll_jitter=arg.poll_jitter,
+                                poll_max=arg.poll_max,
+                                snapshot=arg.snapshot,
+                                snapshot_interval=arg.snapshot_interval,
+                                queue_size=arg.queue_size,
+                                queue_policy=arg.queue_policy,
                                 #log=log
                                 )
             if arg.device:
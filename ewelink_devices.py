@@ -32,6 +32,7 @@ and reconnecting the app/client.
 Power cycling the Autoslide reconnects the Autoslide's websocket client to iTEAD's servers, so you can pick up again (if you are still connected).
 
 Do not hit the servers with too many commands too quickly, max is about 1 per second. You will get Timeouts if you send commands too quickly.
+Commands for each device are queued and sent at no more than command_rate (default 1) per second, a queued command is replaced by a newer one for the same params.
 
 command line options:
 client.get_config()
@@ -82,8 +83,23 @@ import datetime
 
 import logging
 
+from log_utils import LazyJson
+from mqtt import Envelope
+from device_state import DeviceState, compact_device
+
 logger = logging.getLogger('Main.'+__name__)
 
+def command(*aliases):
+    '''
+    Decorator to register a device method as the handler for the MQTT command(s) in aliases.
+    The handler is called as handler(command, message, json_message) and returns a coroutine (or None)
+    The dispatch table is compiled once per class (see Default._compile_dispatch)
+    '''
+    def decorator(func):
+        func._commands = aliases
+        return func
+    return decorator
+
 class Default():
     """ An eweclient class for connecting to unknown devices
         Also used as the base class for a device, just override the sections that are not default for your new device.
@@ -111,6 +127,7 @@ class Default():
     device_type = 'switch'  #device type for template rendering
     
     triggers        =[  ]                           #things used to trigger device eg 'switch'
+    non_idempotent  =[  ]                           #params that do something every time they are sent (eg door trigger), these are never retried
     settings        ={  }                           #(read/write options) #if you don't fill this in, it will be autopopulated, but won't show params that don't exist yet
     other_params    ={  "fwVersion": "fwVersion",   #(read only stuff)
                         "rssi": "rssi",
@@ -122,6 +139,47 @@ class Default():
     timers_supported=[  'delay', 'repeat', 'once', 'duration']
 
     __version__ = '2.0'
+    
+    _dispatch = {}      #command:handler table, compiled for each class by _compile_dispatch()
+    _ambiguous = []     #(alias, alias, reason) tuples found when compiling the dispatch table
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._compile_dispatch()
+        
+    @classmethod
+    def _compile_dispatch(cls):
+        '''
+        build the command dispatch table for this class: @command aliases (subclasses override base classes),
+        then settings params and descriptions (which take priority, as they always have)
+        Records ambiguous aliases in cls._ambiguous
+        '''
+        dispatch = {}
+        ambiguous = []
+        for klass in reversed(cls.__mro__):
+            for name, func in vars(klass).items():
+                for alias in getattr(func, '_commands', ()):
+                    dispatch[alias] = getattr(cls, name)    #use the most derived version of the method
+        commands = sorted(dispatch.keys())
+        for param, description in cls.settings.items():
+            handler = cls._setting_handler(param)
+            for alias in {param, description}:
+                if alias in commands:
+                    ambiguous.append((alias, dispatch[alias].__name__, 'setting overrides command'))
+                dispatch[alias] = handler
+        for alias in commands:
+            for other in commands:
+                if alias != other and alias in other and dispatch[alias] is not dispatch[other]:
+                    ambiguous.append((alias, other, 'substring'))
+        cls._dispatch = dispatch
+        cls._ambiguous = ambiguous
+        
+    @staticmethod
+    def _setting_handler(param):
+        def set_param(self, command, message, json_message):
+            self.logger.debug('Setting parameter for device: %s: %s, %s', self.deviceid, param, message)
+            return self._setparameter(param, message)
+        return set_param
 
     def __init__(self, parent, deviceid, device, productModel, initial_parameters={}):
         self.logger = logging.getLogger('Main.'+__class__.__name__)
@@ -129,40 +187,62 @@ class Default():
         self._parent = parent
         self._deviceid = deviceid
         self._config = device
+        self._state = DeviceState(deviceid, device.get('params') if device else None)
         if device:
             self.devicekey = device.get('devicekey', None)   #this is the apikey for V3 fw encryption (if not in DIY mode)
+            device['params'] = self._state.params           #device json shares the current params (not a copy)
+            compact_device(device)
         self.loop = asyncio.get_event_loop()
-        self._update_settings(self._config)
+        self._update_settings(self._state.params)
         self._productModel = productModel   #we are created as this kind of productModel if there is more than one kind of model(one of self.productModel list)
         for param, value in initial_parameters.items():
             pass
-        self.q = asyncio.Queue()
-        self.loop.create_task(self._process_queue())
-        self.logger.debug('Created %s Device V:%s, model: %s' % (self.__class__.__name__,self.__version__,self._productModel))
+        self.logger.debug('Created %s Device V:%s, model: %s', self.__class__.__name__,self.__version__,self._productModel)
         
-    async def _process_queue(self):
-        while True:
-            try:
-                command, message = await self.q.get()
-                if command is None:
-                    #self.logger.debug('deviceid: %s, got EXIT command' % self.deviceid)
-                    self.q.task_done()
-                    raise RuntimeError('task completed')
-
-                self.logger.debug('deviceid: %s, got command from queue: %s, %s' % (self.deviceid, command, message))
-                func = self._on_message(command, message)
-                if func: 
-                    asyncio.run_coroutine_threadsafe(func,self.loop)
-                self.q.task_done()
-            except Exception as e:
-                self.logger.debug('deviceid: %s, process queue exited: %s' % (self.deviceid,e))
-                break
+    def _process_command(self, command, message):
+        '''
+        called by the parent's worker pool, in order, for each command for this device
+        returns the coroutine (if any) that carries out the command
+        '''
+        self.logger.debug('deviceid: %s, got command from queue: %s, %s', self.deviceid, command, message)
+        return self._on_message(command, message)
+        
+    def _update_device(self, device):
+        '''
+        the device list has been fetched again (eg on reconnect), and this device is still in it, so this client is kept
+        (with it's state), use the new device json, and merge it's params into the state
+        '''
+        params = device.get('params') or {}
+        self._config = device
+        self.devicekey = device.get('devicekey', getattr(self, 'devicekey', None))
+        self._update_settings(self._state.update(params))
+        device['params'] = self._state.params           #device json shares the current params (not a copy)
+        compact_device(device)
+        
+    def _close(self):
+        '''
+        the device has gone from the device list, stop anything this client has running
+        '''
+        pass
                 
-    def _update_settings(self,data):
-        for param in data['params']:
+    def _update_settings(self, params):
+        '''
+        params the device has that are not known settings (or read only) are added to this device's settings, and dispatch table
+        the class settings and dispatch table are shared by every device of the class, so they are copied before the first change
+        '''
+        for param in params:
             if param not in self.settings.keys() and param not in self.other_params.keys():
-                self.logger.debug('adding %s to settings' % param)
+                self.logger.debug('adding %s to settings', param)
+                if self.settings is type(self).settings:
+                    self.settings = dict(self.settings)
                 self.settings[param]=param
+            if param in self.settings.keys() and param not in self._dispatch:
+                if self._dispatch is type(self)._dispatch:
+                    self._dispatch = dict(self._dispatch)
+                for other in self._dispatch:
+                    if param in other:
+                        self.logger.debug('device %s: ambiguous command %s / %s (substring)', self.deviceid, param, other)
+                self._dispatch[param] = self._setting_handler(param)
                 
     def pprint(self,obj):
         """Pretty JSON dump of an object."""
@@ -172,6 +252,10 @@ class Default():
     def config(self):
         return self._config
         
+    @property
+    def state(self):
+        return self._state
+        
     @property
     def deviceid(self):
         return self._deviceid
@@ -203,84 +287,92 @@ class Default():
         return message
     
     def _on_message(self, command, message):
-        self.logger.info("%s CLIENT: Received Command: %s, device: %s, Setting: %s" % (__class__.__name__,command, self.deviceid, message))
-        func = None
+        self.logger.info("%s CLIENT: Received Command: %s, device: %s, Setting: %s", __class__.__name__,command, self.deviceid, message)
         
         json_message = message
         message = self.convert_json(message.lower())   #make case insensitive as "ON" does not work ("on" does)
         
-        for param, description in self.settings.items():
-            if command == param or command == description:
-                self.logger.debug('Setting parameter for device: %s: %s, %s' % (self.deviceid, param, message))
-                func = self._setparameter(param, message)
-                break
-        else:
+        handler = self._dispatch.get(command)
+        if handler is None:
+            return self._on_message_default(command, message)
+        return handler(self, command, message, json_message)
         
-            if 'set_switch' in command:
-                self.logger.debug('set switch mode: %s, %s' % (self.deviceid,message)) 
-                func = self._setparameter('switch', message)
+    @command('set_switch')
+    def _cmd_set_switch(self, command, message, json_message):
+        self.logger.debug('set switch mode: %s, %s', self.deviceid,message) 
+        return self._setparameter('switch', message)
         
-            elif 'set_led' in command:
-                self.logger.debug('set led mode: %s, %s' % (self.deviceid,message)) #example: mosquitto_pub -t "/ewelink_command/100050xxxx/set_led" -m "on" or mosquitto_pub -t "/ewelink_command/Switch 1/set_led" -m "off"
-                func = self._setparameter('sledOnline', message)
-                
-            elif 'send_json' in command:
-                '''
-                Sets "parms" to whatever you send as a json string (not dict)
-                You can use this to send custom json parameters to the device (if you know the format)
-                '''
-                self.logger.debug('send_json: for device %s' % self.deviceid)
-                try:
-                    func = self._sendjson(self.convert_json(json_message, True))
-                except json.JSONDecodeError as e:
-                    self.log.error('Your json is invalid: {}, Error: {}'.format(json_message, e))
-                
-            elif 'get_config' in command:
-                self.logger.debug('get_config: for device %s' % self.deviceid)
-                func = self._getparameter()
-                
-            elif 'add_timer' in command:
-                self.logger.debug('add_timer: for device %s' % self.deviceid)
-                func = self._addtimer(message)
-                
-            elif 'list_timer' in command:
-                self.logger.debug('list_timers: for device %s' % self.deviceid)
-                func = self._list_timers()
-                
-            elif 'del_timer' in command:
-                self.logger.debug('delete_timer: for device %s' % self.deviceid)
-                func = self._del_timer(message)
-                
-            elif 'clear_timers' in command:
-                self.logger.debug('clear_timers: for device %s' % self.deviceid)
-                func = self._sendjson({'timers': []})
-                
-            else:
-                func = self._on_message_default(command, message)
+    @command('set_led')
+    def _cmd_set_led(self, command, message, json_message):
+        self.logger.debug('set led mode: %s, %s', self.deviceid,message) #example: mosquitto_pub -t "/ewelink_command/100050xxxx/set_led" -m "on" or mosquitto_pub -t "/ewelink_command/Switch 1/set_led" -m "off"
+        return self._setparameter('sledOnline', message)
         
-        return func
+    @command('send_json', 'set_json')
+    def _cmd_send_json(self, command, message, json_message):
+        '''
+        Sets "parms" to whatever you send as a json string (not dict)
+        You can use this to send custom json parameters to the device (if you know the format)
+        '''
+        self.logger.debug('send_json: for device %s', self.deviceid)
+        try:
+            return self._sendjson(self.convert_json(json_message, True))
+        except json.JSONDecodeError as e:
+            self.logger.error('Your json is invalid: {}, Error: {}'.format(json_message, e))
+        return None
+        
+    @command('get_config')
+    def _cmd_get_config(self, command, message, json_message):
+        self.logger.debug('get_config: for device %s', self.deviceid)
+        self._parent._clear_history(self.deviceid)   #publish everything, even if unchanged
+        return self._getparameter()
+        
+    @command('add_timer', 'add_timers')
+    def _cmd_add_timer(self, command, message, json_message):
+        self.logger.debug('add_timer: for device %s', self.deviceid)
+        return self._addtimer(message)
+        
+    @command('list_timer', 'list_timers')
+    def _cmd_list_timer(self, command, message, json_message):
+        self.logger.debug('list_timers: for device %s', self.deviceid)
+        return self._list_timers()
+        
+    @command('del_timer', 'del_timers')
+    def _cmd_delete_timer(self, command, message, json_message):
+        self.logger.debug('delete_timer: for device %s', self.deviceid)
+        return self._del_timer(message)
+        
+    @command('clear_timers')
+    def _cmd_clear_timers(self, command, message, json_message):
+        self.logger.debug('clear_timers: for device %s', self.deviceid)
+        return self._sendjson({'timers': []})
+        
+    def has_command(self, command):
+        '''
+        True if command is handled by this device (it's in the dispatch table, or the class handles other commands itself)
+        '''
+        return command in self._dispatch or type(self)._on_message_default is not Default._on_message_default
         
     def _on_message_default(self, command, message):
         '''
-        Default which can be overridden by a class for processing special functions for the device while retaining the basic
-        commands
+        Called for commands that are not in the dispatch table. Can be overridden by a class for processing special functions
+        for the device while retaining the basic commands, but registering handlers with @command is preferred
         '''
         self.logger.warn('Command: %s not found' % command)
         return None
         
     async def _list_timers(self):
         await self._getparameter(waitResponse=True)
-        timers = self._config['params'].get('timers', None)
+        timers = self._state.get('timers')
         if timers:
             for num, timer in enumerate(timers):
-                self.logger.info('deviceid: %s, timer %d: type:%s at:%s' % (self.deviceid, num, timer.get('coolkit_timer_type',timer['type']), timer['at']))
+                self.logger.info('deviceid: %s, timer %d: type:%s at:%s', self.deviceid, num, timer.get('coolkit_timer_type',timer['type']), timer['at'])
         else:
-            self.logger.info('deviceid: %s, no timers configured' % self.deviceid)
+            self.logger.info('deviceid: %s, no timers configured', self.deviceid)
             
     async def _del_timer(self, message):
         await self._list_timers()
         deleted = 0
-        timers = self._config['params'].get('timers', None)
+        timers = self._state.get('timers')
         if timers:
             nums_string = message.replace(',',' ').split()
             nums = sorted([int(num) for num in nums_string if num.isdigit()], reverse=True)
@@ -290,7 +382,7 @@ class Default():
                     assert num < len(timers)
                     del_timer = timers.pop(num)
                     deleted +=1
-                    self.logger.info('deviceid: %s, timer %d: type:%s at:%s DELETED' % (self.deviceid, num, del_timer.get('coolkit_timer_type',del_timer['type']), del_timer['at']))
+                    self.logger.info('deviceid: %s, timer %d: type:%s at:%s DELETED', self.deviceid, num, del_timer.get('coolkit_timer_type',del_timer['type']), del_timer['at'])
                     
                 except AssertionError as e:
                     self.logger.error('deviceid: %s, problem deleting timer %d, error %s' % (self.deviceid, num, e))
@@ -299,7 +391,7 @@ class Default():
             self.logger.warn('deviceid: %s, can\'t delete timers: %s no timers found' % (self.deviceid,message))
         
         if deleted > 0:
-            self.logger.debug('deviceid: %s,deleted %d timers' % (self.deviceid,deleted))
+            self.logger.debug('deviceid: %s,deleted %d timers', self.deviceid,deleted)
             func = await self._sendjson({'timers':timers})    
         else:
             func =  None
@@ -321,11 +413,11 @@ class Default():
             return None
             
         timers = {}
-        timers['timers'] = self._config['params'].get('timers', [])
+        timers['timers'] = self._state.get('timers', [])
         if len(timers['timers'])+1 > 8:
             self.logger.error('deviceid: %s,Cannot set more than 8 timers'  % self.deviceid)
             return None
-        self.logger.debug('adding timer: %s, %s' % (len(timers['timers'])+1, org_message))
+        self.logger.debug('adding timer: %s, %s', len(timers['timers'])+1, org_message)
         if timer_type == 'delay':
             #"countdown" Timer format is 'delay period (channel) switch (manual)' where 'manual' is for TH16/10 to disable auto control and can be left off normally
             auto = True
@@ -473,12 +565,12 @@ class Default():
     async def _sendjson(self, message):
         ''' send a dictionary of parameters as a json string '''
         if isinstance(message, str):
-            await self._parent._sendjson(self.deviceid, message)
+            return await self._parent._sendjson(self.deviceid, message)
         else:
-            await self._parent._sendjson(self.deviceid, json.dumps(message))
+            return await self._parent._sendjson(self.deviceid, json.dumps(message))
         
     async def _getparameter(self, params=[], waitResponse=False):
-        await self._parent._getparameter(self.deviceid, params, waitResponse)
+        return await self._parent._getparameter(self.deviceid, params, waitResponse)
           
     async def _setparameter(self, param, targetState, update_config=True, waitResponse=False):
         if param not in self.settings.keys():
@@ -491,36 +583,38 @@ class Default():
              
         if param in self.numerical_params:
             targetState = int(targetState)
-        await self._parent._setparameter(self.deviceid, param, targetState, update_config, waitResponse)
+        return await self._parent._setparameter(self.deviceid, param, targetState, update_config, waitResponse)
         
     def _handle_notification(self, data):
         '''
         receive status in action key 'update' or 'sysmsg'
+        data can be a dict or an Envelope (so the json publish reuses the serialized data)
         '''
-        self.logger.debug("Received data %s" % data)
+        envelope = Envelope.wrap(data)
+        data = envelope.data
+        self.logger.debug("Received data %s", data)
         
         if data.get('error', 0) != 0:
             self.logger.warn('Not Processing error')
             return
 
-        self._parent.update(self._config, data)
-        self._config['update']=time.time()
+        delta = self._state.update(data.get('params', {}))
         
         if self._parent._json_out:
-            self._publish('json', data)
+            self._publish('json', envelope)
         
         try:
             update = data['params']
             if data.get('action', None):
                 if 'update' in data['action']:
-                    self._update_settings(data)
-                    self.logger.debug("Action Update: Publishing: %s" % (update))
+                    self._update_settings(delta)
+                    self.logger.debug("Action Update: Publishing: %s", update)
                     self._publish_config(update)
                     self._publish('status', "OK")
                             
                 elif 'sysmsg' in data['action']:
                     for param, value in update.items():
-                        self.logger.debug("Sysmsg Update: Publishing: %s:%s" % (param, value))
+                        self.logger.debug("Sysmsg Update: Publishing: %s:%s", param, value)
                         self._publish(param, value)
                         if 'online' in param:
                             if value == True:
@@ -528,8 +622,8 @@ class Default():
                                 self._publish('status', "OK")
                                 
             elif data.get('params', None):
-                self._update_settings(data)
-                self.logger.debug("Params Update: Publishing: %s" % (update))
+                self._update_settings(delta)
+                self.logger.debug("Params Update: Publishing: %s", update)
                 self._publish_config(update)
             else:
                 self.logger.debug("No Action to Publish")
@@ -557,7 +651,7 @@ class Default():
         '''
         Only used for command line (API) options, not strictly necessary if only mqtt is used, but uses the same format as mqtt
         '''
-        asyncio.run_coroutine_threadsafe(self.q.put((command, message)),self.loop)
+        self.loop.call_soon_threadsafe(self._parent._workers.put, self.deviceid, self._process_command, command, message)
                     
     def set_parameter(self, param, value=None):
         asyncio.run_coroutine_threadsafe(self._setparameter(param, value),self.loop)
@@ -570,6 +664,8 @@ class Default():
         
     def delete_timers(self):
         asyncio.run_coroutine_threadsafe(self._setparameter('timers', []),self.loop)
+        
+Default._compile_dispatch()   #subclasses are compiled by __init_subclass__
 
 
 class Autoslide(Default):
@@ -578,6 +674,7 @@ class Autoslide(Default):
     productModel    = ["WFA-1"]   #model list used for identifying the correct class
     
     triggers        =[  'b']
+    non_idempotent  =[  'b']
     settings        ={  'a':'mode',         #0=auto, 1=stacker, 2=lock, 3=pet
                         'b':'command',      #app trigger none=0, 1=inside, 2=outside, 3=pet, 4=stacker
                         'd':'unknown_d',
@@ -609,8 +706,11 @@ class Autoslide(Default):
         self._parent = parent
         self._deviceid = deviceid
         self._config = device
+        self._state = DeviceState(deviceid, device.get('params') if device else None)
         if device:
             self.devicekey = device.get('devicekey', None)   #this is the apikey for V3 fw encryption (if not in DIY mode)
+            device['params'] = self._state.params           #device json shares the current params (not a copy)
+            compact_device(device)
         self._productModel = productModel   #we are created as this kind of productModel if there is more than one kind of model(one of self.productModel list)
         self._org_delay = None
         self._delay_person = None
@@ -621,67 +721,61 @@ class Autoslide(Default):
         for param, value in initial_parameters.items():
             if param == 'delay_person':
                self._delay_person = value 
-        self.q = asyncio.Queue()
         self.loop = asyncio.get_event_loop()
-        self.loop.create_task(self._process_queue())
-        self.logger.debug('Created %s Device V:%s, model: %s' % (self.__class__.__name__ ,self.__version__,self._productModel))
+        self.logger.debug('Created %s Device V:%s, model: %s', self.__class__.__name__ ,self.__version__,self._productModel)
         
     def delay_person(self, delay_person=None):
         if delay_person is not None:
             self._delay_person = delay_person
         return self._delay_person
     
-    def _on_message_default(self, command, message):
-        self.logger.info("%s CLIENT: Received Command: %s, device: %s, Setting: %s" % (__class__.__name__,command, self.deviceid, message))
-        func = None
-        
-        if 'door_trigger_delay' in command:
-            #3=pet, 2=outdoor, 1=indoor, 4=stacker
-            trigger, delay = message.split(' ')
-            self.logger.debug('Triggering Door Delay: %s, %s, %s' % (trigger, self.deviceid, delay))
-            func = self._hold_open(trigger, delay)
-            
-        elif 'set_delay_person' in command:
-            #set delay for person different from pet
-            self.logger.debug('setting delay_person to: %s' % message)
-            if message == 'None':
-                self._delay_person = None
-            else:
-                self._delay_person = message
-            func = self._getparameter()
+    @command('door_trigger_delay')
+    def _cmd_door_trigger_delay(self, command, message, json_message):
+        #3=pet, 2=outdoor, 1=indoor, 4=stacker
+        trigger, delay = message.split(' ')
+        self.logger.debug('Triggering Door Delay: %s, %s, %s', trigger, self.deviceid, delay)
+        return self._hold_open(trigger, delay)
         
-        elif 'door_trigger' in command:
-            #3=pet, 2=outdoor, 1=indoor, 4=stacker
-            self.logger.debug('Triggering Door: %s, %s' % (self.deviceid,message))
-            func = self._setparameter('b', message)
-     
-        elif 'set_mode' in command:
-            #a=mode, 0=auto, 1=stacker, 2=lock, 3=pet
-            self.logger.debug('set_mode: Door %s, %s' % (self.deviceid,message)) #example: mosquitto_pub -t "/ewelink_command/100050xxxx/set_mode" -m "3" or mosquitto_pub -t "/ewelink_command/Patio Door/set_mode" -m "3"
-            func = self._setparameter('a', message)
-
-        elif 'set_option' in command:
-            #options are (0=ON)
-            '''
-            a=mode, 0=auto, 1=stacker, 2=lock, 3=pet
-            d=unknown
-            e=75% power
-            f=Slam Shut
-            g=unknown
-            h=Heavy door
-            i=Stacker Mode
-            j=Door Delay (in seconds)
-            k=unknown
-            l=Notifications
-            '''
-            option, setting = message.split()
-            self.logger.debug('set_option: Door %s, %s to %s' % (self.deviceid, option, setting))
-            func = self._setparameter(option, setting)
-            
+    @command('set_delay_person')
+    def _cmd_set_delay_person(self, command, message, json_message):
+        #set delay for person different from pet
+        self.logger.debug('setting delay_person to: %s', message)
+        if str(message).lower() == 'none':
+            self._delay_person = None
         else:
-            func = super()._on_message_default(command, message)
-                               
-        return func
+            self._delay_person = message
+        return self._getparameter()
+        
+    @command('door_trigger')
+    def _cmd_door_trigger(self, command, message, json_message):
+        #3=pet, 2=outdoor, 1=indoor, 4=stacker
+        self.logger.debug('Triggering Door: %s, %s', self.deviceid,message)
+        return self._setparameter('b', message)
+        
+    @command('set_mode')
+    def _cmd_set_mode(self, command, message, json_message):
+        #a=mode, 0=auto, 1=stacker, 2=lock, 3=pet
+        self.logger.debug('set_mode: Door %s, %s', self.deviceid,message) #example: mosquitto_pub -t "/ewelink_command/100050xxxx/set_mode" -m "3" or mosquitto_pub -t "/ewelink_command/Patio Door/set_mode" -m "3"
+        return self._setparameter('a', message)
+        
+    @command('set_option')
+    def _cmd_set_option(self, command, message, json_message):
+        #options are (0=ON)
+        '''
+        a=mode, 0=auto, 1=stacker, 2=lock, 3=pet
+        d=unknown
+        e=75% power
+        f=Slam Shut
+        g=unknown
+        h=Heavy door
+        i=Stacker Mode
+        j=Door Delay (in seconds)
+        k=unknown
+        l=Notifications
+        '''
+        option, setting = message.split()
+        self.logger.debug('set_option: Door %s, %s to %s', self.deviceid, option, setting)
+        return self._setparameter(option, setting)
         
     async def _setparameter(self, param, targetState, update_config=True, waitResponse=False):
         '''
@@ -714,32 +808,34 @@ class Autoslide(Default):
             targetState = '0'+targetState
             
         if param == 'b':
-            self._config['params']['b']=targetState
+            self._state.update({'b': targetState})
             self._config['b_update']=time.time() #time app was last triggered
         
-        await super()._setparameter(param, targetState, update_config, waitResponse)
+        return await super()._setparameter(param, targetState, update_config, waitResponse)
         
     def _handle_notification(self, data):
         '''
         receive door status in action key 'update' or 'sysmsg'
+        data can be a dict or an Envelope (so the json publish reuses the serialized data)
         '''
-        self.logger.debug("Received data %s" % data)
+        envelope = Envelope.wrap(data)
+        data = envelope.data
+        self.logger.debug("Received data %s", data)
         
         if data.get('error', 0) != 0:
             self.logger.warn('Not Processing error')
             return
 
-        self._parent.update(self._config, data)
-        self._config['update']=time.time()
+        delta = self._state.update(data.get('params', {}))
         
         if self._parent._json_out:
-            self._publish('json', data)
+            self._publish('json', envelope)
         
         try:
             update = data['params']
             if data.get('action', None):
                 if 'update' in data['action']:
-                    self.logger.debug("Action Update: Publishing: %s" % (update))
+                    self.logger.debug("Action Update: Publishing: %s", update)
                     self._publish_config(update)
                     #self._publish('status', "OK")
                     #handle circumstance where door delay for person trigger is different from default (ie Pet) trigger
@@ -749,7 +845,7 @@ class Autoslide(Default):
                         n = update.get('n',None)
                         b = self._config.get('b','3') #b is last app trigger
                         b_update = self._config.get('b_update',0) #this is when it was last triggered
-                        self.logger.debug('ShowNotification: Got b_update: %s' % b_update)
+                        self.logger.debug('ShowNotification: Got b_update: %s', b_update)
                         if c == '0' and m == '1' and n == '0': #if not triggered locally
                             if time.time()-b_update < 2:  #if app was triggered within the last 2 seconds
                                 n = b
@@ -757,19 +853,19 @@ class Autoslide(Default):
                                 n = '1'
                                 self.config['b_update'] = time.time()
                         if n in ['1','2']: #non-app person trigger
-                            self.logger.debug('ShowNotification: adding delay to door trigger: %s, %s, %s' % (update['n'], self.deviceid, self._delay_person))
+                            self.logger.debug('ShowNotification: adding delay to door trigger: %s, %s, %s', update['n'], self.deviceid, self._delay_person)
                             self.loop.create_task(self._hold_open(update['n'], self._delay_person))
                             
                 elif 'sysmsg' in data['action']:
                     for param, value in update.items():
-                        self.logger.debug("Sysmsg Update: Publishing: %s:%s" % (param, value))
+                        self.logger.debug("Sysmsg Update: Publishing: %s:%s", param, value)
                         self._publish(param, value)
                         if 'online' in param:
                             if value == True: 
                                 self._parent._update_config = True
 
             elif data.get('params', None):
-                self.logger.debug("Params Update: Publishing: %s" % (update))
+                self.logger.debug("Params Update: Publishing: %s", update)
                 self._publish_config(update)
             else:
                 self.logger.debug("No Action to Publish")
@@ -828,17 +924,17 @@ class Autoslide(Default):
         delay = str(delay)
         #self.logger.debug('hold_open: self._config: %s' % self.pprint(self._config))
         if trigger == '0':
-            trigger = self._config['params'].get('n','0')
+            trigger = self._state.get('n','0')
         if trigger == '0':
-            trigger = self._config['params'].get('b','0')
+            trigger = self._state.get('b','0')
         if trigger == '0':
             trigger = '1'
         self._hold_open_running = True
         self.logger.debug('hold_open: triggering door')
         await self._setparameter('b', trigger)
         #await asyncio.sleep(2)
-        org_delay = self._config['params']['j']
-        self.logger.debug('hold_open: orig delay: %s' % org_delay)
+        org_delay = self._state['j']
+        self.logger.debug('hold_open: orig delay: %s', org_delay)
         if int(delay) != int(org_delay):
             if self._restore_delay_task:
                 self._restore_delay_task.cancel()
@@ -856,16 +952,16 @@ class Autoslide(Default):
             self._restore_delay_task = self.loop.create_task(self._restore_delay(delay))
         self._hold_open_running = False
             
+    def _close(self):
+        if self._restore_delay_task:
+            self._restore_delay_task.cancel()
+            
     async def _restore_delay(self, delay=2):
         self.logger.debug('restore_delay: scheduled, waiting')
         try:
             await asyncio.sleep(int(delay)) #change delay back when closing, so wait for m == 2 (closed)
-            while True:
-                m = self._config['params'].get('m','0')
-                await asyncio.sleep(1)
-                if m == '2':
-                    break
-            self.logger.debug('restore_delay: got org_delay: %s' % self._org_delay)
+            await self._state.wait_for('m', '2')
+            self.logger.debug('restore_delay: got org_delay: %s', self._org_delay)
             await self._setparameter('j', self._org_delay, update_config=False)
             self._org_delay = None
         except asyncio.CancelledError:
@@ -969,11 +1065,10 @@ class TH16Switch(Default):
     
     __version__ = '1.0'
     
-    def _on_message_default(self, command, message):
+    @command('set_temperature', 'set_humidity')
+    def _cmd_set_target(self, command, message, json_message):
         '''
-        Default which can be overridden by a class for processing special functions for the device while retaining the basic
-        commands
-        Here process commands for setting temperature and humidity triggers.
+        Process commands for setting temperature and humidity triggers.
         hi setting must be lower or the same as low setting
         The high Switch is always the opposite of the low switch (so no need to send high switch)
         format:
@@ -981,51 +1076,50 @@ class TH16Switch(Default):
         message: low on|off high so for example "20 on 26" is turn on at 20 deg C and off at 26 deg C.
         topic: set_humidity
         as above, but with humidity values
-        topic: set_manual (set deviceType="normal", mainSwitch="off" for manual mode) 
         '''
-        if 'set_temperature' in command or 'set_humidity' in command:
-            message = message.lower().split(" ")
-            if len(message) == 2:
-                low = hi = message[0] 
-                low_switch = 'on' if message[1] == 'on' else 'off'
-                hi_switch = 'on' if low_switch == 'off' else 'off'
-            if len(message) >= 3:
-                low = message[0] 
-                low_switch = 'on' if message[1] == 'on' else 'off'
-                hi_switch = 'on' if low_switch == 'off' else 'off'
-                hi = message[2]
-            else:
-                self.logger.error('format of message is lo_value, switch, hi_value, or low/hi_value switch, you sent: %s' % message)
-                return None
-                
-            if not low.isdigit() or not hi.isdigit() or int(low) > int(hi):
-                self.logger.error('low and high values must be numbers, and low must be lower or equal to high, with low first, you sent: %s' % message)
-                return None
-                
-            temp = {}
-            temp["mainSwitch"]="on"
-            temp["targets"]=[]
-            temp["targets"].append({"reaction":{"switch": hi_switch if hi_switch == 'on' else 'off'}, "targetHigh": hi}) # high goes first in the list
-            temp["targets"].append({"reaction":{"switch": low_switch if low_switch == 'on' else 'off'}, "targetLow": low}) 
+        message = message.lower().split(" ")
+        if len(message) == 2:
+            low = hi = message[0] 
+            low_switch = 'on' if message[1] == 'on' else 'off'
+            hi_switch = 'on' if low_switch == 'off' else 'off'
+        if len(message) >= 3:
+            low = message[0] 
+            low_switch = 'on' if message[1] == 'on' else 'off'
+            hi_switch = 'on' if low_switch == 'off' else 'off'
+            hi = message[2]
+        else:
+            self.logger.error('format of message is lo_value, switch, hi_value, or low/hi_value switch, you sent: %s' % message)
+            return None
+            
+        if not low.isdigit() or not hi.isdigit() or int(low) > int(hi):
+            self.logger.error('low and high values must be numbers, and low must be lower or equal to high, with low first, you sent: %s' % message)
+            return None
             
-            if 'temperature' in command:   
-                self.logger.debug('set_temperature switching: for device %s to (low) %s degC:%s (hi) %s degC:%s' % (self.deviceid, low, low_switch, hi, hi_switch))
-                temp["deviceType"]="temperature"
-                                 
-            if 'humidity' in command: 
-                self.logger.debug('set_humidity switching: for device %s to (low) %s degC:%s (hi) %s degC:%s' % (self.deviceid, low, low_switch, hi, hi_switch))
-                temp["deviceType"]="humidity"
+        temp = {}
+        temp["mainSwitch"]="on"
+        temp["targets"]=[]
+        temp["targets"].append({"reaction":{"switch": hi_switch if hi_switch == 'on' else 'off'}, "targetHigh": hi}) # high goes first in the list
+        temp["targets"].append({"reaction":{"switch": low_switch if low_switch == 'on' else 'off'}, "targetLow": low}) 
+        
+        if 'temperature' in command:   
+            self.logger.debug('set_temperature switching: for device %s to (low) %s degC:%s (hi) %s degC:%s', self.deviceid, low, low_switch, hi, hi_switch)
+            temp["deviceType"]="temperature"
+                             
+        if 'humidity' in command: 
+            self.logger.debug('set_humidity switching: for device %s to (low) %s degC:%s (hi) %s degC:%s', self.deviceid, low, low_switch, hi, hi_switch)
+            temp["deviceType"]="humidity"
 
-            self.logger.info('sending: %s' % self.pprint(temp))
-            func = self._sendjson(temp)
-        elif 'set_manual' in command:
-            self.logger.debug('set_manual switching: for device %s' % self.deviceid)
-            temp = { "deviceType": "normal","mainSwitch": "off"}
-            func = self._sendjson(temp)
-        else:
-            func = super()._on_message_default(command, message)
-  
-        return func
+        self.logger.info('sending: %s', LazyJson(temp))
+        return self._sendjson(temp)
+        
+    @command('set_manual')
+    def _cmd_set_manual(self, command, message, json_message):
+        '''
+        set deviceType="normal", mainSwitch="off" for manual mode
+        '''
+        self.logger.debug('set_manual switching: for device %s', self.deviceid)
+        temp = { "deviceType": "normal","mainSwitch": "off"}
+        return self._sendjson(temp)
 
 class LEDBulb(Default):
     """An eweclient class for connecting to Sonoff Led Bulb B1"""
@@ -1108,4 +1202,17 @@ class FourChannelSwitch(Default):
             self.logger.error('deviceid: %s, must be an even number of channel (number), setting (on|off) pairs for param: %s, you sent: %s : error: %s' % (self.deviceid,param,targetState,e))
             return
         
-        await super()._setparameter(param, targetState, update_config, waitResponse)
+        return await super()._setparameter(param, targetState, update_config, waitResponse)
+
+def device_classes():
+    '''
+    returns list of the device classes (Default and all classes derived from it, including any defined in other
+    modules that have been imported), in name order, so the first class for a productModel is always the same one
+    '''
+    classes, subclasses = [], [Default]
+    while subclasses:
+        dev_class = subclasses.pop()
+        if dev_class not in classes:
+            classes.append(dev_class)
+            subclasses.extend(dev_class.__subclasses__())
+    return sorted(classes, key=lambda dev_class: dev_class.__name__)
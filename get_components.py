@@ -1,45 +1,263 @@
-# install custom_components from https://api.github.com/repos/AlexxIT/SonoffLAN/releases/latest if not existing
+#!/usr/bin/env python3
+# install custom_components from https://api.github.com/repos/AlexxIT/SonoffLAN/releases if not existing
+'''
+The SonoffLAN release archives are kept in a local cache (one zip per version, with it's sha256 in manifest.json),
+so once a version has been downloaded, custom_components can be installed (again) without network access.
+Set by environment variables (as custom_components are installed when ewelink.py is imported, before it's options are read):
+SONOFFLAN_VERSION   release tag to install (eg v3.3.1), default is the latest release
+SONOFFLAN_SHA256    sha256 the release archive must have, default is the one recorded when it was first downloaded
+SONOFFLAN_CACHE     cache directory, default ~/.cache/ewelink-mqtt
+SONOFFLAN_OFFLINE   set to 1 to only install from the cache
+'''
 
 import os
+import json
+import hashlib
+import shutil
 
-async def install_components():
+RELEASES = 'https://api.github.com/repos/AlexxIT/SonoffLAN/releases'
+COMPONENTS = './custom_components'
+VERSION_FILE = '.sonofflan_version'     #in COMPONENTS, the version installed
+CHUNK = 64 * 1024
+
+class ComponentsError(Exception):
     '''
-    Download custom_components from latest release at https://github.com/AlexxIT/SonoffLAN
+    custom_components could not be installed
     '''
-    from io import BytesIO
-    import shutil, sys
-    from zipfile import ZipFile
-    from aiohttp import ClientSession, ClientTimeout
-    print('Attempting to install custom_components')
-    async with ClientSession(timeout=ClientTimeout(total=5.0)) as session:
-        async with session.get('https://api.github.com/repos/AlexxIT/SonoffLAN/releases/latest') as resp:
-            if resp.status == 200:
+
+class ComponentCache():
+    '''
+    Versioned cache of SonoffLAN release archives in directory path
+    '''
+
+    def __init__(self, path=None):
+        self.path = os.path.expanduser(path or os.environ.get('SONOFFLAN_CACHE') or '~/.cache/ewelink-mqtt')
+        self.manifest_path = os.path.join(self.path, 'manifest.json')
+        self.manifest = self._load_manifest()
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if isinstance(manifest.get('versions'), dict):
+                return manifest
+        except (OSError, ValueError, AttributeError):
+            pass
+        return {'latest': None, 'versions': {}}     #versions is version: sha256
+
+    def _save_manifest(self):
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp, self.manifest_path)
+
+    def archive(self, version):
+        return os.path.join(self.path, 'SonoffLAN-{}.zip'.format(version.replace('/', '_')))
+
+    @property
+    def latest(self):
+        '''
+        latest version downloaded, None if the cache is empty
+        '''
+        return self.manifest.get('latest')
+
+    def get(self, version, sha256=None):
+        '''
+        returns the path of the archive for version, if it's in the cache and it's hash matches sha256 (or the hash recorded
+        when it was downloaded), None if it isn't
+        '''
+        path = self.archive(version)
+        expected = sha256 or self.manifest['versions'].get(version)
+        if not expected or not os.path.exists(path):
+            return None
+        if file_sha256(path) != expected.lower():
+            print('Cached SonoffLAN {} does not match sha256 {}, ignoring it'.format(version, expected))
+            return None
+        return path
+
+    def add(self, version, sha256, latest=False):
+        '''
+        record the archive for version (already written to archive(version)) and it's hash
+        '''
+        self.manifest['versions'][version] = sha256
+        if latest or not self.manifest.get('latest'):
+            self.manifest['latest'] = version
+        self._save_manifest()
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+async def download_components(cache, version=None, sha256=None):
+    '''
+    Download the SonoffLAN release version (latest if None) into the cache, unless it's already there,
+    returns (version, path of archive). The archive is streamed to disk, and hashed as it's written.
+    '''
+    from aiohttp import ClientSession, ClientTimeout, ClientError
+    url = '{}/tags/{}'.format(RELEASES, version) if version else RELEASES+'/latest'
+    try:
+        async with ClientSession(timeout=ClientTimeout(total=None, sock_connect=5, sock_read=30)) as session:
+            async with session.get(url) as resp:
+                if resp.status != 200:
+                    raise ComponentsError('{} returned {}'.format(url, resp.status))
                 data = await resp.json()
-                zipfile_url = data.get('zipball_url', None)
-                if zipfile_url:
-                    print('retrieving: {}'.format(zipfile_url))
-                    async with session.get(zipfile_url) as r:
-                        if r.status == 200:
-                            SonoffLAN = ZipFile(BytesIO(await r.read()))
-                            name_list = SonoffLAN.namelist()
-                            root = name_list[0]
-                            files = [name for name in name_list if 'custom_components' in name]
-                            print('Extracting: {}'.format('\n'.join(files)))
-                            SonoffLAN.extractall(members = files)
-                            shutil.move(root+'custom_components', './')
-                            if len(root) > 3:
-                                shutil.rmtree(root)
-                            print('Installed custom_components')
-                            return True
-            print('Could not install custom_components from https://api.github.com/repos/AlexxIT/SonoffLAN')
-            sys.exit(1)
-                
+            version = data.get('tag_name') or version
+            zipfile_url = data.get('zipball_url')
+            if not version or not zipfile_url:
+                raise ComponentsError('no release archive found at {}'.format(url))
+            path = cache.get(version, sha256)
+            if path:
+                return version, path
+            print('retrieving: {}'.format(zipfile_url))
+            path = cache.archive(version)
+            tmp = path + '.part'
+            hasher = hashlib.sha256()
+            os.makedirs(cache.path, exist_ok=True)
+            try:
+                async with session.get(zipfile_url) as r:
+                    if r.status != 200:
+                        raise ComponentsError('{} returned {}'.format(zipfile_url, r.status))
+                    with open(tmp, 'wb') as f:
+                        async for chunk in r.content.iter_chunked(CHUNK):
+                            hasher.update(chunk)
+                            f.write(chunk)
+                digest = hasher.hexdigest()
+                if sha256 and digest != sha256.lower():
+                    raise ComponentsError('SonoffLAN {} sha256 is {}, expected {}'.format(version, digest, sha256))
+                os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+    except (ClientError, OSError, ValueError) as e:
+        raise ComponentsError('Could not download SonoffLAN from {}: {}'.format(url, e)) from e
+    cache.add(version, digest, latest=url.endswith('/latest'))
+    return version, path
+
+def extract_components(path, version, target=COMPONENTS):
+    '''
+    extract custom_components from release archive path to target, one file at a time (not the whole archive in memory)
+    into a temporary directory, which then replaces target, so target is never left half installed
+    '''
+    from zipfile import ZipFile, BadZipFile
+    tmp = target.rstrip('/') + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    try:
+        with ZipFile(path) as archive:
+            members = [info for info in archive.infolist() if '/custom_components/' in '/'+info.filename]
+            if not members:
+                raise ComponentsError('no custom_components in {}'.format(path))
+            for info in members:
+                name = info.filename.split('custom_components/', 1)[1]
+                dest = os.path.normpath(os.path.join(tmp, name))
+                if os.path.isabs(name) or (dest != os.path.normpath(tmp) and not dest.startswith(os.path.normpath(tmp)+os.sep)):
+                    raise ComponentsError('bad path in {}: {}'.format(path, info.filename))
+                if info.is_dir():
+                    os.makedirs(dest, exist_ok=True)
+                    continue
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                with archive.open(info) as src, open(dest, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, CHUNK)
+        with open(os.path.join(tmp, VERSION_FILE), 'w') as f:
+            f.write(version)
+        shutil.rmtree(target, ignore_errors=True)
+        os.replace(tmp, target)
+    except (BadZipFile, OSError) as e:
+        raise ComponentsError('Could not extract custom_components from {}: {}'.format(path, e)) from e
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print('Installed custom_components (SonoffLAN {}) from {}'.format(version, path))
+
+async def install_components(version=None, sha256=None, offline=False, cache=None):
+    '''
+    Install custom_components from SonoffLAN release version (latest if None) at https://github.com/AlexxIT/SonoffLAN
+    from the cache if it's there (or offline is set), downloading it if not.
+    If the latest release can't be found (eg no network), the latest version in the cache is used.
+    Raises ComponentsError if it can't be installed.
+    '''
+    cache = cache or ComponentCache()
+    print('Attempting to install custom_components')
+    path = cache.get(version, sha256) if version else None
+    if not path:
+        if offline:
+            if version or not cache.latest:
+                raise ComponentsError('SonoffLAN {} is not in the cache {}'.format(version or 'release', cache.path))
+            print('Offline: using the latest cached version')
+        else:
+            try:
+                version, path = await download_components(cache, version, sha256)
+            except ComponentsError as e:
+                if version or not cache.latest:
+                    raise
+                print('{}, using the latest cached version'.format(e))
+        if not path:
+            version = cache.latest
+            path = cache.get(version, sha256)
+            if not path:
+                raise ComponentsError('SonoffLAN {} in the cache {} is missing or corrupt'.format(version, cache.path))
+    extract_components(path, version)
+    return version
+
+def installed_version(target=COMPONENTS):
+    '''
+    SonoffLAN version of custom_components in target, '' if it was installed some other way, None if not installed
+    '''
+    if not os.path.exists(target):
+        return None
+    try:
+        with open(os.path.join(target, VERSION_FILE), 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
 def check_setup():
-    if not os.path.exists('./custom_components'):
-        import asyncio
+    '''
+    install custom_components if they are not installed, or (if they were installed by us) not the pinned SONOFFLAN_VERSION
+    exits if they can't be installed, as nothing works without them
+    '''
+    version = os.environ.get('SONOFFLAN_VERSION') or None
+    installed = installed_version()
+    if installed is not None and (not version or not installed or installed == version):
+        return
+    import asyncio, sys
+    try:
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(install_components())
-                
+        loop.run_until_complete(install_components(version, os.environ.get('SONOFFLAN_SHA256') or None,
+                                                   os.environ.get('SONOFFLAN_OFFLINE', '') not in ('', '0')))
+    except ComponentsError as e:
+        print("Error installing custom_components (SonoffLAN {}): {} - check your network connection, or the SONOFFLAN_ environment variables"
+              .format(version or 'latest', e))
+        sys.exit(1)
+
 if __name__ == "__main__":
-    check_setup()
-    
\ No newline at end of file
+    import argparse, asyncio, sys
+    parser = argparse.ArgumentParser(description='Install (or re-install) custom_components from SonoffLAN, via the cache')
+    parser.add_argument(
+        'version',
+        nargs='?',
+        default=os.environ.get('SONOFFLAN_VERSION'),
+        help='SonoffLAN release tag, eg v3.3.1 (default: latest)')
+    parser.add_argument(
+        '-s', '--sha256',
+        action='store',
+        default=os.environ.get('SONOFFLAN_SHA256'),
+        help='sha256 the release archive must have (default: the one recorded when it was first downloaded)')
+    parser.add_argument(
+        '-c', '--cache',
+        action='store',
+        default=None,
+        help='cache directory (default: $SONOFFLAN_CACHE or ~/.cache/ewelink-mqtt)')
+    parser.add_argument(
+        '-o', '--offline',
+        action='store_true',
+        default=False,
+        help='only install from the cache (default: %(default)s)')
+    arg = parser.parse_args()
+    try:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(install_components(arg.version, arg.sha256, arg.offline, ComponentCache(arg.cache)))
+    except ComponentsError as e:
+        print(e)
+        sys.exit(1)
@@ -0,0 +1,135 @@
+'''
+Import helpers for the ewelink bridge
+ImportProfiler records how long each module takes to import (like python -X importtime, but available as a
+report from the running bridge), and import_submodule() imports a module from a package without running the package's
+__init__.py files, which in SonoffLAN import the whole integration, and with it the dummy homeassistant modules.
+'''
+
+import importlib
+import importlib.util
+import sys
+import time
+
+try:
+    import resource
+except ImportError:     #not on windows
+    resource = None
+
+class _TimedLoader():
+    '''
+    wraps a module loader, to time exec_module() (which runs the module, including anything it imports)
+    '''
+
+    def __init__(self, loader, profiler):
+        self._loader = loader
+        self._profiler = profiler
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        self._profiler._exec(self._loader, module)
+
+    def __getattr__(self, attr):
+        return getattr(self._loader, attr)
+
+class ImportProfiler():
+    '''
+    Meta path finder that times every module imported while it is started.
+    Each module's cumulative time includes the modules it imports, it's own (self) time doesn't.
+    '''
+
+    def __init__(self):
+        self.modules = {}   #name: (cumulative ms, self ms)
+        self._stack = []    #time spent in modules imported by the modules being imported
+        self.rss_start = rss_kb()
+
+    def start(self):
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+        return self
+
+    def stop(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, name, path=None, target=None):
+        for finder in sys.meta_path:
+            find_spec = getattr(finder, 'find_spec', None)
+            if finder is self or find_spec is None:
+                continue
+            spec = find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+            spec.loader = _TimedLoader(spec.loader, self)
+        return spec
+
+    def _exec(self, loader, module):
+        self._stack.append(0)
+        start = time.perf_counter()
+        try:
+            loader.exec_module(module)
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            self.modules[module.__name__] = (elapsed, elapsed - children)
+
+    def report(self, top=25):
+        '''
+        returns a table of the top modules by self time, with the total import time and the resident memory used
+        '''
+        modules = sorted(self.modules.items(), key=lambda item: item[1][1], reverse=True)
+        total = sum(own for cumulative, own in self.modules.values())
+        lines = ['{:>9}  {:>9}  {}'.format('self ms', 'cumul ms', 'module')]
+        for name, (cumulative, own) in modules[:top]:
+            lines.append('{:9.1f}  {:9.1f}  {}'.format(own, cumulative, name))
+        lines.append('{:9.1f}  {:>9}  total for {} modules'.format(total, '', len(self.modules)))
+        rss = rss_kb()
+        if rss is not None:
+            lines.append('max resident memory: {:,} KB ({:,} KB at start)'.format(rss, self.rss_start or 0))
+        return '\n'.join(lines)
+
+def rss_kb():
+    '''
+    maximum resident memory of this process so far in KB, None if it can't be found
+    '''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss    #bytes on macOS, KB elsewhere
+
+def import_submodule(name):
+    '''
+    import module name (eg custom_components.sonoff.core.ewelink.cloud) without running the __init__.py of the
+    packages it's in, the packages that haven't been imported yet are added as empty modules (with their __path__ set,
+    so their submodules can be found). If the module needs something from a package __init__.py after all, the empty
+    packages are removed again, and the module is imported normally.
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    parts = name.split('.')
+    added = []
+    try:
+        for i in range(1, len(parts)):
+            package = '.'.join(parts[:i])
+            if package in sys.modules:
+                continue
+            spec = importlib.util.find_spec(package)
+            if spec is None or spec.submodule_search_locations is None:
+                raise ImportError('{} is not a package'.format(package), name=package)
+            module = sys.modules[package] = importlib.util.module_from_spec(spec)
+            if i > 1:
+                setattr(sys.modules['.'.join(parts[:i-1])], parts[i-1], module)
+            added.append(package)
+        return importlib.import_module(name)
+    except ImportError:
+        if not added:
+            raise
+        for module in [m for m in sys.modules if any(m == p or m.startswith(p+'.') for p in added)]:
+            del sys.modules[module]
+        return importlib.import_module(name)
@@ -0,0 +1,123 @@
+'''
+Logging helpers for the ewelink bridge
+LazyJson defers json formatting until a log record is actually emitted,
+DeferredQueueHandler leaves formatting log messages to the QueueListener thread (where that's safe),
+SamplingFilter limits the rate of repeated (high rate) log messages,
+set_log_level changes log levels at runtime (from an MQTT command),
+StageTimer records how long each stage of a process (eg startup) takes
+'''
+
+import contextlib
+import json
+import logging
+import time
+from logging.handlers import QueueHandler
+
+class LazyJson():
+    '''
+    Pretty JSON dump of obj, only done if the log message is emitted, use like this:
+    log.debug('received: %s', LazyJson(data))
+    '''
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj, sort_keys=True, indent=2, separators=(',', ': '), default=str)
+
+class DeferredQueueHandler(QueueHandler):
+    '''
+    QueueHandler.prepare() formats the message (and any traceback) before queueing the record, which runs on the event loop.
+    Records whose args are all immutable (str, numbers, None) are queued as they are, and formatted by the QueueListener thread,
+    records with other args (eg LazyJson of a dict, which the event loop could change before the listener gets to it)
+    are still formatted here.
+    '''
+    immutable = (str, int, float, bool, type(None))
+
+    def prepare(self, record):
+        args = record.args
+        if isinstance(args, tuple) and all(isinstance(arg, self.immutable) for arg in args):
+            return record
+        return super().prepare(record)
+
+class SamplingFilter(logging.Filter):
+    '''
+    Allows at most rate DEBUG/INFO records per second for each logger (subsystem) and message template,
+    the rest are dropped, and counted. The count is added to the next record that is allowed through.
+    Warnings and above are never dropped.
+    '''
+    max_windows = 1000  #pre-formatted messages are all different, so don't keep too many
+
+    def __init__(self, rate=10, interval=1.0):
+        super().__init__()
+        self.rate = rate
+        self.interval = interval
+        self._windows = {}  #(logger, msg): [window start, count, suppressed]
+
+    def filter(self, record):
+        if self.rate <= 0 or record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        window = self._windows.get(key)
+        if window is None and len(self._windows) >= self.max_windows:
+            self._windows = {k: w for k, w in self._windows.items() if now - w[0] < self.interval}
+        if window is None or now - window[0] >= self.interval:
+            suppressed = window[2] if window is not None else 0
+            self._windows[key] = [now, 1, 0]
+            if suppressed:
+                record.msg = '{} ({} similar messages suppressed)'.format(record.msg, suppressed)
+            return True
+        window[1] += 1
+        if window[1] <= self.rate:
+            return True
+        window[2] += 1
+        return False
+
+def set_log_level(setting, default_logger='Main'):
+    '''
+    setting is a level ("DEBUG") or a logger and level ("Main.MQTT DEBUG")
+    returns (logger name, level name), raises ValueError if the level is invalid
+    '''
+    parts = str(setting).split()
+    name = parts[0] if len(parts) > 1 else default_logger
+    level_name = parts[-1].upper() if parts else ''
+    level = logging.getLevelName(level_name)
+    if not isinstance(level, int):
+        raise ValueError('invalid log level: {}'.format(setting))
+    logging.getLogger(name).setLevel(level)
+    return name, level_name
+
+class StageTimer():
+    '''
+    Records when each named stage starts (ms from start) and how long it takes (ms), stages can overlap, use like this:
+    with timer.stage('login'):
+        await login()
+    '''
+
+    def __init__(self, start=None, log=None):
+        self._log = log
+        if self._log is None:
+            self._log = logging.getLogger('Main.'+__class__.__name__)
+        self.start = start if start is not None else time.monotonic()
+        self.stages = {}    #name: (start ms, duration ms)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        begin = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            self.stages[name] = (round((begin - self.start) * 1000, 1), round((end - begin) * 1000, 1))
+            self._log.info('%s took %sms (%sms from start)', name, self.stages[name][1], round((end - self.start) * 1000, 1))
+
+    def report(self):
+        '''
+        returns the stages (in the order they started) as a table
+        '''
+        lines = ['{:<20}{:>10}{:>10}{:>10}'.format('stage', 'start ms', 'took ms', 'end ms')]
+        for name, (begin, duration) in sorted(self.stages.items(), key=lambda stage: stage[1][0]):
+            lines.append('{:<20}{:>10}{:>10}{:>10}'.format(name, begin, duration, round(begin + duration, 1)))
+        return '\n'.join(lines)
@@ -3,26 +3,216 @@ MQTT Client library
 8/4/2022 V 1.0.0 N Waterton - Initial Release
 26/5/2022 V 1.0.1 N Waterton - Bug fixes
 14/7/2022 V 1.0.2 N Waterton - Bug fixes
+17/10/2026 V 1.1.0 N Waterton - Added optional asyncio native transport, publish pipeline, publish cache, bounded publish queue, Envelope
 '''
-import re, socket
+import re, socket, time, collections, json
 from ast import literal_eval
 import logging
 import asyncio
 
-import paho.mqtt.client as mqtt
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+import mqtt_asyncio
 
-__version__ = "1.0.2"
+__version__ = "1.1.0"
+
+class Envelope():
+    '''
+    A parsed message (dict) and it's JSON serialization, which is only done when it is first needed,
+    then reused everywhere the message is published (or logged)
+    '''
+    __slots__ = ('data', '_payload')
+    
+    def __init__(self, data):
+        self.data = data
+        self._payload = None
+        
+    @classmethod
+    def wrap(cls, data):
+        '''
+        returns data if it's already an Envelope, otherwise a new Envelope for data
+        '''
+        return data if isinstance(data, cls) else cls(data)
+        
+    @property
+    def payload(self):
+        '''
+        serialized data (utf-8 encoded JSON bytes)
+        '''
+        if self._payload is None:
+            self._payload = json.dumps(self.data).encode('utf-8')
+        return self._payload
+        
+    def __str__(self):
+        return self.payload.decode('utf-8')
+
+class OutboundQueue():
+    '''
+    Bounded queue of (topic, payload) waiting to be published.
+    policy is:
+    'block'       producers should await wait_for_space() before producing more (put() never drops, the queue can overflow maxsize)
+    'drop_oldest' the oldest message is dropped to make space
+    'latest'      only the latest payload for each topic is kept, the oldest topic is dropped to make space
+    '''
+    policies = ['block', 'drop_oldest', 'latest']
+    
+    def __init__(self, maxsize=1000, policy='drop_oldest'):
+        if policy not in self.policies:
+            raise ValueError('queue policy must be one of {}'.format(self.policies))
+        self.maxsize = maxsize
+        self.policy = policy
+        self._q = collections.OrderedDict()
+        self._seq = 0
+        self._space = asyncio.Event()
+        self._space.set()
+        self.stats = {'max_depth': 0, 'dropped': 0, 'replaced': 0, 'overflow': 0}
+        
+    def __len__(self):
+        return len(self._q)
+        
+    def put(self, topic, payload):
+        if self.policy == 'latest':
+            if topic in self._q:
+                self._q[topic] = (topic, payload)
+                self.stats['replaced'] += 1
+                return
+            key = topic
+        else:
+            self._seq += 1
+            key = self._seq
+        if len(self._q) >= self.maxsize:
+            if self.policy == 'block':
+                self.stats['overflow'] += 1
+            else:
+                self._q.popitem(last=False)
+                self.stats['dropped'] += 1
+        self._q[key] = (topic, payload)
+        if len(self._q) >= self.maxsize:
+            self._space.clear()
+        self.stats['max_depth'] = max(self.stats['max_depth'], len(self._q))
+        
+    def get(self):
+        topic, payload = self._q.popitem(last=False)[1]
+        if len(self._q) < self.maxsize:
+            self._space.set()
+        return topic, payload
+        
+    async def wait_for_space(self):
+        await self._space.wait()
+
+class PublishCache():
+    '''
+    Remembers the last message published to each (key, topic), and suppresses identical messages,
+    unless refresh seconds have passed since it was last published. refresh=0 turns suppression off.
+    Topics in exempt are always published.
+    '''
+    def __init__(self, refresh=0, exempt=()):
+        self.refresh = refresh
+        self._exempt = set(exempt)
+        self._history = {}      #key: {topic: (message, time published)}
+        self.stats = {'suppressed': 0}
+        
+    def has_changed(self, key, topic, message):
+        '''
+        returns True if message should be published (and records it), False if it is unchanged
+        '''
+        if self.refresh <= 0 or topic in self._exempt:
+            return True
+        message = str(message)
+        now = time.monotonic()
+        history = self._history.get(key)
+        if history is None:
+            history = self._history[key] = {}
+        previous = history.get(topic)
+        if previous is not None and previous[0] == message and now - previous[1] < self.refresh:
+            self.stats['suppressed'] += 1
+            return False
+        history[topic] = (message, now)
+        return True
+        
+    def clear(self, key=None):
+        '''
+        forget history for key, or everything if key is None, so the next publish is not suppressed
+        '''
+        if key is None:
+            self._history = {}
+        else:
+            self._history.pop(key, None)
+
+class PublishPipeline():
+    '''
+    Coalesces publishes for a key (eg a deviceid) for window seconds, keeping only the latest message for each topic,
+    then flushes the whole batch in one go using publish(topic, message).
+    publish() should return False if the message was not published (counted as dropped).
+    A window of 0 publishes immediately.
+    '''
+    def __init__(self, publish, window=0, loop=None):
+        self._publish = publish
+        self.window = window
+        self._loop = loop or asyncio.get_event_loop()
+        self._pending = {}      #key: {topic: message}
+        self._handles = {}      #key: TimerHandle for flush
+        self.stats = {'published': 0, 'coalesced': 0, 'dropped': 0}
+        
+    def put(self, key, topic, message):
+        if self.window <= 0:
+            self._send(topic, message)
+            return
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = {}
+            self._handles[key] = self._loop.call_later(self.window, self.flush, key)
+        if topic in batch:
+            self.stats['coalesced'] += 1
+        batch[topic] = message
+        
+    def flush(self, key=None):
+        '''
+        publish pending batch for key, or all keys if key is None
+        '''
+        for k in [key] if key is not None else list(self._pending.keys()):
+            handle = self._handles.pop(k, None)
+            if handle:
+                handle.cancel()
+            for topic, message in self._pending.pop(k, {}).items():
+                self._send(topic, message)
+                
+    def clear(self):
+        '''
+        discard everything pending
+        '''
+        for handle in self._handles.values():
+            handle.cancel()
+        self.stats['dropped'] += sum(len(batch) for batch in self._pending.values())
+        self._handles = {}
+        self._pending = {}
+        
+    @property
+    def pending(self):
+        return sum(len(batch) for batch in self._pending.values())
+                
+    def _send(self, topic, message):
+        if self._publish(topic, message) is False:
+            self.stats['dropped'] += 1
+        else:
+            self.stats['published'] += 1
 
 class MQTT():
     '''
     Async MQTT client intended to be used as a subclass
     all methods not starting with '_' can be sent as commands to MQTT topic
     feedback is published to pubtopic plus name (if given)
+    transport is 'paho' (paho-mqtt running in it's own thread) or 'asyncio' (mqtt_asyncio client running on the event loop)
+    publishes are queued (up to queue_size, see OutboundQueue for queue_policy) while the MQTT client has max_backlog messages
+    waiting to be sent to the broker
     '''
     __version__ = __version__
     invalid_commands = ['start', 'stop', 'subscribe', 'unsubscribe', '']
+    max_backlog = 100
     
-    def __init__(self, ip=None, port=1883, user=None, password=None, pubtopic='default', topic='/default/#', name=None, poll=None, json_out=False, log=None):
+    def __init__(self, ip=None, port=1883, user=None, password=None, pubtopic='default', topic='/default/#', name=None, poll=None, json_out=False, transport='paho', queue_size=1000, queue_policy='drop_oldest', log=None):
         self._log = log
         if self._log is None:
             self._log = logging.getLogger('Main.'+__class__.__name__)
@@ -33,10 +223,17 @@ class MQTT():
         self._pubtopic = pubtopic
         self._topic = topic if not topic.endswith('/#') else topic[:-2]
         self._name = name
+        self._transport = transport if mqtt is not None else 'asyncio'
         self._polling = []
         self._log.info(f'{__class__.__name__} library v{__class__.__version__}')
         self._debug = self._log.getEffectiveLevel() <= logging.DEBUG
         self._mqttc = None
+        self._out_q = OutboundQueue(queue_size, queue_policy)
+        self._sent = 0          #messages given to the MQTT client
+        self._acked = 0         #messages the MQTT client has sent to the broker (on_publish)
+        self._drain_event = asyncio.Event()
+        self._connected_event = asyncio.Event()     #set while connected to the broker, see _waitForMQTT()
+        self._drain_waiting = False
         self._method_dict = {func:getattr(self, func)  for func in dir(self) if callable(getattr(self, func)) and not func.startswith("_")}
         if poll:
             self._poll = poll[0]
@@ -64,12 +261,16 @@ class MQTT():
         if self._MQTT_connected: return
         try:
             # connect to broker
-            self._log.info('Connecting to MQTT broker: {}'.format(self._broker))
-            self._mqttc = mqtt.Client()
+            self._log.info('Connecting to MQTT broker: {} using {} transport'.format(self._broker, self._transport))
+            if self._transport == 'asyncio':
+                self._mqttc = mqtt_asyncio.Client(loop=self._loop, log=self._log)
+            else:
+                self._mqttc = mqtt.Client()
             # Assign event callbacks
             self._mqttc.on_message = self._on_message
-            self._mqttc.on_connect = self._on_connect
-            self._mqttc.on_disconnect = self._on_disconnect
+            self._mqttc.on_connect = self._on_mqtt_connect
+            self._mqttc.on_disconnect = self._on_mqtt_disconnect
+            self._mqttc.on_publish = self._on_publish
             if self._user and self._password:
                 self._mqttc.username_pw_set(self._user, self._password)
             self._mqttc.will_set(self._get_pubtopic('status'), payload="Offline", qos=0, retain=False)
@@ -108,29 +309,87 @@ class MQTT():
         returns false if not broker defined
         '''
         if not self._broker: return False
-        timeout = timeout if timeout else 1000000
-        count = 0
-        while not self._MQTT_connected and count < timeout:
-            await asyncio.sleep(1)
-            count += 1
+        try:
+            await asyncio.wait_for(self._connected_event.wait(), timeout or None)
+        except asyncio.TimeoutError:
+            pass
         return self._MQTT_connected
         
+    def _on_mqtt_connect(self, client, userdata, flags, rc):
+        '''
+        MQTT client on_connect callback, calls _on_connect() (which subclasses override), then wakes _waitForMQTT()
+        '''
+        self._on_connect(client, userdata, flags, rc)
+        if rc == 0:
+            self._signal(self._connected_event.set)
+        
+    def _on_mqtt_disconnect(self, mosq, obj, rc):
+        self._signal(self._connected_event.clear)
+        self._on_disconnect(mosq, obj, rc)
+        
     def _on_connect(self, client, userdata, flags, rc):
         self._log.info('MQTT broker connected')
         self.subscribe('{}/all/#'.format(self._topic))
         if self._name:
             self.subscribe('{}/{}/#'.format(self._topic, self._name))
         self._history = {}
+        self._reset_backlog()
+        
+    def _reset_backlog(self):
+        '''
+        messages pending when the connection was lost are never going to be sent, so reset the backlog count and restart draining the queue
+        '''
+        self._acked = self._sent
+        self._wake_drain()
+        
+    def _on_publish(self, client, userdata, mid):
+        self._acked = min(self._acked + 1, self._sent)  #acks for messages sent before a _reset_backlog can arrive after it
+        if self._drain_waiting and self._backlog < self.max_backlog:
+            self._wake_drain()
+            
+    def _wake_drain(self):
+        self._signal(self._drain_event.set)
+            
+    def _signal(self, func):
+        '''
+        call func (eg an Event's set()) on the event loop, from an MQTT client callback
+        '''
+        if self._transport == 'asyncio':
+            func()
+        else:
+            self._loop.call_soon_threadsafe(func)   #paho callbacks are in the paho thread
+            
+    @property
+    def _backlog(self):
+        '''
+        number of messages given to the MQTT client, but not sent to the broker yet
+        '''
+        return self._sent - self._acked
+        
+    def _publish_stats(self):
+        stats = {'queue_depth': len(self._out_q), 'backlog': self._backlog}
+        stats.update(self._out_q.stats)
+        return stats
+        
+    async def _wait_for_publish_space(self):
+        '''
+        for 'block' queue policy, producers wait here until there is space in the publish queue
+        '''
+        if self._out_q.policy == 'block':
+            await self._out_q.wait_for_space()
         
     def _on_disconnect(self, mosq, obj, rc):
         self._log.warning('MQTT broker disconnected')
-        if rc != 0:
+        if rc != 0 and not getattr(self._mqttc, 'auto_reconnect', False):
             self._log.info('Reconnecting...')
             self._connect_client()
         
     def _on_message(self, mosq, obj, msg):
         #self._log.info(msg.topic + " " + str(msg.qos) + " " + str(msg.payload))
-        asyncio.run_coroutine_threadsafe(self._q.put(msg), self._loop)    #mqtt client is running in a different thread
+        if self._transport == 'asyncio':
+            self._q.put_nowait(msg)     #already on the event loop
+        else:
+            asyncio.run_coroutine_threadsafe(self._q.put(msg), self._loop)    #mqtt client is running in a different thread
         
     def _get_pubtopic(self, topic=None):
         pubtopic = self._pubtopic
@@ -141,27 +400,77 @@ class MQTT():
         return pubtopic
             
     def _publish(self, topic=None, message=None):
+        '''
+        publish message to topic (under pubtopic), returns True if published, False if not
+        '''
         if topic is None and message is None:
-            self._log.debug(f'Not pubishing: {topic}: {message}')
-            return
+            self._log.debug('Not pubishing: %s: %s', topic, message)
+            return False
         try:
             if self._MQTT_connected:
                 
                 pubtopic = self._get_pubtopic(topic)
-                self._log.info("publishing item: {}: {}".format(pubtopic, message))
-                self._mqttc.publish(pubtopic, str(message))
+                self._log.debug("publishing item: %s: %s", pubtopic, message)
+                if len(self._out_q) or self._backlog >= self.max_backlog:
+                    #broker is not keeping up, queue message
+                    self._out_q.put(pubtopic, self._payload(message))
+                    if '_drain_q' not in self._tasks:
+                        self._tasks['_drain_q'] = self._loop.create_task(self._drain_q())
+                else:
+                    self._send(pubtopic, self._payload(message))
+                return True
             else:
-                self._log.warning(f'MQTT not connected - not publishing {topic}: {message}')
+                self._log.warning('MQTT not connected - not publishing %s: %s', topic, message)
+        except Exception as e:
+            self._log.exception(e)
+        return False
+            
+    @staticmethod
+    def _payload(message):
+        '''
+        MQTT payload for message, Envelopes are serialized once (and the bytes reused), bytes are sent as is
+        '''
+        if isinstance(message, Envelope):
+            return message.payload
+        if isinstance(message, (bytes, bytearray)):
+            return message
+        return str(message)
+            
+    def _send(self, pubtopic, payload):
+        self._sent += 1
+        self._mqttc.publish(pubtopic, payload)
+        
+    async def _drain_q(self):
+        '''
+        publish queued messages as the MQTT client backlog allows, exits when the queue is empty
+        '''
+        try:
+            while len(self._out_q):
+                if not self._MQTT_connected or self._backlog >= self.max_backlog:
+                    self._drain_event.clear()
+                    self._drain_waiting = True
+                    if not self._MQTT_connected or self._backlog >= self.max_backlog:
+                        await self._drain_event.wait()
+                    self._drain_waiting = False
+                    continue
+                self._send(*self._out_q.get())
+        except asyncio.CancelledError:
+            pass
         except Exception as e:
             self._log.exception(e)
+        self._tasks.pop('_drain_q', None)
             
     async def _poll_status(self):
         '''
         publishes commands in self._polling every self._poll seconds
+        polls start every self._poll seconds (not self._poll seconds after the last one finished), if a poll takes
+        longer than that, the next one starts as soon as it finishes
         '''
         try:
+            next_poll = self._loop.time() + self._poll
             while not self._exit:
-                await asyncio.sleep(self._poll)
+                await asyncio.sleep(max(0, next_poll - self._loop.time()))
+                next_poll = max(next_poll + self._poll, self._loop.time())
                 self._log.info('Polling...')
                 for cmd in self._polling:
                     if cmd in self._method_dict.keys():
@@ -172,6 +481,8 @@ class MQTT():
                             self._decode_topics(result)
                     else:
                         self._log.warning('Polling command: {cmd} not found')
+                if self._loop.time() > next_poll:
+                    self._log.warning('Polling took longer than the poll interval ({}s)'.format(self._poll))
         except asyncio.CancelledError:
             pass
         self._log.info('Poll loop exited')
@@ -224,7 +535,7 @@ class MQTT():
         while not self._exit:
             try:
                 if self._q.qsize() > 0 and self._debug:
-                    self._log.warning('Pending event queue size is: {}'.format(self._q.qsize()))
+                    self._log.warning('Pending event queue size is: %s', self._q.qsize())
                 msg = await self._q.get()
                 
                 command, args = self._get_command(msg)
@@ -320,7 +631,7 @@ class MQTT():
         self._log.info("Cancelling {} outstanding tasks".format(len(tasks)))
         await asyncio.gather(*tasks, return_exceptions=True)
         self._tasks = {}
-        if self._MQTT_connected:
+        if self._mqttc is not None:    #even if not connected, the client may be trying to reconnect
             self._mqttc.disconnect()
             self._mqttc.loop_stop()
             self._mqttc = None
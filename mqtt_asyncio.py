@@ -0,0 +1,392 @@
+'''
+Asyncio native MQTT 3.1.1 client
+Implements the subset of the paho-mqtt Client interface used by mqtt.MQTT, but runs entirely on the asyncio event loop,
+so callbacks are called on the loop thread, and publishing writes straight to the transport (no thread hops).
+Supports QoS 0 and 1 publishing (QoS 1 messages are not re-sent after a reconnect), and receiving QoS 0, 1 and 2.
+Reconnects automatically (with backoff) if the connection to the broker is lost, or nothing (not even a PINGRESP) has been
+received from the broker for 1.5 times the keepalive interval.
+N Waterton - based on the MQTT V3.1.1 OASIS standard http://docs.oasis-open.org/mqtt/mqtt/v3.1.1/os/mqtt-v3.1.1-os.html
+'''
+import asyncio
+import logging
+import os
+import struct
+
+__version__ = "1.0.0"
+
+CONNECT     = 0x10
+CONNACK     = 0x20
+PUBLISH     = 0x30
+PUBACK      = 0x40
+PUBREC      = 0x50
+PUBREL      = 0x60
+PUBCOMP     = 0x70
+SUBSCRIBE   = 0x80
+SUBACK      = 0x90
+UNSUBSCRIBE = 0xA0
+UNSUBACK    = 0xB0
+PINGREQ     = 0xC0
+PINGRESP    = 0xD0
+DISCONNECT  = 0xE0
+
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
+
+RETRY_DELAYS = [1, 2, 5, 10, 30, 60]
+WRITE_HIGH_WATER = 64 * 1024  #transport buffer size above which on_publish is delayed until the buffer drains
+
+class MQTTMessage():
+    '''
+    Received message, same attributes as paho MQTTMessage
+    '''
+    __slots__ = ('topic', 'payload', 'qos', 'retain', 'mid')
+
+    def __init__(self, topic, payload, qos=0, retain=False, mid=0):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.mid = mid
+
+class MQTTMessageInfo():
+    '''
+    returned by publish(), same as paho MQTTMessageInfo (rc and mid)
+    '''
+    __slots__ = ('rc', 'mid')
+
+    def __init__(self, rc, mid):
+        self.rc = rc
+        self.mid = mid
+
+    def is_published(self):
+        return self.rc == MQTT_ERR_SUCCESS
+
+def _encode_str(s):
+    if isinstance(s, str):
+        s = s.encode('utf-8')
+    return struct.pack('!H', len(s)) + s
+
+def _encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        encoded.append(byte)
+        if length == 0:
+            return bytes(encoded)
+
+def _packet(header, body=b''):
+    return bytes((header,)) + _encode_length(len(body)) + body
+
+class Client():
+    '''
+    asyncio MQTT client with paho style interface
+    callbacks are on_connect(client, userdata, flags, rc), on_disconnect(client, userdata, rc) and
+    on_message(client, userdata, msg), and are called on the event loop thread
+    '''
+    __version__ = __version__
+    auto_reconnect = True   #reconnects itself, so MQTT class does not need to create a new client
+
+    def __init__(self, client_id='', clean_session=True, userdata=None, loop=None, log=None):
+        self._log = log
+        if self._log is None:
+            self._log = logging.getLogger('Main.'+__name__)
+        self._client_id = client_id or 'ewelink-{}'.format(os.urandom(4).hex())
+        self._clean_session = clean_session
+        self._userdata = userdata
+        self._loop = loop or asyncio.get_event_loop()
+        self._host = None
+        self._port = 1883
+        self._keepalive = 60
+        self._username = None
+        self._password = None
+        self._will = None
+        self._reader = None
+        self._writer = None
+        self._connected = False
+        self._stop = False
+        self._mid = 0
+        self._subscriptions = {}
+        self._task = None
+        self._ping_task = None
+        self._drain_task = None
+        self._unacked = []      #mids waiting for transport to drain before on_publish
+        self._inflight = set()  #mids of QoS 1 messages waiting for PUBACK before on_publish
+        self._last_received = 0 #loop time the last packet was received from the broker
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+
+    def username_pw_set(self, username, password=None):
+        self._username = username
+        self._password = password
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        self._will = (topic, self._to_bytes(payload), qos, retain)
+
+    def is_connected(self):
+        return self._connected
+
+    def connect(self, host, port=1883, keepalive=60):
+        '''
+        start connection to broker, connection is made (and remade) in the background
+        '''
+        self._host = host
+        self._port = port
+        self._keepalive = keepalive
+        self._stop = False
+        if self._task is None or self._task.done():
+            self._task = self._loop.create_task(self._run())
+        return MQTT_ERR_SUCCESS
+
+    def loop_start(self):
+        '''
+        Nothing to do, the client runs on the asyncio loop
+        '''
+        return MQTT_ERR_SUCCESS
+
+    def loop_stop(self, force=False):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        return MQTT_ERR_SUCCESS
+
+    def disconnect(self):
+        self._stop = True
+        was_connected = self._connected
+        if was_connected:
+            self._write(_packet(DISCONNECT))
+        self._close()
+        if was_connected and self.on_disconnect:
+            self.on_disconnect(self, self._userdata, 0)
+        return MQTT_ERR_SUCCESS
+
+    def want_write(self):
+        '''
+        True if the transport has a backlog of data waiting to be sent
+        '''
+        if self._writer is None:
+            return False
+        return self._writer.transport.get_write_buffer_size() > 0
+
+    def subscribe(self, topic, qos=0):
+        self._subscriptions[topic] = qos
+        if not self._connected:
+            return (MQTT_ERR_NO_CONN, None)
+        mid = self._next_mid()
+        self._write(_packet(SUBSCRIBE | 0x02, struct.pack('!H', mid) + _encode_str(topic) + bytes((qos,))))
+        return (MQTT_ERR_SUCCESS, mid)
+
+    def unsubscribe(self, topic):
+        self._subscriptions.pop(topic, None)
+        if not self._connected:
+            return (MQTT_ERR_NO_CONN, None)
+        mid = self._next_mid()
+        self._write(_packet(UNSUBSCRIBE | 0x02, struct.pack('!H', mid) + _encode_str(topic)))
+        return (MQTT_ERR_SUCCESS, mid)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if not self._connected:
+            return MQTTMessageInfo(MQTT_ERR_NO_CONN, 0)
+        mid = 0
+        body = _encode_str(topic)
+        if qos > 0:
+            mid = self._next_mid()
+            body += struct.pack('!H', mid)
+        self._write(_packet(PUBLISH | (min(qos, 1) << 1) | (1 if retain else 0), body + self._to_bytes(payload)))
+        if qos > 0:
+            self._inflight.add(mid)     #on_publish is called when the broker acknowledges it (PUBACK)
+        elif self.on_publish:
+            if self._unacked or self._writer.transport.get_write_buffer_size() > WRITE_HIGH_WATER:
+                #broker is not keeping up, call on_publish when the transport has drained
+                self._unacked.append(mid)
+                if self._drain_task is None:
+                    self._drain_task = self._loop.create_task(self._drain())
+            else:
+                self.on_publish(self, self._userdata, mid)
+        return MQTTMessageInfo(MQTT_ERR_SUCCESS, mid)
+        
+    async def _drain(self):
+        try:
+            while self._unacked and self._writer is not None:
+                await self._writer.drain()
+                unacked, self._unacked = self._unacked, []
+                for mid in unacked:
+                    self.on_publish(self, self._userdata, mid)
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            self._drain_task = None
+
+    def _to_bytes(self, payload):
+        if payload is None:
+            return b''
+        if isinstance(payload, (bytes, bytearray)):
+            return bytes(payload)
+        if isinstance(payload, str):
+            return payload.encode('utf-8')
+        if isinstance(payload, (int, float)):
+            return str(payload).encode('ascii')
+        return bytes(payload)
+
+    def _next_mid(self):
+        self._mid = self._mid % 65535 + 1
+        return self._mid
+
+    def _write(self, data):
+        if self._writer is not None:
+            self._writer.write(data)
+
+    def _close(self):
+        if self._ping_task:
+            self._ping_task.cancel()
+            self._ping_task = None
+        if self._drain_task:
+            self._drain_task.cancel()
+            self._drain_task = None
+        self._unacked = []
+        self._inflight.clear()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._reader = None
+        self._connected = False
+
+    async def _run(self):
+        '''
+        connect, read packets until the connection drops, then reconnect (unless disconnect() was called)
+        '''
+        fails = 0
+        try:
+            while not self._stop:
+                rc = 1
+                try:
+                    await self._connect()
+                    fails = 0
+                    await self._read_loop()
+                    rc = 0 if self._stop else 1
+                except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError) as e:
+                    self._log.warning('MQTT connection error: {}'.format(e))
+                was_connected = self._connected
+                self._close()
+                if was_connected and self.on_disconnect:
+                    self.on_disconnect(self, self._userdata, rc)
+                if self._stop:
+                    break
+                delay = RETRY_DELAYS[min(fails, len(RETRY_DELAYS)-1)]
+                fails += 1
+                self._log.info('MQTT reconnecting in {}s'.format(delay))
+                await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self._close()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self._host, self._port), 30)
+        flags = 0x02 if self._clean_session else 0
+        payload = _encode_str(self._client_id)
+        if self._will:
+            topic, will_payload, qos, retain = self._will
+            flags |= 0x04 | (qos << 3) | (0x20 if retain else 0)
+            payload += _encode_str(topic) + _encode_str(will_payload)
+        if self._username is not None:
+            flags |= 0x80
+            payload += _encode_str(self._username)
+            if self._password is not None:
+                flags |= 0x40
+                payload += _encode_str(self._password)
+        self._write(_packet(CONNECT, _encode_str('MQTT') + bytes((4, flags)) + struct.pack('!H', self._keepalive) + payload))
+        header, body = await asyncio.wait_for(self._read_packet(), self._keepalive or 60)
+        if header & 0xF0 != CONNACK or len(body) < 2:
+            raise ConnectionError('unexpected reply to CONNECT: {}'.format(header))
+        rc = body[1]
+        if rc != 0:
+            if self.on_connect:
+                self.on_connect(self, self._userdata, {'session present': 0}, rc)
+            raise ConnectionError('connection refused, rc: {}'.format(rc))
+        self._connected = True
+        self._last_received = self._loop.time()
+        if self._keepalive:
+            self._ping_task = self._loop.create_task(self._ping())
+        for topic, qos in self._subscriptions.items():  #resubscribe after a reconnect
+            mid = self._next_mid()
+            self._write(_packet(SUBSCRIBE | 0x02, struct.pack('!H', mid) + _encode_str(topic) + bytes((qos,))))
+        if self.on_connect:
+            self.on_connect(self, self._userdata, {'session present': body[0] & 0x01}, rc)
+
+    async def _ping(self):
+        '''
+        send PINGREQ every keepalive/2 seconds, and drop the connection (so it's remade) if nothing has been received from
+        the broker for 1.5 * keepalive seconds, as a half open connection would never be noticed otherwise
+        '''
+        try:
+            while True:
+                await asyncio.sleep(self._keepalive / 2)
+                if not self._connected:
+                    break
+                silent = self._loop.time() - self._last_received
+                if silent > self._keepalive * 1.5:
+                    self._log.warning('MQTT nothing received from broker for {:.0f}s, reconnecting'.format(silent))
+                    self._writer.transport.abort()  #the read loop gets end of file, and _run() reconnects
+                    break
+                self._write(_packet(PINGREQ))
+        except asyncio.CancelledError:
+            pass
+
+    async def _read_packet(self):
+        header = (await self._reader.readexactly(1))[0]
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await self._reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        body = await self._reader.readexactly(length) if length else b''
+        return header, body
+
+    async def _read_loop(self):
+        while self._connected:
+            header, body = await self._read_packet()
+            self._last_received = self._loop.time()
+            packet_type = header & 0xF0
+            if packet_type == PUBLISH:
+                self._handle_publish(header, body)
+            elif packet_type == PUBACK:
+                self._handle_puback(body)
+            elif packet_type == PUBREL:
+                self._write(_packet(PUBCOMP, body[:2]))
+            elif packet_type in (SUBACK, UNSUBACK, PINGRESP, PUBCOMP):
+                pass
+            else:
+                self._log.debug('MQTT ignoring packet type: {}'.format(packet_type >> 4))
+
+    def _handle_puback(self, body):
+        (mid,) = struct.unpack('!H', body[:2])
+        if mid in self._inflight:
+            self._inflight.discard(mid)
+            if self.on_publish:
+                self.on_publish(self, self._userdata, mid)
+
+    def _handle_publish(self, header, body):
+        qos = (header >> 1) & 0x03
+        (topic_len,) = struct.unpack('!H', body[:2])
+        topic = body[2:2+topic_len].decode('utf-8')
+        pos = 2 + topic_len
+        mid = 0
+        if qos > 0:
+            (mid,) = struct.unpack('!H', body[pos:pos+2])
+            pos += 2
+        msg = MQTTMessage(topic, body[pos:], qos, bool(header & 0x01), mid)
+        if qos == 1:
+            self._write(_packet(PUBACK, struct.pack('!H', mid)))
+        elif qos == 2:
+            self._write(_packet(PUBREC, struct.pack('!H', mid)))
+        if self.on_message:
+            try:
+                self.on_message(self, self._userdata, msg)
+            except Exception as e:
+                self._log.exception(e)
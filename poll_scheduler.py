@@ -0,0 +1,134 @@
+'''
+Poll scheduler for the ewelink bridge
+Keeps the time each polled device is next due to be polled in a heap, so the bridge only wakes up when a device is due.
+A device that sends an update by itself doesn't need polling, so every update pushes it's next poll back, and the
+interval between polls adapts to how often polls find something the device didn't tell us about.
+'''
+
+import asyncio
+import heapq
+import random
+import time
+
+class _Entry():
+    __slots__ = ('due', 'interval', 'min_interval', 'max_interval', 'polling')
+
+    def __init__(self, due, min_interval, max_interval):
+        self.due = due
+        self.interval = min_interval
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.polling = False
+
+class PollScheduler():
+    '''
+    Each device is polled interval seconds after it was last polled or last sent an update (seen()),
+    interval starts at min_interval, halves (down to min_interval) when a poll finds changed params,
+    and doubles (up to max_interval) when it doesn't. If min_interval == max_interval, the interval is fixed.
+    New devices are first due after min_interval, plus a random delay of up to jitter seconds.
+    '''
+
+    def __init__(self, jitter=0):
+        self.jitter = jitter
+        self._entries = {}      #deviceid: _Entry
+        self._heap = []         #(due, deviceid), entries that no longer match the _Entry are skipped
+        self._changed = asyncio.Event()
+        self.stats = {'polled': 0, 'deferred': 0, 'changed': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, deviceid):
+        return deviceid in self._entries
+
+    def add(self, deviceid, min_interval, max_interval=0):
+        '''
+        schedule deviceid to be polled every min_interval to max_interval seconds (if it's already scheduled, just update the intervals)
+        '''
+        entry = self._entries.get(deviceid)
+        if entry is not None:
+            entry.min_interval = min_interval
+            entry.max_interval = max(min_interval, max_interval)
+            entry.interval = min(max(entry.interval, entry.min_interval), entry.max_interval)
+            return
+        due = time.monotonic() + min_interval + random.uniform(0, min(self.jitter, min_interval))
+        entry = self._entries[deviceid] = _Entry(due, min_interval, max_interval)
+        self._push(deviceid, entry)
+
+    def remove(self, deviceid):
+        self._entries.pop(deviceid, None)
+
+    def seen(self, deviceid):
+        '''
+        deviceid sent an update, so it doesn't need polling for another interval
+        '''
+        entry = self._entries.get(deviceid)
+        if entry is not None and not entry.polling:
+            entry.due = time.monotonic() + entry.interval
+            self.stats['deferred'] += 1
+            self._push(deviceid, entry, wake=False)   #later than before, nothing to wake up for
+
+    def polled(self, deviceid, changed=False):
+        '''
+        deviceid has been polled, changed is True if the poll found params that changed without an update
+        '''
+        entry = self._entries.get(deviceid)
+        if entry is None:
+            return
+        self.stats['polled'] += 1
+        if changed:
+            self.stats['changed'] += 1
+            entry.interval = max(entry.min_interval, entry.interval / 2)
+        else:
+            entry.interval = min(entry.max_interval, entry.interval * 2)
+        entry.polling = False
+        entry.due = time.monotonic() + entry.interval
+        self._push(deviceid, entry)
+
+    def _push(self, deviceid, entry, wake=True):
+        heapq.heappush(self._heap, (entry.due, deviceid))
+        if len(self._heap) > 4 * len(self._entries) + 64:  #lots of updates have left stale entries behind
+            self._heap = [(e.due, d) for d, e in self._entries.items() if not e.polling]
+            heapq.heapify(self._heap)
+        if wake:
+            self._changed.set()
+
+    def due(self):
+        '''
+        returns list of deviceids that are due to be polled now, they are not due again until polled() is called
+        '''
+        now = time.monotonic()
+        deviceids = []
+        while self._heap and self._heap[0][0] <= now:
+            due, deviceid = heapq.heappop(self._heap)
+            entry = self._entries.get(deviceid)
+            if entry is None or entry.polling or entry.due != due:     #stale
+                continue
+            entry.polling = True
+            deviceids.append(deviceid)
+        return deviceids
+
+    def next_due(self):
+        '''
+        seconds until the next device is due (0 if one is due now), None if there is nothing to poll
+        '''
+        while self._heap:
+            due, deviceid = self._heap[0]
+            entry = self._entries.get(deviceid)
+            if entry is not None and not entry.polling and entry.due == due:
+                return max(0, due - time.monotonic())
+            heapq.heappop(self._heap)
+        return None
+
+    async def wait(self):
+        '''
+        wait until a device is due (or the schedule changes)
+        '''
+        self._changed.clear()
+        delay = self.next_due()
+        if delay == 0:
+            return
+        try:
+            await asyncio.wait_for(self._changed.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,153 @@
+'''
+In-flight request tracker for the ewelink bridge
+Records every command sent to the cloud by sequence id, with the time it was sent, when the
+cloud acknowledged it, and the outcome, and keeps per device latency histograms.
+'''
+
+import bisect
+import collections
+import logging
+import time
+
+class LatencyHistogram():
+    '''
+    Counts of latencies (ms) in buckets with upper bounds of bounds (the last bucket has no upper bound)
+    '''
+    __slots__ = ('counts', 'count', 'total', 'max')
+    bounds = (50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def as_dict(self):
+        buckets = {'<={}'.format(bound): count for bound, count in zip(self.bounds, self.counts)}
+        buckets['>{}'.format(self.bounds[-1])] = self.counts[-1]
+        return {'count'  : self.count,
+                'mean_ms': round(self.total / self.count, 1) if self.count else None,
+                'max_ms' : round(self.max, 1),
+                'buckets': buckets}
+
+class InFlightTracker():
+    '''
+    Table of commands sent to the cloud that have not been acknowledged yet, keyed by sequence id.
+    Outcomes are "online" (ok), "timeout" (the cloud says the device did not respond), "E#<error>" (counted as error)
+    or no_response (the cloud never acknowledged the command within expire seconds, or before the connection closed).
+    At most max_inflight requests are kept, the oldest are dropped (as no_response) to make room.
+    Completed requests are kept in recent (the last 100) as dictionaries.
+    '''
+
+    def __init__(self, expire=30, max_inflight=10000, log=None):
+        self._log = log
+        if self._log is None:
+            self._log = logging.getLogger('Main.'+__class__.__name__)
+        self.expire = expire
+        self.max_inflight = max_inflight
+        self._inflight = collections.OrderedDict()  #sequence: (deviceid, params, sent time, attempt)
+        self._latency = {}                          #deviceid: LatencyHistogram
+        self.recent = collections.deque(maxlen=100)
+        self.stats = {'sent': 0, 'online': 0, 'timeout': 0, 'error': 0, 'no_response': 0, 'retries': 0}
+
+    def __len__(self):
+        return len(self._inflight)
+
+    @staticmethod
+    def outcome(error):
+        '''
+        the same result strings as XRegistryCloud.send() returns for a cloud error code
+        '''
+        return {0: 'online', 504: 'timeout'}.get(error, 'E#{}'.format(error))
+
+    @staticmethod
+    def failed(result):
+        '''
+        True if result is an error or timeout, not if the device replied that it's offline (E#503), or nothing was waited for (None)
+        '''
+        return result not in ['online', 'E#503', None]
+
+    def sent(self, sequence, deviceid, params=None, attempt=0):
+        self._expire()
+        while len(self._inflight) >= self.max_inflight:
+            self._complete(*self._inflight.popitem(last=False), 'no_response')
+        self._inflight[sequence] = (deviceid, params, time.monotonic(), attempt)
+        self.stats['sent'] += 1
+        if attempt:
+            self.stats['retries'] += 1
+
+    def ack(self, sequence, result):
+        '''
+        record the cloud response to sequence, result is an outcome string
+        returns False if sequence is not in flight
+        '''
+        request = self._inflight.pop(sequence, None)
+        if request is None:
+            return False
+        deviceid, params, sent, attempt = request
+        latency = (time.monotonic() - sent) * 1000
+        self._latency.setdefault(deviceid, LatencyHistogram()).add(latency)
+        self._complete(sequence, request, result, latency)
+        return True
+
+    def done(self, sequence, result):
+        '''
+        send() has returned result for sequence, if the cloud hasn't acknowledged it, there was no response
+        '''
+        request = self._inflight.pop(sequence, None)
+        if request is not None:
+            self._complete(sequence, request, 'no_response' if result in [None, 'timeout'] else result)
+
+    def drop(self, deviceid=None):
+        '''
+        the cloud connection has closed (or deviceid has been removed), so requests in flight (to deviceid) will never be
+        acknowledged, they are completed as no_response
+        '''
+        for sequence, request in list(self._inflight.items()):
+            if deviceid is None or request[0] == deviceid:
+                del self._inflight[sequence]
+                self._complete(sequence, request, 'no_response')
+
+    def forget(self, deviceid):
+        '''
+        drop the requests in flight to, and latency histogram of, deviceid (a device that has been removed)
+        '''
+        self.drop(deviceid)
+        self._latency.pop(deviceid, None)
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._inflight:
+            sequence, request = next(iter(self._inflight.items()))
+            if now - request[2] < self.expire:
+                break
+            del self._inflight[sequence]
+            self._complete(sequence, request, 'no_response')
+
+    def _complete(self, sequence, request, result, latency=None):
+        deviceid, params, sent, attempt = request
+        if result in ['online', 'timeout', 'no_response']:
+            self.stats[result] += 1
+        else:
+            self.stats['error'] += 1
+        if result != 'online':
+            self._log.debug('request %s to %s: %s (attempt %s)', sequence, deviceid, result, attempt + 1)
+        self.recent.append({'sequence': sequence,
+                            'deviceid': deviceid,
+                            'params'  : params,
+                            'attempt' : attempt + 1,
+                            'sent'    : time.time() - (time.monotonic() - sent),  #wall clock time
+                            'latency' : round(latency, 1) if latency is not None else None,
+                            'outcome' : result})
+
+    def latency(self):
+        '''
+        returns dictionary of deviceid: latency histogram (dict)
+        '''
+        return {deviceid: histogram.as_dict() for deviceid, histogram in self._latency.items()}
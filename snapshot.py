@@ -0,0 +1,65 @@
+'''
+Snapshot file for the ewelink bridge
+Saves the device list (with each device's last known params) and the auth token, so that on the next start the bridge
+can publish the last known state, and accept commands, before it has logged in and fetched the device list from the cloud.
+'''
+
+import json
+import logging
+import os
+import time
+
+class Snapshot():
+    '''
+    json snapshot file at path, written atomically (to a temporary file, which then replaces the old one), and only
+    readable by the owner, as it contains the auth token. An empty path turns snapshots off.
+    '''
+    version = 1
+
+    def __init__(self, path, log=None):
+        self._log = log
+        if self._log is None:
+            self._log = logging.getLogger('Main.'+__class__.__name__)
+        self.path = path
+        self.saved = 0      #time of last save
+
+    def load(self):
+        '''
+        returns the snapshot dictionary, or None if there isn't a (valid) one
+        '''
+        if not self.path:
+            return None
+        try:
+            with open(self.path, 'r') as f:
+                snapshot = json.load(f)
+            if snapshot.get('version') != self.version:
+                raise ValueError('snapshot version {} is not {}'.format(snapshot.get('version'), self.version))
+            self._log.debug('loaded snapshot from %s, saved at %s: %s devices', self.path,
+                            time.ctime(snapshot.get('saved', 0)), len(snapshot.get('devices', [])))
+            return snapshot
+        except FileNotFoundError:
+            return None
+        except (ValueError, AttributeError, OSError) as e:
+            self._log.warning('Unable to load snapshot %s: %s', self.path, e)
+            return None
+
+    def save(self, devices, auth=None):
+        '''
+        save the device list (list of device dictionaries) and auth (dictionary of login, region, at, appid)
+        '''
+        if not self.path:
+            return
+        snapshot = {'version': self.version,
+                    'saved'  : time.time(),
+                    'auth'   : auth,
+                    'devices': devices}
+        tmp = self.path + '.tmp'
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f, separators=(',', ':'))
+            os.replace(tmp, self.path)
+            self.saved = snapshot['saved']
+            self._log.debug('saved snapshot to %s: %s devices', self.path, len(devices))
+        except (TypeError, ValueError, OSError) as e:
+            self._log.warning('Unable to save snapshot %s: %s', self.path, e)
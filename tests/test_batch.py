@@ -0,0 +1,98 @@
+'''
+Batches: all the commands are checked before any are sent, and the results are published in one message
+'''
+
+import argparse
+import asyncio
+import json
+import types
+
+import pytest
+
+pytestmark = pytest.mark.cloud
+
+@pytest.fixture
+def ewelink():
+    import ewelink
+    ewelink.arg = argparse.Namespace(poll_interval=0, appid=0, oauth=False, startup_report=False)
+    return ewelink
+
+def device(deviceid, name):
+    return {'deviceid': deviceid, 'name': name, 'productModel': 'Basic', 'apikey': 'key', 'params': {'switch': 'off'}}
+
+def make_client(ewelink):
+    class TestClient(ewelink.EwelinkClient):
+        async def send(self, device, params=None, sequence=None, timeout=5):
+            self.sent.append((device['deviceid'], params))
+
+        def _publish(self, deviceid, topic, message):
+            self.published.append((deviceid, topic, message))
+            super()._publish(deviceid, topic, message)
+
+    client = TestClient(None, None, command_rate=0)
+    ewelink.XRegistryCloud.__init__(client, None)
+    client.sent = []
+    client.published = []
+    client._devices = [device('d1', 'Light'), device('d2', 'Fan'), device('d3', 'Heater')]
+    client._create_client_devices()
+    client.set_online(True)
+    return client
+
+def published(client):
+    return [json.loads(message) for deviceid, topic, message in client.published if deviceid == 'client' and topic == 'batch']
+
+async def test_valid_batch(ewelink):
+    client = make_client(ewelink)
+    try:
+        result = await client.batch_command({'id': 'evening', 'commands': [
+            {'device': 'Light', 'command': 'set_switch', 'value': 'on'},
+            {'device': 'd2', 'command': 'set_switch', 'value': 'off'},
+            {'device': 'light', 'command': 'set_led', 'value': 'off'}]})
+        assert [params for deviceid, params in client.sent if deviceid == 'd1'] == [{'switch': 'on'}, {'sledOnline': 'off'}]  #in order
+        assert [params for deviceid, params in client.sent if deviceid == 'd2'] == [{'switch': 'off'}]
+        assert result['id'] == 'evening' and result['entries'] == 3 and result['ok'] == 3 and result['failed'] == 0
+        assert [(entry['device'], entry['command'], entry['value'], entry['status']) for entry in result['results']] == [
+            ('d1', 'set_switch', 'on', 'sent'), ('d2', 'set_switch', 'off', 'sent'), ('d1', 'set_led', 'off', 'sent')]
+        assert all(entry['latency_ms'] >= 0 for entry in result['results'])
+        assert published(client) == [result]
+    finally:
+        await client._stop()
+
+@pytest.mark.parametrize('batch, errors', [
+    ([{'device': 'Light', 'command': 'set_switch', 'value': 'on'}, {'device': 'Kettle', 'command': 'set_switch', 'value': 'on'}],
+     ['entry 1: device Kettle not found']),
+    ([{'device': 'Light', 'command': 'set_colour', 'value': 'red'}, 'switch'],
+     ['entry 0: invalid command set_colour for device d1', 'entry 1: not a dictionary']),
+    ([{'device': 'Light', 'command': 'reconnect', 'value': 'ON'}], ['entry 0: invalid command reconnect for device d1']),
+    ('[{"device": "Light", ', None),
+    ({'commands': 'set_switch'}, ['invalid batch: a batch must be a list of commands']),
+], ids=['unknown device', 'invalid commands', 'reconnect', 'invalid json', 'not a list'])
+async def test_invalid_batch_sends_nothing(ewelink, batch, errors):
+    client = make_client(ewelink)
+    try:
+        result = await client.batch_command(batch)
+        await asyncio.sleep(0.01)
+        assert client.sent == []
+        assert 'results' not in result and result['errors']
+        if errors is not None:
+            assert result['errors'] == errors
+        assert published(client) == [result]
+    finally:
+        await client._stop()
+
+async def test_batch_over_mqtt(ewelink):
+    client = make_client(ewelink)
+    try:
+        batch = [{'device': 'Light', 'command': 'set_switch', 'value': 'on'}, {'device': 'Heater', 'command': 'set_switch', 'value': 'on'}]
+        topic = '{}/client/batch'.format(client._topic.rstrip('/'))
+        client._get_command(types.SimpleNamespace(topic=topic, payload=json.dumps(batch).encode()))
+        await client._workers.join()
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+            if published(client):
+                break
+        [result] = published(client)
+        assert result['id'] is None and result['entries'] == 2 and result['ok'] == 2
+        assert [entry['device'] for entry in result['results']] == ['d1', 'd3']
+    finally:
+        await client._stop()
@@ -0,0 +1,178 @@
+'''
+Cloud WS connection: reusing the saved WS server, falling back to the dispatch server, rejected tokens,
+and the start_connection() loop only ever having one WS task
+'''
+
+import argparse
+import asyncio
+
+import pytest
+from aiohttp import ClientSession, web
+
+pytestmark = pytest.mark.cloud
+
+@pytest.fixture
+def ewelink():
+    import ewelink
+    ewelink.arg = argparse.Namespace(poll_interval=0, appid=0, oauth=False, startup_report=False)
+    return ewelink
+
+class CloudServer():
+    '''
+    local dispatch and WS server, handshake is the response to the WS handshake (a dictionary, or a string to send as is)
+    '''
+    def __init__(self, handshake=None):
+        self.handshake = {'error': 0} if handshake is None else handshake
+        self.hits = []
+        self.port = None
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/dispatch/app', self._dispatch)
+        app.router.add_get('/api/ws', self._ws)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', 0).start()
+        self.port = self._runner.addresses[0][1]
+        return self
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    @property
+    def ws_url(self):
+        return 'ws://127.0.0.1:{}/api/ws'.format(self.port)
+
+    async def _dispatch(self, request):
+        self.hits.append('dispatch')
+        return web.json_response({'domain': '127.0.0.1', 'port': self.port})
+
+    async def _ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        msg = await ws.receive_json()
+        self.hits.append(('ws', msg['at']))
+        if isinstance(self.handshake, str):
+            await ws.send_str(self.handshake)
+        else:
+            await ws.send_json(self.handshake)
+        async for msg in ws:
+            pass
+        return ws
+
+def make_client(ewelink, server, session, saved_ws=None):
+    class TestClient(ewelink.EwelinkClient):
+        @property
+        def ws_host(self):
+            return 'http://127.0.0.1:{}/dispatch/app'.format(server.port)
+
+        async def _get_ws_server(self):
+            return (await super()._get_ws_server()).replace('wss://', 'ws://')   #no TLS locally
+
+    client = TestClient('me', 'pw')
+    ewelink.XRegistryCloud.__init__(client, session)
+    client.region = 'us'
+    client.auth = {'at': 'token', 'user': {'apikey': 'key'}, 'appid': 'app'}
+    client._saved_auth = {'login': 'me', 'region': 'us', 'app': 0, 'at': 'token', 'rt': 'refresh', 'ts': 0}
+    if saved_ws:
+        client._saved_auth['ws'] = saved_ws
+    return client
+
+async def connect(ewelink, handshake=None, saved_ws=None):
+    '''
+    returns (connect() result, client, server) for a client connecting to a local server
+    '''
+    server = await CloudServer(handshake).start()
+    async with ClientSession() as session:
+        client = make_client(ewelink, server, session, saved_ws(server) if callable(saved_ws) else saved_ws)
+        try:
+            result = await client.connect()
+            ws_closed = client.ws is None or client.ws.closed
+            await client._close_ws()
+        finally:
+            await client._stop()
+            await server.stop()
+    return result, ws_closed, client, server
+
+async def test_reuses_saved_ws_server(ewelink):
+    connected, ws_closed, client, server = await connect(ewelink, saved_ws=lambda server: server.ws_url)
+    assert connected and not ws_closed
+    assert server.hits == [('ws', 'token')]
+
+async def test_asks_dispatch_server_when_saved_ws_server_fails(ewelink):
+    connected, ws_closed, client, server = await connect(ewelink, saved_ws='ws://127.0.0.1:1/api/ws')
+    assert connected and not ws_closed
+    assert server.hits == ['dispatch', ('ws', 'token')]
+    assert client._saved_auth['ws'] == server.ws_url
+
+async def test_rejected_token_is_forgotten(ewelink):
+    connected, ws_closed, client, server = await connect(ewelink, {'error': 406}, saved_ws=lambda server: server.ws_url)
+    assert not connected and ws_closed
+    assert 'at' not in client._saved_auth and 'rt' not in client._saved_auth
+    assert client._saved_auth['region'] == 'us'
+
+@pytest.mark.parametrize('handshake', [{'error': 500}, 'not json'])
+async def test_handshake_error(ewelink, handshake):
+    connected, ws_closed, client, server = await connect(ewelink, handshake)
+    assert not connected and ws_closed
+    assert server.hits == ['dispatch', ('ws', 'token')]
+    assert client._saved_auth['at'] == 'token'
+    assert 'ws' not in client._saved_auth
+
+async def test_reconnect_stops_ws_task(ewelink):
+    '''
+    the WS task keeps reconnecting while the session is open (as XRegistryCloud.run_forever() does), so start_connection()
+    has to stop it before connecting again, or there is one more WS task (and WS) after every reconnect
+    '''
+    client = ewelink.EwelinkClient(None, None)
+    client.reconnect_delay = 0
+    ws_tasks = set()
+    online = asyncio.Queue()
+    fail = [False]
+    closed = [asyncio.Event()]
+
+    async def login(*args, **kwargs):
+        client._saved_auth = {'at': 'token'}
+        return True
+    async def get_homes():
+        return {'home': 'Home'}
+    async def get_devices(homes=None):
+        return [{'deviceid': 'd1', 'name': 'Light', 'productModel': 'Basic', 'apikey': 'key', 'params': {'switch': 'on'}}]
+    async def connect():
+        if fail[0]:
+            fail[0] = False
+            return False
+        closed[0] = asyncio.Event()
+        return True
+    async def run_forever():
+        ws_tasks.add(asyncio.current_task())
+        try:
+            while not client.session.closed:
+                if not await client.connect():
+                    client.set_online(False)
+                    await asyncio.sleep(0.01)
+                    continue
+                client.set_online(True)
+                await closed[0].wait()
+        finally:
+            ws_tasks.discard(asyncio.current_task())
+    loop_while_online = client._loop_while_online
+    async def while_online():
+        online.put_nowait(len(ws_tasks))
+        await loop_while_online()
+    client._login, client.get_homes, client.get_devices, client.connect, client.run_forever = login, get_homes, get_devices, connect, run_forever
+    client._loop_while_online = while_online
+
+    task = asyncio.create_task(client.start_connection(ewelink.arg))
+    try:
+        for reconnect in range(5):
+            assert await asyncio.wait_for(online.get(), 5) == 1
+            fail[0] = True      #the WS closes, and the WS task can't reconnect, so the cloud goes offline
+            closed[0].set()
+        assert await asyncio.wait_for(online.get(), 5) == 1
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await client._stop()
+    assert len(ws_tasks) <= 1
@@ -0,0 +1,96 @@
+'''
+CommandScheduler: sending in order, superseding and merging queued commands, clear() (while a command is being sent too),
+and commands put after clear()
+'''
+
+import asyncio
+
+from command_scheduler import CommandScheduler
+
+class Cloud():
+    '''
+    send() for a CommandScheduler, blocks until release() if blocking
+    '''
+    def __init__(self, blocking=False):
+        self.sent = []
+        self.sending = asyncio.Event()
+        self._release = asyncio.Event()
+        if not blocking:
+            self._release.set()
+
+    async def send(self, payload, waitResponse):
+        self.sent.append(payload.get('params'))    #None for a query
+        self.sending.set()
+        await self._release.wait()
+        return 'online'
+
+    def release(self):
+        self._release.set()
+
+async def test_sends_in_order():
+    cloud = Cloud()
+    scheduler = CommandScheduler(cloud.send, rate=0)
+    results = await asyncio.gather(scheduler.put({'params': {'switch': 'on'}}), scheduler.put({'params': {'startup': 'off'}}))
+    assert results == ['online', 'online']
+    assert cloud.sent == [{'switch': 'on'}, {'startup': 'off'}]
+
+async def test_clear_while_sending_resolves_futures():
+    cloud = Cloud(blocking=True)
+    scheduler = CommandScheduler(cloud.send, rate=0)
+    sending = scheduler.put({'params': {'switch': 'on'}})
+    queued = scheduler.put({'params': {'startup': 'off'}})
+    await cloud.sending.wait()
+    scheduler.clear()
+    assert await asyncio.wait_for(sending, 1) is None
+    assert await asyncio.wait_for(queued, 1) is None
+    assert len(scheduler) == 0
+
+async def test_put_after_clear_is_sent():
+    cloud = Cloud(blocking=True)
+    scheduler = CommandScheduler(cloud.send, rate=0)
+    scheduler.put({'params': {'switch': 'on'}})
+    await cloud.sending.wait()
+    scheduler.clear()
+    cloud.release()
+    future = scheduler.put({'params': {'switch': 'off'}})   #before the cancelled task has finished
+    assert await asyncio.wait_for(future, 1) == 'online'
+    assert cloud.sent == [{'switch': 'on'}, {'switch': 'off'}]
+
+async def test_newer_write_supersedes_queued_one():
+    cloud = Cloud(blocking=True)
+    scheduler = CommandScheduler(cloud.send, rate=0)
+    sending = scheduler.put({'params': {'bright': 10}})
+    await cloud.sending.wait()
+    replaced = scheduler.put({'params': {'bright': 20}})
+    switch = scheduler.put({'params': {'switch': 'on'}})
+    latest = scheduler.put({'params': {'bright': 30}})
+    assert len(scheduler) == 2 and scheduler.stats['superseded'] == 1
+    cloud.release()
+    assert await asyncio.wait_for(asyncio.gather(sending, replaced, switch, latest), 1) == ['online'] * 4
+    assert cloud.sent == [{'bright': 10}, {'switch': 'on'}, {'bright': 30}]    #the latest value, after the switch
+
+async def test_clear_resolves_queued_futures():
+    cloud = Cloud()
+    scheduler = CommandScheduler(cloud.send, rate=0.01)     #the second command waits 100s for the rate limit
+    first = scheduler.put({'params': {'switch': 'on'}})
+    queued = [scheduler.put({'params': {'startup': 'off'}}), scheduler.put({}, waitResponse=True)]
+    assert await asyncio.wait_for(first, 1) == 'online'
+    scheduler.clear()
+    assert await asyncio.wait_for(asyncio.gather(*queued), 1) == [None, None]
+    assert cloud.sent == [{'switch': 'on'}]
+
+async def test_writes_in_merge_window_are_sent_together():
+    cloud = Cloud()
+    scheduler = CommandScheduler(cloud.send, rate=0, merge_window=0.05)
+    futures = [scheduler.put({'params': params}) for params in ({'switch': 'on'}, {'startup': 'off'}, {'switch': 'off', 'pulse': 'on'})]
+    assert await asyncio.wait_for(asyncio.gather(*futures), 1) == ['online'] * 3
+    assert cloud.sent == [{'switch': 'off', 'startup': 'off', 'pulse': 'on'}]
+    assert scheduler.stats['merged'] == 2 and scheduler.stats['sent'] == 1
+
+async def test_query_is_not_merged():
+    cloud = Cloud()
+    scheduler = CommandScheduler(cloud.send, rate=0, merge_window=0.05)
+    futures = [scheduler.put({'params': {'switch': 'on'}}), scheduler.put({}), scheduler.put({'params': {'startup': 'off'}})]
+    assert await asyncio.wait_for(asyncio.gather(*futures), 1) == ['online'] * 3
+    assert cloud.sent == [{'switch': 'on'}, None, {'startup': 'off'}]
+    assert scheduler.stats['merged'] == 0
@@ -0,0 +1,50 @@
+'''
+Sending commands: waiting for the device to respond, and retries
+'''
+
+import argparse
+
+import pytest
+
+pytestmark = pytest.mark.cloud
+
+@pytest.fixture
+def ewelink():
+    import ewelink
+    ewelink.arg = argparse.Namespace(poll_interval=0, appid=0, oauth=False, startup_report=False)
+    return ewelink
+
+def make_client(ewelink, results, **kwargs):
+    '''
+    client with one Basic switch, the cloud returns results in turn (timeout if there aren't any left)
+    '''
+    class TestClient(ewelink.EwelinkClient):
+        async def send(self, device, params=None, sequence=None, timeout=5):
+            self.timeouts.append(timeout)
+            return results.pop(0) if results and timeout else ('timeout' if timeout else None)
+
+    client = TestClient(None, None, command_rate=0, **kwargs)
+    ewelink.XRegistryCloud.__init__(client, None)
+    client.timeouts = []
+    client._devices = [{'deviceid': 'd1', 'name': 'Light', 'productModel': 'Basic', 'apikey': 'key', 'params': {'switch': 'off'}}]
+    client._create_client_devices()
+    client.set_online(True)
+    return client
+
+async def test_no_wait_by_default(ewelink):
+    client = make_client(ewelink, [])
+    try:
+        assert await client._send_request_now({'device': client._devices[0], 'params': {'switch': 'on'}}) is None
+        assert client.timeouts == [0]
+        assert await client._send_request_now({'device': client._devices[0], 'params': {'switch': 'on'}}, waitResponse=True) == 'timeout'
+        assert client.timeouts == [0, client._command_timeout]
+    finally:
+        await client._stop()
+
+async def test_retries(ewelink):
+    client = make_client(ewelink, ['timeout', 'online'], retries=1)
+    try:
+        assert await client._send_request_now({'device': client._devices[0], 'params': {'switch': 'on'}}) == 'online'
+        assert client.timeouts == [client._command_timeout] * 2
+    finally:
+        await client._stop()
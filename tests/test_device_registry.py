@@ -0,0 +1,45 @@
+'''
+Device lookups: by deviceid, name or index number, the first device in the list that matches wins
+'''
+
+import argparse
+
+import pytest
+
+from device_registry import DeviceRegistry
+
+DEVICES = [{'deviceid': 'd0', 'name': 'Light'},
+           {'deviceid': 'd1', 'name': 'Fan'},
+           {'deviceid': 'd2', 'name': '1'},
+           {'deviceid': 'd3', 'name': '3'}]
+
+@pytest.mark.parametrize('sel_device, deviceid', [
+    ('d1', 'd1'),
+    ('Fan', 'd1'),
+    ('fan', 'd1'),      #case insensitive if there is no exact match
+    (0, 'd0'),
+    ('1', 'd1'),        #index 1 is before the device called "1"
+    ('3', 'd3'),        #the device called "3" is also index 3
+    ('7', None),
+    ('Heater', None),
+])
+def test_get_deviceid(sel_device, deviceid):
+    assert DeviceRegistry(DEVICES).get_deviceid(sel_device) == deviceid
+
+def test_numeric_name_before_index():
+    registry = DeviceRegistry([{'deviceid': 'd0', 'name': '2'}] + DEVICES[1:3])
+    assert registry.get_deviceid('2') == 'd0'
+
+@pytest.mark.cloud
+async def test_router_matches_get_deviceid():
+    import ewelink
+    ewelink.arg = argparse.Namespace(poll_interval=0, appid=0, oauth=False, startup_report=False)
+    client = ewelink.EwelinkClient(None, None)
+    client._devices = [dict(device, productModel='Basic', params={}) for device in DEVICES]
+    client._create_client_devices()
+    try:
+        for sel_device in ('d1', 'Fan', 'fan', '0', '1', '3'):
+            target, levels = client._router.route('{}/{}/switch'.format(client._topic.rstrip('/'), sel_device))
+            assert target.deviceid == client.get_deviceid(sel_device)
+    finally:
+        await client._stop()
@@ -0,0 +1,25 @@
+'''
+Device clients: command dispatch tables
+'''
+
+from ewelink_devices import Default, BasicSwitch
+
+def make_device(cls, deviceid, params):
+    device = {'deviceid': deviceid, 'name': deviceid, 'productModel': cls.productModel[0], 'params': dict(params)}
+    return cls(None, deviceid, device, cls.productModel[0])
+
+async def test_learned_settings_are_per_device():
+    class_dispatch = dict(Default._dispatch)
+    class_settings = dict(Default.settings)
+    first = make_device(Default, 'd1', {'switch': 'on', 'colorTemp': 50})
+    second = make_device(Default, 'd2', {'switch': 'on'})
+    assert first.has_command('colorTemp')
+    assert not second.has_command('colorTemp')
+    assert 'colorTemp' not in second.settings
+    assert Default._dispatch == class_dispatch and Default.settings == class_settings
+
+async def test_devices_without_new_settings_share_the_class_table():
+    first = make_device(BasicSwitch, 'd1', {})
+    second = make_device(BasicSwitch, 'd2', {})
+    assert first._dispatch is second._dispatch is BasicSwitch._dispatch
+    assert first.has_command('set_switch') and second.has_command('set_switch')
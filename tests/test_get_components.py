@@ -0,0 +1,39 @@
+'''
+Installing custom_components: a failed install ends the program with a clear message, not a traceback
+'''
+
+import asyncio
+import os
+
+import pytest
+
+import get_components
+
+@pytest.fixture
+def loop():
+    '''
+    check_setup() runs at import time, when there is always a current event loop, the async tests leave none
+    '''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+def test_failed_install_exits(tmp_path, monkeypatch, capsys, loop):
+    monkeypatch.chdir(tmp_path)     #custom_components are not installed here
+    monkeypatch.setenv('SONOFFLAN_CACHE', str(tmp_path / 'cache'))
+    monkeypatch.setenv('SONOFFLAN_OFFLINE', '1')    #and the cache is empty
+    monkeypatch.delenv('SONOFFLAN_VERSION', raising=False)
+    with pytest.raises(SystemExit) as exit:
+        get_components.check_setup()
+    assert exit.value.code == 1
+    out = capsys.readouterr().out
+    assert 'Error installing custom_components (SonoffLAN latest): SonoffLAN release is not in the cache' in out
+    assert not os.path.exists(tmp_path / 'custom_components')
+
+def test_installed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'custom_components').mkdir()
+    monkeypatch.delenv('SONOFFLAN_VERSION', raising=False)
+    get_components.check_setup()    #nothing to do
@@ -0,0 +1,98 @@
+'''
+Device groups: a group command goes to every device in the group, and the results are published in one message
+'''
+
+import argparse
+import asyncio
+import json
+import types
+
+import pytest
+
+pytestmark = pytest.mark.cloud
+
+@pytest.fixture
+def ewelink():
+    import ewelink
+    ewelink.arg = argparse.Namespace(poll_interval=0, appid=0, oauth=False, startup_report=False)
+    return ewelink
+
+def device(deviceid, name, model='Basic'):
+    return {'deviceid': deviceid, 'name': name, 'productModel': model, 'apikey': 'key', 'params': {'switch': 'off'}}
+
+def make_client(ewelink, groups):
+    class TestClient(ewelink.EwelinkClient):
+        async def send(self, device, params=None, sequence=None, timeout=5):
+            self.sent.append((device['deviceid'], params))
+
+        def _publish(self, deviceid, topic, message):
+            self.published.append((deviceid, topic, message))
+            super()._publish(deviceid, topic, message)
+
+    client = TestClient(None, None, command_rate=0)
+    ewelink.XRegistryCloud.__init__(client, None)
+    client.sent = []
+    client.published = []
+    client._group_config = groups
+    client._devices = [device('d1', 'Light'), device('d2', 'Fan'), device('d3', 'Heater')]
+    client._create_client_devices()
+    client.set_online(True)
+    return client
+
+async def group_command(client, group, command='set_switch', payload='on'):
+    topic = '{}/group/{}/{}'.format(client._topic.rstrip('/'), group, command)
+    client._get_command(types.SimpleNamespace(topic=topic, payload=payload.encode()))
+    await client._workers.join()
+    await asyncio.sleep(0.01)
+    return [json.loads(message) for deviceid, topic, message in client.published if topic == 'result']
+
+async def test_group_command_reaches_every_member(ewelink):
+    client = make_client(ewelink, {'lights': ['Light', 'd2']})
+    try:
+        results = await group_command(client, 'lights')
+        assert sorted(client.sent) == [('d1', {'switch': 'on'}), ('d2', {'switch': 'on'})]
+        assert len(results) == 1
+        assert results[0]['group'] == 'lights' and results[0]['command'] == 'set_switch' and results[0]['message'] == 'on'
+        assert results[0]['devices'] == 2 and results[0]['ok'] == 2 and results[0]['failed'] == 0
+        assert results[0]['results'] == {'d1': 'sent', 'd2': 'sent'}
+    finally:
+        await client._stop()
+
+async def test_automatic_group(ewelink):
+    client = make_client(ewelink, {})
+    try:
+        results = await group_command(client, 'all', payload='off')
+        assert sorted(client.sent) == [('d1', {'switch': 'off'}), ('d2', {'switch': 'off'}), ('d3', {'switch': 'off'})]
+        assert results[0]['devices'] == 3
+    finally:
+        await client._stop()
+
+async def test_unknown_group(ewelink):
+    client = make_client(ewelink, {'gone': ['Kettle']})     #no devices found, so no group
+    try:
+        assert 'gone' not in client._groups
+        assert await group_command(client, 'gone') == []
+        assert await group_command(client, 'nothing') == []
+        assert client.sent == []
+    finally:
+        await client._stop()
+
+async def test_member_missing_from_device_list(ewelink):
+    client = make_client(ewelink, {'downstairs': ['Light', 'Kettle', 7]})
+    try:
+        assert client._groups['downstairs'].clients == [client._clients['d1']]
+        results = await group_command(client, 'downstairs')
+        assert client.sent == [('d1', {'switch': 'on'})]
+        assert results[0]['devices'] == 1 and results[0]['results'] == {'d1': 'sent'}
+    finally:
+        await client._stop()
+
+async def test_unsupported_command(ewelink):
+    client = make_client(ewelink, {'lights': ['Light', 'Fan']})
+    try:
+        results = await group_command(client, 'lights', command='set_colour')
+        assert client.sent == []
+        assert results[0]['ok'] == 0 and results[0]['failed'] == 2
+        assert results[0]['results'] == {'d1': 'not_supported', 'd2': 'not_supported'}
+    finally:
+        await client._stop()
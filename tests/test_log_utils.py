@@ -0,0 +1,41 @@
+'''
+Logging: records are formatted by the listener thread, unless their args could change before it gets to them
+'''
+
+import logging
+import queue
+
+from log_utils import DeferredQueueHandler, LazyJson
+
+def make_logger(name):
+    log_queue = queue.SimpleQueue()
+    log = logging.getLogger(name)
+    log.propagate = False
+    log.setLevel(logging.DEBUG)
+    log.handlers = [DeferredQueueHandler(log_queue)]
+    return log, log_queue
+
+def test_immutable_args_are_not_formatted():
+    log, log_queue = make_logger('test.deferred')
+    log.info('device %s: %s=%s', 'd1', 'switch', 1)
+    record = log_queue.get_nowait()
+    assert record.msg == 'device %s: %s=%s' and record.args == ('d1', 'switch', 1)
+    assert record.getMessage() == 'device d1: switch=1'
+
+def test_exception_is_formatted_by_the_listener():
+    log, log_queue = make_logger('test.deferred_exception')
+    try:
+        1/0
+    except ZeroDivisionError:
+        log.exception('failed')
+    record = log_queue.get_nowait()
+    assert record.exc_info is not None
+    assert 'ZeroDivisionError' in logging.Formatter().format(record)
+
+def test_mutable_args_are_formatted_when_logged():
+    log, log_queue = make_logger('test.formatted')
+    params = {'switch': 'on'}
+    log.debug('params: %s', LazyJson(params))
+    params['switch'] = 'off'    #changed before the listener gets to the record
+    record = log_queue.get_nowait()
+    assert record.args is None and '"on"' in record.getMessage()
@@ -0,0 +1,149 @@
+'''
+asyncio MQTT client: half open connections, on_publish for QoS 1, stopping while disconnected, and waiting to connect
+'''
+
+import asyncio
+import struct
+
+import mqtt_asyncio
+from mqtt import MQTT
+
+class Broker():
+    '''
+    minimal MQTT broker, that accepts connections, and answers PINGREQ and QoS 1 publishes unless told not to
+    '''
+    def __init__(self, ping=True, puback=True):
+        self.ping = ping
+        self.puback = puback
+        self.connections = 0
+        self.published = asyncio.Queue()
+        self._writer = None
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self._server.close()
+        if self._writer is not None:
+            self._writer.close()
+        await self._server.wait_closed()
+
+    def ack(self, mid):
+        self._writer.write(mqtt_asyncio._packet(mqtt_asyncio.PUBACK, struct.pack('!H', mid)))
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        self._writer = writer
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                length, multiplier = 0, 1
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) * multiplier
+                    if not byte & 0x80:
+                        break
+                    multiplier *= 128
+                body = await reader.readexactly(length) if length else b''
+                packet_type = header & 0xF0
+                if packet_type == mqtt_asyncio.CONNECT:
+                    writer.write(mqtt_asyncio._packet(mqtt_asyncio.CONNACK, b'\x00\x00'))
+                elif packet_type == mqtt_asyncio.PINGREQ and self.ping:
+                    writer.write(mqtt_asyncio._packet(mqtt_asyncio.PINGRESP))
+                elif packet_type == mqtt_asyncio.PUBLISH and header & 0x06:
+                    (topic_len,) = struct.unpack('!H', body[:2])
+                    (mid,) = struct.unpack('!H', body[2+topic_len:4+topic_len])
+                    self.published.put_nowait(mid)
+                    if self.puback:
+                        self.ack(mid)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+def make_client():
+    client = mqtt_asyncio.Client()
+    client.events = asyncio.Queue()
+    client.on_connect = lambda client, userdata, flags, rc: client.events.put_nowait(('connect', rc))
+    client.on_disconnect = lambda client, userdata, rc: client.events.put_nowait(('disconnect', rc))
+    client.on_publish = lambda client, userdata, mid: client.events.put_nowait(('publish', mid))
+    return client
+
+async def test_half_open_connection_is_dropped():
+    broker = await Broker(ping=False).start()   #the connection stays open, but nothing is received
+    client = make_client()
+    try:
+        client.connect('127.0.0.1', broker.port, keepalive=1)
+        assert await asyncio.wait_for(client.events.get(), 1) == ('connect', 0)
+        assert await asyncio.wait_for(client.events.get(), 3) == ('disconnect', 1)
+    finally:
+        client.disconnect()
+        client.loop_stop()
+        await broker.stop()
+
+async def test_connection_kept_while_broker_answers_pings():
+    broker = await Broker().start()
+    client = make_client()
+    try:
+        client.connect('127.0.0.1', broker.port, keepalive=1)
+        assert await asyncio.wait_for(client.events.get(), 1) == ('connect', 0)
+        await asyncio.sleep(2.5)
+        assert client.events.empty() and client.is_connected()
+    finally:
+        client.disconnect()
+        client.loop_stop()
+        await broker.stop()
+
+async def test_qos1_on_publish_waits_for_puback():
+    broker = await Broker(puback=False).start()
+    client = make_client()
+    try:
+        client.connect('127.0.0.1', broker.port)
+        assert await asyncio.wait_for(client.events.get(), 1) == ('connect', 0)
+        client.publish('test/qos0', 'zero')
+        assert await asyncio.wait_for(client.events.get(), 1) == ('publish', 0)
+        info = client.publish('test/qos1', 'one', qos=1)
+        assert await asyncio.wait_for(broker.published.get(), 1) == info.mid
+        await asyncio.sleep(0.1)
+        assert client.events.empty()
+        broker.ack(info.mid)
+        assert await asyncio.wait_for(client.events.get(), 1) == ('publish', info.mid)
+    finally:
+        client.disconnect()
+        client.loop_stop()
+        await broker.stop()
+
+async def test_stop_while_disconnected():
+    '''
+    the asyncio client reconnects by itself, so stopping while it's disconnected has to stop it too
+    '''
+    broker = await Broker().start()
+    port = broker.port
+    await broker.stop()     #nothing listening, so the client keeps trying to reconnect
+    mqtt = MQTT(ip='127.0.0.1', port=port, transport='asyncio')
+    client = mqtt._mqttc
+    await asyncio.sleep(0.1)
+    assert not mqtt._MQTT_connected
+    await mqtt._stop()
+    assert mqtt._mqttc is None
+    assert client._task is None
+
+async def test_wait_for_mqtt_wakes_on_connect():
+    broker = await Broker().start()
+    mqtt = MQTT(ip='127.0.0.1', port=broker.port, transport='asyncio')
+    try:
+        assert await asyncio.wait_for(mqtt._waitForMQTT(), 1)
+    finally:
+        await mqtt._stop()
+        await broker.stop()
+
+async def test_wait_for_mqtt_timeout():
+    broker = await Broker().start()
+    port = broker.port
+    await broker.stop()
+    mqtt = MQTT(ip='127.0.0.1', port=port, transport='asyncio')
+    try:
+        assert await asyncio.wait_for(mqtt._waitForMQTT(timeout=0.1), 1) is False
+    finally:
+        await mqtt._stop()
@@ -0,0 +1,61 @@
+'''
+Polling: the poll interval adapts to whether the reply to a poll changed the device's params,
+and only errors and timeouts count as failed polls
+'''
+
+import argparse
+import asyncio
+
+import pytest
+
+pytestmark = pytest.mark.cloud
+
+@pytest.fixture
+def ewelink():
+    import ewelink
+    ewelink.arg = argparse.Namespace(poll_interval=0, appid=0, oauth=False, startup_report=False)
+    return ewelink
+
+def make_client(ewelink, reply):
+    '''
+    client with one Basic switch, the cloud replies to each command (after a short delay) with reply (params, error)
+    '''
+    class TestClient(ewelink.EwelinkClient):
+        async def send(self, device, params=None, sequence=None, timeout=5):
+            params, error = reply
+            message = {'deviceid': device['deviceid'], 'apikey': 'key', 'sequence': sequence, 'error': error}
+            if params:
+                message['params'] = dict(params)
+            self.loop.call_later(0.01, lambda: asyncio.ensure_future(self._process_ws_msg(message)))
+            if timeout:
+                return await self._wait_response(sequence, timeout)
+
+    client = TestClient(None, None, command_rate=0)
+    ewelink.XRegistryCloud.__init__(client, None)
+    client._poll_jitter = 0
+    client._devices = [{'deviceid': 'd1', 'name': 'Light', 'productModel': 'Basic', 'apikey': 'key', 'params': {'switch': 'off'}}]
+    client._create_client_devices()
+    client._poller.add('d1', 60, 600)
+    client._poller._entries['d1'].interval = 240
+    client.set_online(True)
+    return client
+
+@pytest.mark.parametrize('params, interval', [({'switch': 'on'}, 120), ({'switch': 'off'}, 480)], ids=['changed', 'unchanged'])
+async def test_poll_reply_adapts_interval(ewelink, params, interval):
+    client = make_client(ewelink, (params, 0))
+    try:
+        await client._poll_batch(['d1'])
+        assert client._clients['d1']._state['switch'] == params['switch']
+        assert client._poller._entries['d1'].interval == interval
+        assert client._poll_stats['failed'] == 0
+    finally:
+        await client._stop()
+
+@pytest.mark.parametrize('error, failed', [(503, 0), (504, 1), (400, 1)], ids=['offline', 'timeout', 'error'])
+async def test_poll_failures(ewelink, error, failed):
+    client = make_client(ewelink, (None, error))
+    try:
+        await client._poll_batch(['d1'])
+        assert client._poll_stats['failed'] == failed
+    finally:
+        await client._stop()
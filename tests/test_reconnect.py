@@ -0,0 +1,82 @@
+'''
+Reconnecting: the device list is fetched again, clients of devices still in it are kept, others are closed or recreated
+'''
+
+import argparse
+import asyncio
+
+import pytest
+
+pytestmark = pytest.mark.cloud
+
+@pytest.fixture
+def ewelink():
+    import ewelink
+    ewelink.arg = argparse.Namespace(poll_interval=0, appid=0, oauth=False, startup_report=False)
+    return ewelink
+
+def device(deviceid, name, params, model='Basic'):
+    return {'deviceid': deviceid, 'name': name, 'productModel': model, 'apikey': 'key', 'params': dict(params)}
+
+def make_client(ewelink, devices):
+    class TestClient(ewelink.EwelinkClient):
+        async def send(self, device, params=None, sequence=None, timeout=5):
+            self.sent.append((device['deviceid'], params))
+
+    client = TestClient(None, None, command_rate=0)
+    ewelink.XRegistryCloud.__init__(client, None)
+    client.sent = []
+    client._devices = devices
+    client._create_client_devices()
+    return client
+
+def reconnect(client, devices):
+    client._devices = devices
+    client._create_client_devices()
+
+async def test_kept_device_merges_state(ewelink):
+    client = make_client(ewelink, [device('d1', 'Light', {'switch': 'off', 'startup': 'on'})])
+    try:
+        light = client._clients['d1']
+        reconnect(client, [device('d1', 'Light', {'switch': 'on'})])
+        assert client._clients['d1'] is light
+        assert light._state['switch'] == 'on'
+        assert light._state['startup'] == 'on'    #not in the new params, kept from before
+        assert client._devices[0]['params'] is light._state.params
+    finally:
+        await client._stop()
+
+async def test_removed_device_is_closed(ewelink):
+    client = make_client(ewelink, [device('d1', 'Light', {'switch': 'off'}), device('d2', 'Fan', {'switch': 'off'})])
+    try:
+        light = client._clients['d1']
+        closed = []
+        light._close = lambda: closed.append('d1')
+        #not online, so the first command waits for the cloud connection, and the second is queued behind it
+        commands = [asyncio.ensure_future(client._send_request({'device': client._devices[0], 'params': params}))
+                    for params in ({'switch': 'on'}, {'startup': 'off'})]
+        await asyncio.sleep(0.01)
+        assert len(client._schedulers['d1']) == 1
+        reconnect(client, [device('d2', 'Fan', {'switch': 'off'})])
+        assert closed == ['d1']
+        assert 'd1' not in client._clients and 'd1' not in client._schedulers
+        assert await asyncio.wait_for(asyncio.gather(*commands), 1) == [None, None]
+        client.set_online(True)
+        await asyncio.sleep(0.01)
+        assert client.sent == []
+    finally:
+        await client._stop()
+
+async def test_changed_model_recreates_client(ewelink):
+    client = make_client(ewelink, [device('d1', 'Light', {'switch': 'off'})])
+    try:
+        light = client._clients['d1']
+        closed = []
+        light._close = lambda: closed.append('d1')
+        reconnect(client, [device('d1', 'Patio Door', {'a': '3', 'm': '1'}, model='WFA-1')])
+        assert closed == ['d1']
+        assert client._clients['d1'] is not light
+        assert client._clients['d1']._productModel == 'WFA-1'
+        assert client._clients['d1']._state['m'] == '1'
+    finally:
+        await client._stop()
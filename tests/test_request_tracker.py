@@ -0,0 +1,39 @@
+'''
+In-flight request tracker: requests that will never be acknowledged don't stay in the table
+'''
+
+from request_tracker import InFlightTracker
+
+def test_ack():
+    tracker = InFlightTracker()
+    tracker.sent(1, 'd1', {'switch': 'on'})
+    assert tracker.ack(1, 'online')
+    assert not tracker.ack(1, 'online')
+    assert len(tracker) == 0 and tracker.stats['online'] == 1
+    assert tracker.latency()['d1']['count'] == 1
+
+def test_table_is_bounded():
+    tracker = InFlightTracker(max_inflight=10)
+    for sequence in range(25):
+        tracker.sent(sequence, 'd1')
+    assert len(tracker) == 10
+    assert tracker.stats['no_response'] == 15
+    assert tracker.ack(24, 'online') and not tracker.ack(0, 'online')   #the oldest were dropped
+
+def test_drop_on_disconnect():
+    tracker = InFlightTracker()
+    tracker.sent(1, 'd1')
+    tracker.sent(2, 'd2')
+    tracker.drop()
+    assert len(tracker) == 0 and tracker.stats['no_response'] == 2
+    assert tracker.recent[-1]['outcome'] == 'no_response'
+
+def test_forget_removed_device():
+    tracker = InFlightTracker()
+    tracker.sent(1, 'd1')
+    tracker.sent(2, 'd2')
+    tracker.ack(2, 'online')
+    tracker.sent(3, 'd2')
+    tracker.forget('d2')
+    assert len(tracker) == 1 and tracker.ack(1, 'online')
+    assert 'd2' not in tracker.latency()
@@ -0,0 +1,53 @@
+'''
+Connecting to the cloud: WS messages received while the device list is loading are newer than the params in it
+'''
+
+import argparse
+import asyncio
+
+import pytest
+
+pytestmark = pytest.mark.cloud
+
+@pytest.fixture
+def ewelink():
+    import ewelink
+    ewelink.arg = argparse.Namespace(poll_interval=0, appid=0, oauth=False, startup_report=False)
+    return ewelink
+
+def light(switch):
+    return {'deviceid': 'd1', 'name': 'Light', 'productModel': 'Basic', 'apikey': 'key', 'params': {'switch': switch}}
+
+@pytest.mark.parametrize('existing', [False, True], ids=['new client', 'kept client'])
+async def test_ws_update_while_loading_devices_wins(ewelink, existing):
+    client = ewelink.EwelinkClient(None, None)
+    ewelink.XRegistryCloud.__init__(client, None)
+    if existing:
+        client._devices = [light('on')]
+        client._create_client_devices()
+    loading = asyncio.Event()
+    loaded = asyncio.Event()
+
+    async def login(*args, **kwargs):
+        return True
+    async def get_homes():
+        return {'home': 'Home'}
+    async def get_devices(homes=None):
+        loading.set()
+        await loaded.wait()
+        return [light('on')]    #fetched before the update below was sent
+    async def run_forever():
+        client.set_online(True)
+    client._login, client.get_homes, client.get_devices, client.run_forever = login, get_homes, get_devices, run_forever
+
+    connecting = asyncio.create_task(client._connect_cloud(ewelink.arg))
+    try:
+        await loading.wait()
+        await client._process_ws_msg({'action': 'update', 'deviceid': 'd1', 'params': {'switch': 'off'}})
+        loaded.set()
+        assert await connecting
+        assert client._clients['d1']._state['switch'] == 'off'
+        await client._process_ws_msg({'action': 'update', 'deviceid': 'd1', 'params': {'switch': 'on'}})
+        assert client._clients['d1']._state['switch'] == 'on'
+    finally:
+        await client._stop()
@@ -0,0 +1,105 @@
+'''
+Topic router: exact and case folded matches, rejecting unknown topics, and the route cache when devices are added and removed
+'''
+
+import argparse
+import asyncio
+import types
+
+import pytest
+
+from topic_router import TopicRouter
+
+def make_router():
+    router = TopicRouter(cache_size=4)
+    router.add(['', 'cmd', 'd1', '+'], 'd1')
+    router.add(['', 'cmd', 'Light', '+'], 'light', fold_case=True)
+    router.add(['', 'cmd', 'group', 'plugs', '+'], 'plugs', fold_case=True)
+    router.add(['', 'raw', '#'], 'raw')
+    return router
+
+@pytest.mark.parametrize('topic, route', [
+    ('/cmd/d1/set_switch', ('d1', ('set_switch',))),
+    ('/cmd/Light/set_switch', ('light', ('set_switch',))),
+    ('/cmd/light/set_switch', ('light', ('set_switch',))),
+    ('/cmd/LIGHT/set_switch', ('light', ('set_switch',))),
+    ('/cmd/group/PLUGS/set_switch', ('plugs', ('set_switch',))),
+    ('/raw/a/b', ('raw', ('a', 'b'))),
+])
+def test_routes(topic, route):
+    assert make_router().route(topic) == route
+
+@pytest.mark.parametrize('topic', ['/cmd/d2/set_switch', '/cmd/D1/set_switch', '/cmd/d1', '/cmd/d1/set_switch/extra', '/other/d1/set_switch', ''])
+def test_unknown_topics_are_rejected(topic):
+    router = make_router()
+    assert router.route(topic) is None
+    assert topic not in router._cache     #so they can't push real routes out of the cache
+
+def test_exact_match_before_folded_match():
+    router = make_router()
+    router.add(['', 'cmd', 'light', '+'], 'other light')
+    assert router.route('/cmd/light/x')[0] == 'other light'
+    assert router.route('/cmd/LIGHT/x')[0] == 'light'
+
+def test_cache():
+    router = make_router()
+    assert router.route('/cmd/d2/x') is None
+    router.add(['', 'cmd', 'd2', '+'], 'd2')
+    assert router.route('/cmd/d2/x') == ('d2', ('x',))      #failed before, found after the device was added
+    for n in range(10):
+        router.route('/cmd/d1/command{}'.format(n))
+    assert len(router._cache) <= router.cache_size
+
+@pytest.fixture
+def ewelink():
+    import ewelink
+    ewelink.arg = argparse.Namespace(poll_interval=0, appid=0, oauth=False, startup_report=False)
+    return ewelink
+
+def device(deviceid, name):
+    return {'deviceid': deviceid, 'name': name, 'productModel': 'Basic', 'apikey': 'key', 'params': {'switch': 'off'}}
+
+def message(client, device, command, payload='on'):
+    return types.SimpleNamespace(topic='{}/{}/{}'.format(client._topic.rstrip('/'), device, command), payload=payload.encode())
+
+def make_client(ewelink):
+    class TestClient(ewelink.EwelinkClient):
+        async def send(self, device, params=None, sequence=None, timeout=5):
+            self.sent.append((device['deviceid'], params))
+
+    client = TestClient(None, None, command_rate=0)
+    ewelink.XRegistryCloud.__init__(client, None)
+    client.sent = []
+    client._devices = [device('d1', 'Light')]
+    client._create_client_devices()
+    client.set_online(True)
+    return client
+
+@pytest.mark.cloud
+async def test_unknown_device_and_command(ewelink):
+    client = make_client(ewelink)
+    try:
+        client._get_command(message(client, 'Heater', 'set_switch'))
+        assert len(client._workers) == 0
+        client._get_command(message(client, 'light', 'set_colour'))     #not a Basic switch command
+        client._get_command(message(client, 'light', 'set_switch'))
+        await client._workers.join()
+        await asyncio.sleep(0.01)
+        assert client.sent == [('d1', {'switch': 'on'})]
+    finally:
+        await client._stop()
+
+@pytest.mark.cloud
+async def test_routes_follow_the_device_list(ewelink):
+    client = make_client(ewelink)
+    try:
+        topic = message(client, 'Fan', 'set_switch').topic
+        assert client._router.route(topic) is None
+        client._devices = [device('d1', 'Light'), device('d2', 'Fan')]
+        client._create_client_devices()
+        assert client._router.route(topic)[0] is client._clients['d2']
+        client._devices = [device('d1', 'Light')]
+        client._create_client_devices()
+        assert client._router.route(topic) is None    #was cached before the device was removed
+    finally:
+        await client._stop()
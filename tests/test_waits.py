@@ -0,0 +1,144 @@
+'''
+Waiting on events: a device param changing (DeviceState.wait_for()), the cloud going offline (_loop_while_online()),
+and Autoslide restoring it's delay, they should wake up as soon as the event happens, and stop when cancelled
+'''
+
+import argparse
+import asyncio
+import time
+
+import pytest
+
+from device_state import DeviceState
+
+PROMPT = 0.1    #seconds, these used to be checked every second
+
+@pytest.fixture
+def ewelink():
+    import ewelink
+    ewelink.arg = argparse.Namespace(poll_interval=0, appid=0, oauth=False, startup_report=False)
+    return ewelink
+
+async def woken_after(waiter, trigger, delay=0.05):
+    '''
+    start waiter, call trigger after delay, returns (waiter result, seconds from trigger to waiter finishing)
+    '''
+    task = asyncio.ensure_future(waiter)
+    await asyncio.sleep(delay)
+    assert not task.done()
+    start = time.monotonic()
+    trigger()
+    result = await asyncio.wait_for(task, 1)
+    return result, time.monotonic() - start
+
+async def test_wait_for_param_wakes_on_update():
+    state = DeviceState('d1', {'m': '1'})
+    result, elapsed = await woken_after(state.wait_for('m', '2'), lambda: state.update({'m': '2'}))
+    assert result is True and elapsed < PROMPT
+    assert state._waiters is None
+
+async def test_wait_for_param_already_set():
+    state = DeviceState('d1', {'m': '2'})
+    assert await state.wait_for('m', '2', timeout=0.01) is True
+
+async def test_wait_for_param_timeout():
+    state = DeviceState('d1', {'m': '1'})
+    state.update({'m': '3'})
+    assert await state.wait_for('m', '2', timeout=0.05) is False
+    assert state._waiters is None
+
+async def test_wait_for_param_cancelled():
+    state = DeviceState('d1', {'m': '1'})
+    task = asyncio.ensure_future(state.wait_for('m', '2'))
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert state._waiters is None
+    state.update({'m': '2'})    #nothing left to wake
+
+def make_client(ewelink, devices=()):
+    class TestClient(ewelink.EwelinkClient):
+        async def send(self, device, params=None, sequence=None, timeout=5):
+            self.sent.append((device['deviceid'], params))
+
+    client = TestClient(None, None, command_rate=0)
+    ewelink.XRegistryCloud.__init__(client, None)
+    client.sent = []
+    client._devices = [dict(device) for device in devices]
+    client._create_client_devices()
+    client.set_online(True)
+    return client
+
+@pytest.mark.cloud
+async def test_loop_while_online_wakes_on_offline(ewelink):
+    client = make_client(ewelink)
+    try:
+        result, elapsed = await woken_after(client._loop_while_online(), lambda: client.set_online(False))
+        assert elapsed < PROMPT
+    finally:
+        await client._stop()
+
+@pytest.mark.cloud
+async def test_loop_while_online_checks_token(ewelink):
+    client = make_client(ewelink)
+    client.token_check = 0.02
+    client.token_refresh = 60
+    client._saved_auth = {'at': 'token', 'ts': time.time() - 120}
+    refreshed = asyncio.Event()
+    async def refresh_token():
+        refreshed.set()
+        client._saved_auth['ts'] = time.time()
+        return True
+    client._refresh_token = refresh_token
+    task = asyncio.ensure_future(client._loop_while_online())
+    try:
+        await asyncio.wait_for(refreshed.wait(), 1)
+        assert not task.done()
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await client._stop()
+
+@pytest.mark.cloud
+async def test_loop_while_online_cancelled(ewelink):
+    client = make_client(ewelink)
+    task = asyncio.ensure_future(client._loop_while_online())
+    try:
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(task, PROMPT)
+    finally:
+        await client._stop()
+
+AUTOSLIDE = {'deviceid': 'a1', 'name': 'Patio Door', 'productModel': 'WFA-1', 'apikey': 'key',
+             'params': {'a': '3', 'b': '3', 'c': '1', 'j': '05', 'm': '1', 'n': '0'}}
+
+@pytest.mark.cloud
+async def test_autoslide_restores_delay_when_closed(ewelink):
+    client = make_client(ewelink, [AUTOSLIDE])
+    door = client._clients['a1']
+    try:
+        door._org_delay = '05'
+        door._restore_delay_task = asyncio.ensure_future(door._restore_delay(0))
+        await asyncio.sleep(0.01)
+        assert client.sent == []
+        door._state.update({'m': '2'})  #closed
+        await asyncio.wait_for(asyncio.shield(door._restore_delay_task), PROMPT)
+        assert client.sent == [('a1', {'j': '05'})]
+        assert door._restore_delay_task is None
+    finally:
+        await client._stop()
+
+@pytest.mark.cloud
+async def test_autoslide_restore_delay_cancelled_on_stop(ewelink):
+    client = make_client(ewelink, [AUTOSLIDE])
+    door = client._clients['a1']
+    door._org_delay = '05'
+    task = door._restore_delay_task = asyncio.ensure_future(door._restore_delay(0))
+    await asyncio.sleep(0.01)
+    await client._stop()
+    await asyncio.wait_for(asyncio.gather(task, return_exceptions=True), PROMPT)
+    assert task.done() and client.sent == []
+    assert door._state._waiters is None
@@ -0,0 +1,72 @@
+'''
+WorkerPool: commands for a key are started in order, keys take turns, and errors and stop() don't lose the workers
+'''
+
+import asyncio
+
+from worker_pool import WorkerPool
+
+async def test_commands_for_a_key_start_in_order():
+    pool = WorkerPool(workers=2)
+    started, finished = [], []
+
+    async def command(n, delay):
+        started.append(n)       #eg putting the command in the device's command queue
+        await asyncio.sleep(delay)
+        finished.append(n)
+
+    try:
+        for n, delay in enumerate([0.03, 0, 0.01]):
+            pool.put('d1', command, n, delay)
+        await pool.join()
+        await asyncio.sleep(0.05)
+        assert started == [0, 1, 2]
+        assert finished == [1, 2, 0]    #not awaited by the worker, so they can finish in any order
+    finally:
+        await pool.stop()
+
+async def test_keys_take_turns():
+    pool = WorkerPool(workers=1)
+    handled = []
+    try:
+        for n in range(3):
+            pool.put('busy', handled.append, ('busy', n))
+        pool.put('quiet', handled.append, ('quiet', 0))
+        await pool.join()
+        assert handled == [('busy', 0), ('quiet', 0), ('busy', 1), ('busy', 2)]
+        assert pool.stats['processed'] == 4 and len(pool) == 0
+    finally:
+        await pool.stop()
+
+async def test_error_is_counted_and_worker_carries_on():
+    pool = WorkerPool(workers=1)
+    handled = []
+    def fail():
+        raise ValueError('bad command')
+    try:
+        pool.put('d1', fail)
+        pool.put('d1', handled.append, 'next')
+        await pool.join()
+        assert handled == ['next'] and pool.stats['errors'] == 1
+    finally:
+        await pool.stop()
+
+async def test_stop_cancels_running_commands():
+    pool = WorkerPool(workers=1)
+    cancelled = asyncio.Event()
+    async def command():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+    pool.put('d1', command)
+    await pool.join()
+    await asyncio.sleep(0)
+    await pool.stop()
+    assert cancelled.is_set() and len(pool) == 0
+    handled = []
+    pool.put('d1', handled.append, 'after stop')     #starts new workers
+    await asyncio.wait_for(pool.join(), 1)
+    assert handled == ['after stop']
+    await pool.stop()
@@ -0,0 +1,90 @@
+'''
+Topic router for the ewelink bridge
+A trie over MQTT topic levels, built once for a set of topic patterns (eg /ewelink_command/<device>/+ for every device),
+that routes a received topic straight to the target (eg device client) for it.
+'''
+
+_TARGET = object()  #key for the target of the pattern ending at a node
+_FOLD = object()    #key for the lower case index of a node's children
+
+class TopicRouter():
+    '''
+    Patterns are lists of topic levels, which can include + (any single level) and a final # (any number of levels)
+    as in MQTT subscriptions. Exact levels are matched before +, and + before #.
+    route() returns the target and the levels matched by wildcards, or None. A topic that doesn't match anything
+    is rejected after at most a few dictionary lookups per level.
+    Routes found are cached by topic (up to cache_size topics), as the same command topics are received over and over,
+    topics that don't match are not cached, so they can't push the real ones out.
+    '''
+
+    def __init__(self, cache_size=1024):
+        self._root = {}
+        self._cache = {}
+        self.cache_size = cache_size
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, levels, target, fold_case=False):
+        '''
+        add pattern levels (list) for target, the first target added for a pattern is kept
+        if fold_case, levels that don't match exactly are also matched in lower case
+        '''
+        node = self._root
+        for level in levels:
+            child = node.setdefault(level, {})
+            if fold_case and level not in ('+', '#'):
+                node.setdefault(_FOLD, {}).setdefault(level.lower(), child)
+            node = child
+        if _TARGET not in node:
+            node[_TARGET] = target
+            self.size += 1
+        self._cache.clear()
+
+    def route(self, topic):
+        '''
+        returns (target, tuple of levels matched by wildcards) or None
+        '''
+        result = self._cache.get(topic)
+        if result is None:
+            result = self._match(topic)
+            if result is not None:
+                if len(self._cache) >= self.cache_size:
+                    self._cache.clear()
+                self._cache[topic] = result
+        return result
+
+    def _match(self, topic):
+        levels = topic.split('/')
+        end = len(levels)
+        branches = []   #wildcard branches still to try, + before #
+        node, i, wild = self._root, 0, ()
+        while True:
+            if i == end:
+                if _TARGET in node:
+                    return node[_TARGET], wild
+                multi = node.get('#')
+                if multi is not None and _TARGET in multi:
+                    return multi[_TARGET], wild
+            else:
+                level = levels[i]
+                child = node.get(level)
+                if child is None and _FOLD in node:
+                    child = node[_FOLD].get(level.lower())
+                single = node.get('+')
+                multi = node.get('#')
+                if multi is not None:
+                    branches.append((multi, end, wild + tuple(levels[i:])))
+                if child is None:   #no exact match, carry on with + (if any)
+                    child = single
+                    wild += (level,)
+                elif single is not None:
+                    branches.append((single, i+1, wild + (level,)))
+                if child is not None:
+                    node = child
+                    i += 1
+                    continue
+            if not branches:
+                return None
+            node, i, wild = branches.pop()
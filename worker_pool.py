@@ -0,0 +1,122 @@
+'''
+Worker pool for the ewelink bridge
+Commands for all devices are handled by a fixed number of workers, instead of a queue and task for every device.
+Each device is always handled by the same worker (by deviceid hash), so it's commands are started in order,
+and each worker takes one command from each of it's devices in turn, so one busy device can't hold up the others.
+'''
+
+import asyncio
+import collections
+import logging
+import zlib
+
+class _Shard():
+    '''
+    Work queues for the devices handled by one worker
+    '''
+    __slots__ = ('queues', 'ready', 'event')
+
+    def __init__(self):
+        self.queues = {}                    #key: deque of (func, args)
+        self.ready = collections.deque()    #keys with work, in turn order
+        self.event = asyncio.Event()
+
+class WorkerPool():
+    '''
+    put(key, func, *args) calls func(*args) on the worker for key, in the order put for each key.
+    If func returns a coroutine, it is run as a task (so a slow command doesn't hold up the worker). Tasks start in the order
+    they are created, so each runs up to it's first await in order, after that the tasks for a key can finish in any order.
+    '''
+
+    def __init__(self, workers=4, loop=None, log=None):
+        self._log = log
+        if self._log is None:
+            self._log = logging.getLogger('Main.'+__class__.__name__)
+        self._loop = loop or asyncio.get_event_loop()
+        self._shards = [_Shard() for _ in range(max(1, workers))]
+        self._workers = []
+        self._running = set()   #tasks started by func
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.stats = {'processed': 0, 'max_pending': 0, 'errors': 0}
+
+    def __len__(self):
+        return self._pending
+
+    @property
+    def workers(self):
+        return len(self._shards)
+
+    def shard(self, key):
+        return zlib.crc32(key.encode()) % len(self._shards)
+
+    def put(self, key, func, *args):
+        if not self._workers:
+            self._workers = [self._loop.create_task(self._worker(shard)) for shard in self._shards]
+        shard = self._shards[self.shard(key)]
+        queue = shard.queues.get(key)
+        if queue is None:
+            queue = shard.queues[key] = collections.deque()
+        if not queue:
+            shard.ready.append(key)
+        queue.append((func, args))
+        self._pending += 1
+        self._idle.clear()
+        self.stats['max_pending'] = max(self.stats['max_pending'], self._pending)
+        shard.event.set()
+
+    async def _worker(self, shard):
+        '''
+        takes one item from each key with work in turn, until stopped
+        '''
+        try:
+            while True:
+                if not shard.ready:
+                    shard.event.clear()
+                    await shard.event.wait()
+                    continue
+                key = shard.ready.popleft()
+                queue = shard.queues[key]
+                func, args = queue.popleft()
+                if queue:
+                    shard.ready.append(key)     #back of the line
+                else:
+                    del shard.queues[key]       #don't keep queues for idle keys
+                try:
+                    result = func(*args)
+                    if asyncio.iscoroutine(result):
+                        task = self._loop.create_task(result)
+                        self._running.add(task)
+                        task.add_done_callback(self._running.discard)
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    self._log.exception(e)
+                self.stats['processed'] += 1
+                self._pending -= 1
+                if not self._pending:
+                    self._idle.set()
+                await asyncio.sleep(0)  #let other tasks (and workers) run
+        except asyncio.CancelledError:
+            pass
+
+    async def join(self):
+        '''
+        wait until everything put has been handled
+        '''
+        await self._idle.wait()
+
+    async def stop(self):
+        '''
+        stop the workers, and cancel any tasks they started, anything not handled yet is dropped
+        '''
+        tasks = self._workers + list(self._running)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        for shard in self._shards:
+            shard.queues.clear()
+            shard.ready.clear()
+        self._pending = 0
+        self._idle.set()